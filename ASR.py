@@ -8,20 +8,10 @@
 # 语音合成: https://www.xfyun.cn/doc/tts/online_tts/API.html
 
 import websocket
-import hashlib
 import base64
-import hmac
-import json
-from urllib.parse import urlencode
 import time
 import ssl
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
-import _thread as thread
-import os
 import pyaudio
-import dotenv
 import array
 import sys
 
@@ -29,10 +19,37 @@ import sys
 from spark_api import SparkAPI
 # 导入语音合成模块
 from tts_api import TTSApi
+# 导入讯飞鉴权模块
+from xf_auth import get_signer
+# 导入共享工作线程池
+from worker_pool import submit_or_run, submit_long, wait_done
+# 导入音频上行发送模块
+from audio_uplink import AudioSender
+# 导入上行编码配置（手动构建的听写消息与发送器使用相同的编码参数）
+from uplink_codec import uplink_encoding, AUDIO_FORMAT
+# 导入识别后端模块（云端 + 离线Vosk）
+from asr_backends import create_recognizer, preload_offline_model
+# 导入事件日志模块（热路径输出不做同步控制台I/O）
+from event_log import log, DEBUG
+# 导入配额控制模块（听写接口的并发连接数和每秒请求数）
+from quota import get_quota, QuotaExceeded
+# 导入会话录制模块（默认关闭）
+from session_recorder import record, record_mark, KIND_MIC, KIND_IAT, MARK_TURN_START
+# 导入关键词/本地命令匹配模块
+from command_matcher import load_command_matcher, INTENT_STOP, INTENT_VOLUME_UP, INTENT_VOLUME_DOWN, INTENT_REPEAT
+# 导入麦克风采集（设备不支持16kHz时按原生采样率采集并在进程内转换）
+from resample import open_capture
+# 导入麦克风前端处理（高通、降噪、自动增益）
+from audio_frontend import get_frontend
 
-# 加载环境变量
-dotenv.load_dotenv()
-dotenv.load_dotenv(override=True) 
+from startup import load_config
+# 导入共享的配置快照（解析一次，热加载时整体替换）
+from settings import get_settings
+# 导入JSON编解码（自动选择最快的实现）
+from json_codec import loads, dumps
+
+# 加载环境变量（整个进程只加载一次）
+load_config()
 # 全局常量
 STATUS_FIRST_FRAME = 0  # 第一帧的标识
 STATUS_CONTINUE_FRAME = 1  # 中间帧标识
@@ -55,9 +72,22 @@ asr_preconnected_ws = None  # 预连接的ASR WebSocket对象
 spark_global = None  # 全局Spark模型实例
 tts_global = None    # 全局TTS实例
 asr_paused = False   # 控制ASR是否暂停
+command_matcher = load_command_matcher()  # 停止关键词和本地命令匹配器
+command_scanner = command_matcher.scanner()  # 实时识别结果的增量扫描器
+active_recognizer = None  # 当前录音轮次的识别器（云端 + 离线）
+asr_preconnect_future = None  # 预连接的运行任务
+asr_preconnect_admission = None  # 预连接占用的听写配额
 def preconnect_asr():
     """预连接到ASR服务器但不发送音频"""
-    global ws_param, asr_preconnected_ws
+    global ws_param, asr_preconnected_ws, asr_preconnect_future, asr_preconnect_admission
+    # 上一轮未使用的预连接先关闭，长时间运行不遗留连接和线程
+    close_preconnect()
+    # 预连接只是优化，当前没有空闲配额时不排队，直接跳过
+    try:
+        asr_preconnect_admission = get_quota("iat").acquire(timeout=0)
+    except QuotaExceeded as e:
+        print(f"跳过ASR预连接: {e}")
+        return
     print("预连接ASR服务器...")
     ws_param = WsParam()
     ws_url = ws_param.create_url()
@@ -74,14 +104,31 @@ def preconnect_asr():
     # 保存预连接对象
     asr_preconnected_ws = ws
     
-    # 在后台线程运行连接
+    # 在长任务线程中运行连接
     def run_ws():
         try:
             ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
         except Exception as e:
             print(f"预连接异常: {e}")
     
-    thread.start_new_thread(run_ws, ())
+    asr_preconnect_future = submit_long(run_ws, name="asr-preconnect-ws")
+
+def close_preconnect():
+    """
+    关闭预连接并等待其运行任务退出
+    """
+    global asr_preconnected_ws, asr_preconnect_future, asr_preconnect_admission
+    ws, asr_preconnected_ws = asr_preconnected_ws, None
+    if ws is not None:
+        try:
+            ws.close()
+        except Exception:
+            pass
+    future, asr_preconnect_future = asr_preconnect_future, None
+    wait_done(future, 2)
+    admission, asr_preconnect_admission = asr_preconnect_admission, None
+    if admission is not None:
+        admission.release()
 
 def on_preconnect_open(ws):
     """预连接建立时的处理"""
@@ -102,7 +149,6 @@ def init_services():
     
     # 预初始化Spark
     try:
-        from spark_api import SparkAPI
         spark_global = SparkAPI(auto_connect=True)  # 需要添加auto_connect参数支持
         print("星火大模型预初始化成功")
     except Exception as e:
@@ -110,12 +156,56 @@ def init_services():
         
     # 预初始化TTS
     try:
-        from tts_api import TTSApi
         tts_global = TTSApi()
         tts_global.prepare_connection()  # 需要添加此方法
         print("TTS服务预初始化成功")
     except Exception as e:
         print(f"TTS服务预初始化失败: {e}")
+
+    # 预加载离线识别模型，避免第一次录音时才加载
+    if preload_offline_model():
+        print("离线识别模型预加载成功")
+def handle_local_command(intent, spark_model):
+    """
+    处理无需调用大模型的本地命令（音量、重复等）
+    :param intent: 命令意图
+    :param spark_model: 星火大模型实例，用于获取上一次回复
+    :return: 是否已在本地处理，未处理时应交给大模型
+    """
+    tts = tts_global
+    if tts is None and spark_model is not None:
+        tts = spark_model.tts_api
+    
+    if intent in (INTENT_VOLUME_UP, INTENT_VOLUME_DOWN):
+        if tts is None:
+            print("TTS未初始化，无法调整音量")
+            return True
+        step = 10 if intent == INTENT_VOLUME_UP else -10
+        tts.volume = max(0, min(100, tts.volume + step))
+        print(f"本地命令: 音量调整为 {tts.volume}")
+        tts.speak("好的，音量已调大" if step > 0 else "好的，音量已调小")
+        return True
+    
+    if intent == INTENT_REPEAT:
+        # 查找上一次的助手回复
+        last_response = None
+        if spark_model is not None:
+            for message in reversed(spark_model.conversation_history):
+                if message["role"] == "assistant":
+                    last_response = message["content"]
+                    break
+        if not last_response:
+            print("没有可重复的回复，交给大模型处理")
+            return False
+        print("本地命令: 重复上一次回复")
+        if tts is not None:
+            tts.speak(last_response)
+        else:
+            print(f"星火: {last_response}")
+        return True
+    
+    return False
+
 def is_silent(audio_data, threshold):
     """
     检测音频是否为静音，不使用numpy
@@ -189,11 +279,12 @@ class WsParam(object):
     讯飞开放平台WebAPI参数类
     """
     def __init__(self):
-        # 从环境变量获取讯飞API参数
-        self.APPID = os.getenv("APPID")
-        self.API_KEY = os.getenv("API_KEY")
-        self.API_SECRET = os.getenv("API_SECRET")
-        self.ASR_URL = os.getenv("ASR_BASE_URL")
+        # 讯飞API参数来自共享的配置快照（每次听写会话创建一个WsParam，配置热加载后自动使用新值）
+        settings = get_settings()
+        self.APPID = settings.appid
+        self.API_KEY = settings.api_key
+        self.API_SECRET = settings.api_secret
+        self.ASR_URL = settings.asr_base_url
         
         # 公共参数(common)
         self.CommonArgs = {"app_id": self.APPID}
@@ -210,38 +301,9 @@ class WsParam(object):
         
     def create_url(self):
         """
-        生成WebSocket鉴权URL
+        生成WebSocket鉴权URL（签名器共享并按秒缓存）
         """
-        url = self.ASR_URL
-        now = datetime.now()
-        date = format_date_time(mktime(now.timetuple()))
-        
-        # 生成RFC1123格式的时间戳
-        signature_origin = f"host: ws-api.xfyun.cn\n"
-        signature_origin += f"date: {date}\n"
-        signature_origin += "GET /v2/iat HTTP/1.1"
-        
-        # 进行hmac-sha256加密
-        signature_sha = hmac.new(
-            self.API_SECRET.encode('utf-8'),
-            signature_origin.encode('utf-8'),
-            digestmod=hashlib.sha256
-        ).digest()
-        
-        signature_sha_base64 = base64.b64encode(signature_sha).decode()
-        authorization_origin = f'api_key="{self.API_KEY}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
-        authorization = base64.b64encode(authorization_origin.encode()).decode()
-        
-        # 拼接鉴权参数
-        v = {
-            "authorization": authorization,
-            "date": date,
-            "host": "ws-api.xfyun.cn"
-        }
-        
-        # 拼接URL
-        url = url + '?' + urlencode(v)
-        return url
+        return get_signer(self.API_KEY, self.API_SECRET, self.ASR_URL, presign=True).sign()
 
 
 def on_message(ws, message):
@@ -249,12 +311,15 @@ def on_message(ws, message):
     收到websocket消息的处理
     """
     global all_results, current_combined_result, continue_chat
+    message_json = None
+    record(KIND_IAT, message)
     try:
-        message_json = json.loads(message)
+        message_json = loads(message)
         
         # 解析结果
         if message_json["code"] != 0:
             print(f"错误码: {message_json['code']}, 错误信息: {message_json['message']}")
+            get_quota("iat").on_error_code(message_json["code"])
             return
         
         # 判断是否有结果
@@ -307,7 +372,7 @@ def on_message(ws, message):
                         "is_sentence_end": True  # 标记句子结束
                     })
                     
-                print(f"最终识别片段: {current_text}")
+                log(DEBUG, "asr.final", f"最终识别片段: {current_text}")
             else:
                 # 非最终结果处理
                 
@@ -343,7 +408,7 @@ def on_message(ws, message):
                         "is_sentence_end": False
                     })
                     
-                print(f"实时识别片段: {current_text}")
+                log(DEBUG, "asr.partial", f"实时识别片段: {current_text}")
             
             # 重新构建完整结果
             # 策略：对全部结果按添加顺序拼接
@@ -381,14 +446,12 @@ def on_message(ws, message):
                     current_combined_result += non_final_results[-1]["text"]
             
             # 显示当前累积的识别结果
-            print(f"实时完整内容: {current_combined_result}")
-            print("----------------------------")
+            log(DEBUG, "asr.combined", f"实时完整内容: {current_combined_result}\n----------------------------")
             
-            # 检查停止关键词
-            stop_keywords = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
+            # 检查停止关键词（只扫描新增或被替换的识别文本）
             if current_combined_result:
-                for keyword in stop_keywords:
-                    if keyword in current_combined_result:
+                for intent, keyword in command_scanner.feed(current_combined_result):
+                    if intent == INTENT_STOP:
                         print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
                         continue_chat = False
                         
@@ -397,12 +460,12 @@ def on_message(ws, message):
                             d = {
                                 "data": {
                                     "status": STATUS_LAST_FRAME,
-                                    "format": "audio/L16;rate=16000",
+                                    "format": AUDIO_FORMAT,
                                     "audio": base64.b64encode(b'').decode(),
-                                    "encoding": "raw"
+                                    "encoding": uplink_encoding()
                                 }
                             }
-                            ws.send(json.dumps(d))
+                            ws.send(dumps(d))
                         except:
                             pass
                         
@@ -414,6 +477,13 @@ def on_message(ws, message):
         print(f"处理消息时发生错误: {e}")
         import traceback
         print(traceback.format_exc())
+    finally:
+        # 把云端的最终结果或错误通知给识别器
+        if active_recognizer is not None and message_json is not None:
+            if message_json.get("code", 0) != 0:
+                active_recognizer.primary.fail(f"错误码 {message_json.get('code')}")
+            elif (message_json.get("data") or {}).get("status") == STATUS_LAST_FRAME:
+                active_recognizer.primary.deliver(get_final_recognition_result(all_results))
 
 
 def on_error(ws, error):
@@ -421,6 +491,8 @@ def on_error(ws, error):
     收到websocket错误的处理
     """
     print(f"### 错误: {error}")
+    if active_recognizer is not None:
+        active_recognizer.primary.fail(str(error))
 
 
 def on_close(ws, close_status_code, close_reason):
@@ -432,298 +504,221 @@ def on_close(ws, close_status_code, close_reason):
 
 def on_open(ws):
     """
-    连接建立的处理
+    连接建立的处理：在长任务线程中录音和发送（录音持续到本轮回复播放完毕，不占用短任务的工作线程）
     """
-    global ws_param
-    
     print("### 连接已建立 ###")
-    
-    def run(*args):
-        """
-        发送音频数据的线程
-        """
-        global all_results, continue_chat, current_combined_result, spark_global, tts_global
-        all_results = []  # 清空结果列表
-        current_combined_result = "" # 清空当前累积结果
-        # 使用预初始化的服务或创建新实例
-        spark_model = spark_global if spark_global else None
-        llm_called = False # 标记是否已调用LL
+    try:
+        submit_long(record_turn, ws, name="asr-record")
+    except RuntimeError as e:
+        # 进程正在退出
+        print(f"无法开始录音: {e}")
+        ws.close()
 
-        
-        status = STATUS_FIRST_FRAME  # 音频的状态信息
-        
-        # 音频参数
-        CHUNK = 1280  # 每一帧的音频大小
-        FORMAT = pyaudio.paInt16  # 16位深度，范围-32768至32767
-        CHANNELS = 1  # 单声道
-        RATE = 16000  # 16000采样频率
-        SILENCE_THRESHOLD = 500  # 静音检测阈值
-        MAX_SILENCE_TIME = 2  # 最大静音时间（秒）
-        INITIAL_WAIT_TIME = 5  # 等待用户开始说话的最大时间（秒）
-        
-        # 创建音频对象
-        p = pyaudio.PyAudio()
-        
-        # 打开麦克风
-        stream = p.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            input=True,
-            frames_per_buffer=CHUNK
-        )
-        
-        print("* 录音中... (请在5秒内开始说话)")
-        
-        silence_frames = 0  # 记录静音帧数
-        max_silence_frames = int(RATE / CHUNK * MAX_SILENCE_TIME)  # 最大静音帧数
-        initial_wait_frames = int(RATE / CHUNK * INITIAL_WAIT_TIME)  # 初始等待最大帧数
-        has_speech = False  # 标记是否检测到语音
-        initial_silence_frames = 0  # 记录初始静音帧数
-        
+
+def respond(final_text, spark_model):
+    """
+    处理一轮录音的最终识别文本：停止关键词结束对话，本地命令直接执行，其他内容交给大模型回复
+    :param final_text: 最终识别文本
+    :param spark_model: 星火大模型实例，可能为None
+    :return: 是否检测到停止关键词
+    """
+    global asr_paused
+    
+    # 检查停止关键词和本地命令
+    intent, keyword = command_matcher.match(final_text)
+    if intent == INTENT_STOP:
+        print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
+        return True
+    
+    # 本地命令（音量、重复等）直接处理，不调用大模型
+    if intent is not None and handle_local_command(intent, spark_model):
+        return False
+    
+    if not final_text.strip():
+        print("\n没有有效的实时识别内容。")
+    elif not spark_model:
+        print("\n星火大模型未成功初始化，无法获取回复。")
+    else:
+        print(f"\n使用最终识别结果: {final_text}\n")
         try:
-            for i in range(0, int(RATE * 60 / CHUNK)):  # 最大录音时长60秒
-                # 读取音频数据
-                try:
-                    buf = stream.read(CHUNK, exception_on_overflow=False)
-                except Exception as e:
-                    print(f"读取音频流时出错: {e}")
-                    continue
-                
-                # 判断是否为静音
-                is_silence = is_silent(buf, SILENCE_THRESHOLD)
-                
-                # 检查是否超过初始等待时间
-                if not has_speech:
-                    if is_silence:
-                        initial_silence_frames += 1
-                        if initial_silence_frames % 10 == 0:  # 每10帧输出一次
-                            remaining = INITIAL_WAIT_TIME - (initial_silence_frames * CHUNK / RATE)
-                            print(f"等待用户开始说话: 还剩 {remaining:.1f} 秒")
-                        
-                        if initial_silence_frames >= initial_wait_frames:
-                            print("未检测到语音输入，自动关闭会话...")
-                            continue_chat = False
-                            ws.close()
-                            break
-                    else:
-                        # 检测到用户开始说话
-                        has_speech = True
-                        print("检测到语音输入，开始录音...")
-                        # 预先创建 SparkAPI 实例
-                        if spark_model is None and spark_global is not None:
-                            spark_model = spark_global
-                            print("使用预初始化的星火大模型...")
-                        elif spark_model is None:
-                            print("预先初始化星火大模型...")
-                            try:
-                                spark_model = SparkAPI()
-                                print("星火大模型初始化成功。")
-                            except Exception as e:
-                                print(f"预先初始化星火大模型失败: {e}")
-                                spark_model = None 
-                
-                # 如果已经检测到语音，则按正常的录音处理逻辑
-                if has_speech:
-                    # 如果检测到声音，重置静音计数
-                    if not is_silence:
-                        silence_frames = 0
-                    # 只有在检测到语音后才开始计算静音时间
-                    else:
-                        silence_frames += 1
-                        if silence_frames % 10 == 0: # 每10帧输出一次
-                            print(f"检测到停止说话: {silence_frames}/{max_silence_frames} 帧")
-                        
-                        if silence_frames >= max_silence_frames:
-                            # 检测到持续静音，发送最后一帧并立即调用LLM
-                            print("检测到持续静音，发送最后一帧并准备调用大模型...")
-                            d = {
-                                "data": {
-                                    "status": STATUS_LAST_FRAME,
-                                    "format": "audio/L16;rate=16000",
-                                    "audio": base64.b64encode(b'').decode(),
-                                    "encoding": "raw"
-                                }
-                            }
-                            ws.send(json.dumps(d))
-                            # 短暂等待，让on_message处理可能到来的最后消息
-                            time.sleep(0.2) 
-                            # 打印录音结束和最终文本 (重要：将这部分放在调用大模型之前)
-                            print("* 录音结束")
-                            final_text = get_final_recognition_result(all_results) # 使用处理函数获取完整结果
-                            
-                            if final_text.strip():
-                                print(f"最终确认文本: {final_text}")
-                            else:
-                                print("没有识别到有效内容")
-                            
-                            # 检查停止关键词
-                            stop_keywords = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
-                            for keyword in stop_keywords:
-                                if keyword in final_text:
-                                    print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
-                                    continue_chat = False
-                                    ws.close()
-                                    return
-                                
-                            # 使用当前累积的结果调用LLM
-                            if final_text.strip() and spark_model:
-                                print(f"\n使用最终识别结果: {final_text}\n")
-                                try:
-                                    # 设置asr_paused标志
-                                    asr_paused = True
-                                    
-                                    # 使用全局TTS实例，如果可用
-                                    if tts_global is not None and spark_model.tts_api is None:
-                                        spark_model.tts_api = tts_global
-                                        spark_model.tts_initialized = True
-                                        print("使用预初始化的TTS服务...")
-                                    
-                                    # 调用大模型 (不使用回调参数)
-                                    response = spark_model.chat(final_text)
-                                    
-                                    # TTS播放完成后在这里重置标志
-                                    print("TTS播放完成，准备恢复语音识别...")
-                                    asr_paused = False
-                                    
-                                    llm_called = True # 标记已调用
-                                    ws.close()
-                                    print("ASR WebSocket连接已主动关闭")
-                                except Exception as e:
-                                    print(f"\n调用星火大模型时发生错误: {e}")
-                                    # 确保出错时重置暂停标志
-                                    asr_paused = False
-                            elif not spark_model:
-                                 print("\n星火大模型未成功初始化，无法获取回复。")
-                            else:
-                                print("\n没有有效的实时识别内容。")
+            # 设置 ASR 暂停标志
+            asr_paused = True
+            
+            # 使用全局TTS实例，如果可用
+            if tts_global is not None and spark_model.tts_api is None:
+                spark_model.tts_api = tts_global
+                spark_model.tts_initialized = True
+                print("使用预初始化的TTS服务...")
+            
+            # 调用星火大模型，chat 会等待 TTS 播放完成
+            spark_model.chat(final_text)
+            print("TTS 播放完成，准备恢复语音识别...")
+        except Exception as e:
+            print(f"\n调用星火大模型时发生错误: {e}")
+        finally:
+            # 确保出错时也重置暂停标志
+            asr_paused = False
+    return False
 
-                            break # 结束录音循环
-                
-                # 判断音频的状态
-                if i == 0:
-                    # 第一帧音频
-                    status = STATUS_FIRST_FRAME
-                elif i == int(RATE * 60 / CHUNK) - 1:
-                    # 最后一帧音频
-                    status = STATUS_LAST_FRAME
-                else:
-                    # 中间帧音频
-                    status = STATUS_CONTINUE_FRAME
-                
-                # 第一帧发送业务和公共参数
-                if status == STATUS_FIRST_FRAME:
-                    d = {
-                        "common": ws_param.CommonArgs,
-                        "business": ws_param.BusinessArgs,
-                        "data": {
-                            "status": STATUS_FIRST_FRAME,
-                            "format": "audio/L16;rate=16000",
-                            "audio": base64.b64encode(buf).decode(),
-                            "encoding": "raw"
-                        }
-                    }
-                    ws.send(json.dumps(d))
 
-                # 中间帧只发送音频
-                elif status == STATUS_CONTINUE_FRAME:
-                    d = {
-                        "data": {
-                            "status": STATUS_CONTINUE_FRAME,
-                            "format": "audio/L16;rate=16000",
-                            "audio": base64.b64encode(buf).decode(),
-                            "encoding": "raw"
-                        }
-                    }
-                    ws.send(json.dumps(d))
-                    # 保持稳定的发送节奏，不要太快也不要太慢
-                    # time.sleep(0.05) # 注意：这里的sleep可能不需要或可以缩短
-                # 最后一帧 (由于达到最大时长)
-                elif status == STATUS_LAST_FRAME:
-                    print("达到最大录音时长，发送最后一帧并准备调用大模型...")
-                    d = {
-                        "data": {
-                            "status": STATUS_LAST_FRAME,
-                            "format": "audio/L16;rate=16000",
-                            "audio": base64.b64encode(b'').decode(),
-                            "encoding": "raw"
-                        }
-                    }
-                    ws.send(json.dumps(d))
-                    # 短暂等待
-                    time.sleep(0.2) 
-                    
-                    # 使用当前累积的结果调用LLM
-                    final_text = get_final_recognition_result(all_results)  # 使用处理函数获取完整结果
-                    
-                    # 检查停止关键词
-                    stop_keywords = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
-                    for keyword in stop_keywords:
-                        if keyword in final_text:
-                            print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
-                            continue_chat = False
-                            ws.close()
-                            return
+def record_turn(ws):
+    """
+    录音并发送一轮语音：等待用户开始说话，说完（持续静音或达到最大时长）后结束上行并回复
+    :param ws: 已建立的听写连接
+    """
+    global all_results, continue_chat, current_combined_result, active_recognizer
+    all_results = []  # 清空结果列表
+    command_scanner.reset()  # 清空关键词扫描状态
+    current_combined_result = "" # 清空当前累积结果
+    
+    # 使用预初始化的服务或创建新实例
+    spark_model = spark_global if spark_global else None
+    
+    # 音频参数
+    CHUNK = 1280  # 每一帧的音频大小
+    RATE = 16000  # 16000采样频率
+    SILENCE_THRESHOLD = 300  # 静音检测阈值
+    MAX_SILENCE_TIME = 2  # 最大静音时间（秒）
+    INITIAL_WAIT_TIME = 5  # 等待用户开始说话的最大时间（秒）
+    MAX_FRAMES = int(RATE * 60 / CHUNK)  # 最大录音时长60秒
+    
+    # 创建音频对象
+    p = pyaudio.PyAudio()
+    
+    # 采集与发送解耦：音频帧放入有界队列，由独立的发送线程发送
+    sender = AudioSender(ws, ws_param.CommonArgs, ws_param.BusinessArgs)
+    
+    # 打开麦克风（读取到的总是16kHz音频），输入溢出由采集回调计数，不丢弃已采集的音频
+    stream = open_capture(p, RATE, CHUNK, on_overflow=sender.record_overflow)
+    # 录音先经过前端处理再做静音检测和识别（录制的仍是原始音频）
+    frontend = get_frontend("asr")
+    frontend.restart()
+    
+    print("* 录音中... (请在5秒内开始说话)")
+    
+    # 云端和离线识别并行运行，录音结束后按策略选出最终文本
+    recognizer = create_recognizer(sender, lambda: get_final_recognition_result(all_results))
+    active_recognizer = recognizer
+    record_mark(MARK_TURN_START)
+    
+    silence_frames = 0  # 记录静音帧数
+    max_silence_frames = int(RATE / CHUNK * MAX_SILENCE_TIME)  # 最大静音帧数
+    initial_wait_frames = int(RATE / CHUNK * INITIAL_WAIT_TIME)  # 初始等待最大帧数
+    has_speech = False  # 标记是否检测到语音
+    initial_silence_frames = 0  # 记录初始静音帧数
+    
+    try:
+        for i in range(MAX_FRAMES):
+            # 读取音频数据
+            try:
+                buf = stream.read(CHUNK, exception_on_overflow=False)
+            except Exception as e:
+                sender.record_capture_error()
+                print(f"读取音频流时出错: {e}")
+                continue
+            record(KIND_MIC, buf)
+            buf = frontend.process(buf)
+            
+            # 判断是否为静音
+            is_silence = is_silent(buf, SILENCE_THRESHOLD)
+            
+            # 检查是否超过初始等待时间
+            if not has_speech:
+                if is_silence:
+                    initial_silence_frames += 1
+                    if initial_silence_frames % 10 == 0:  # 每10帧输出一次
+                        remaining = INITIAL_WAIT_TIME - (initial_silence_frames * CHUNK / RATE)
+                        log(DEBUG, "asr.wait", f"等待用户开始说话: 还剩 {remaining:.1f} 秒")
                     
-                    if final_text.strip() and spark_model:
-                        print(f"\n使用最终识别结果: {final_text}\n")
+                    if initial_silence_frames >= initial_wait_frames:
+                        print("未检测到语音输入，自动关闭会话...")
+                        continue_chat = False
+                        ws.close()
+                        break
+                else:
+                    # 检测到用户开始说话
+                    has_speech = True
+                    print("检测到语音输入，开始录音...")
+                    # 预先创建 SparkAPI 实例
+                    if spark_model is None and spark_global is not None:
+                        spark_model = spark_global
+                        print("使用预初始化的星火大模型...")
+                    elif spark_model is None:
+                        print("预先初始化星火大模型...")
                         try:
-                            # 设置asr_paused标志
-                            asr_paused = True
-                            
-                            # 使用全局TTS实例，如果可用
-                            if tts_global is not None and spark_model.tts_api is None:
-                                spark_model.tts_api = tts_global
-                                spark_model.tts_initialized = True
-                                print("使用预初始化的TTS服务...")
-                            
-                            # 调用大模型 (不使用回调参数)
-                            response = spark_model.chat(final_text)
-                            
-                            # TTS播放完成后在这里重置标志
-                            print("TTS播放完成，准备恢复语音识别...")
-                            asr_paused = False
-                            
-                            llm_called = True # 标记已调用
-                            ws.close()
-                            print("ASR WebSocket连接已主动关闭")
+                            spark_model = SparkAPI()
+                            print("星火大模型初始化成功。")
                         except Exception as e:
-                            print(f"\n调用星火大模型时发生错误: {e}")
-                            # 确保出错时重置暂停标志
-                            asr_paused = False
-                    elif not spark_model:
-                         print("\n星火大模型未成功初始化，无法获取回复。")
-                    else:
-                         print("\n没有有效的实时识别内容。")
-                         
-                    break # 结束录音循环
+                            print(f"预先初始化星火大模型失败: {e}")
+                            spark_model = None
+            
+            # 只有在检测到语音后才开始计算静音时间
+            finished = False
+            if has_speech:
+                if not is_silence:
+                    silence_frames = 0
+                else:
+                    silence_frames += 1
+                    if silence_frames % 10 == 0: # 每10帧输出一次
+                        log(DEBUG, "asr.silence", f"检测到停止说话: {silence_frames}/{max_silence_frames} 帧")
+                    if silence_frames >= max_silence_frames:
+                        print("检测到持续静音，发送最后一帧并准备调用大模型...")
+                        finished = True
+            
+            if not finished and i == MAX_FRAMES - 1:
+                print("达到最大录音时长，发送最后一帧并准备调用大模型...")
+                finished = True
+            
+            if not finished:
+                # 第一帧和中间帧放入发送队列，由发送线程发送（第一帧附带业务和公共参数）
+                recognizer.feed(buf)
+                continue
+            
+            # 最后一帧排在已采集的音频之后；云端在延迟预算内未返回最终结果时使用离线识别结果
+            final_text = recognizer.finish_and_resolve().text
+            print(recognizer.report())
+            print("* 录音结束")
+            if final_text.strip():
+                print(f"最终确认文本: {final_text}")
+            else:
+                print("没有识别到有效内容")
+            
+            if respond(final_text, spark_model):
+                continue_chat = False
+            ws.close()
+            print("ASR WebSocket连接已主动关闭")
+            break # 结束录音循环
+    
+    except KeyboardInterrupt:
+        # 用户手动结束
+        print("用户中断录音")
+    except Exception as e:
+        print(f"发送音频时发生错误: {e}")
+    
+    finally:
+        # 停止发送线程并输出上行统计
+        sender.close()
+        recognizer.close()
+        print(sender.report())
         
-        except KeyboardInterrupt:
-            # 用户手动结束
-            print("用户中断录音")
+        # 关闭音频流
+        try:
+            stream.stop_stream()
+            stream.close()
+            p.terminate()
         except Exception as e:
-            print(f"发送音频时发生错误: {e}")
-        
-        finally:
-            # 关闭音频流
-            try:
-                stream.stop_stream()
-                stream.close()
-                p.terminate()
-            except Exception as e:
-                print(f"关闭音频流时出错: {e}")
-    
-    # 启动线程
-    thread.start_new_thread(run, ())
+            print(f"关闭音频流时出错: {e}")
 
 
 def voice_chat():
     """
-    进行语音对话
+    进行一轮语音对话
     :return: 是否继续对话的标志
     """
-    global asr_preconnected_ws, ws_param, all_results, current_combined_result, spark_global, tts_global, continue_chat, asr_paused
+    global ws_param
     
+    # 新建连接时占用的听写配额（使用预连接时由预连接占用）
+    admission = None
     # 检查是否有预连接可用
     if asr_preconnected_ws and asr_preconnected_ws.sock and asr_preconnected_ws.sock.connected:
         print("使用预连接的ASR通道...")
@@ -731,20 +726,27 @@ def voice_chat():
         # 替换回调函数为实际处理函数
         ws.on_message = on_message
         ws.on_close = on_close
-        ws.on_open = on_open  # 确保on_open会启动录音线程
         # 需要重新发送业务参数（根据讯飞协议）
         d = {
             "common": ws_param.CommonArgs,
             "business": ws_param.BusinessArgs,
             "data": {
                 "status": STATUS_FIRST_FRAME,
-                "format": "audio/L16;rate=16000",
+                "format": AUDIO_FORMAT,
                 "audio": "",  # 实际数据在录音线程发送
-                "encoding": "raw"
+                "encoding": uplink_encoding()
             }
         }
-        ws.send(json.dumps(d))
+        ws.send(dumps(d))
     else:
+        # 预连接尚未建立时不再使用它，关闭以免遗留
+        close_preconnect()
+        # 申请听写配额，排队超时时本轮不建立连接
+        try:
+            admission = get_quota("iat").acquire()
+        except QuotaExceeded as e:
+            print(f"语音识别请求被限流: {e}")
+            return continue_chat
         # 正常建立新连接
         ws_param = WsParam()
         ws_url = ws_param.create_url()
@@ -752,298 +754,10 @@ def voice_chat():
             ws_url,
             on_message=on_message,
             on_error=on_error,
-            on_close=on_close,
-            on_open=on_open
+            on_close=on_close
         )
-    
-    # 在on_open回调中设置一个闭包，允许访问ws对象
-    def on_open_wrapper(original_on_open):
-        def wrapper(ws):
-            global all_results, continue_chat, current_combined_result, spark_global, tts_global, asr_paused
-            
-            print("### 连接已建立 ###")
-            
-            def run(*args):
-                """
-                发送音频数据的线程
-                """
-                global all_results, continue_chat, current_combined_result, spark_global, tts_global, asr_paused
-                all_results = []  # 清空结果列表
-                current_combined_result = "" # 清空当前累积结果
-                
-                # 使用预初始化的服务或创建新实例
-                spark_model = spark_global if spark_global else None
-                llm_called = False # 标记是否已调用LLM
-                
-                status = STATUS_FIRST_FRAME  # 音频的状态信息
-                
-                # 音频参数
-                CHUNK = 1280  # 每一帧的音频大小
-                FORMAT = pyaudio.paInt16  # 16位深度，范围-32768至32767
-                CHANNELS = 1  # 单声道
-                RATE = 16000  # 16000采样频率
-                SILENCE_THRESHOLD = 300  # 静音检测阈值
-                MAX_SILENCE_TIME = 2  # 最大静音时间（秒）
-                INITIAL_WAIT_TIME = 5  # 等待用户开始说话的最大时间（秒）
-                
-                # 创建音频对象
-                p = pyaudio.PyAudio()
-                
-                # 打开麦克风
-                stream = p.open(
-                    format=FORMAT,
-                    channels=CHANNELS,
-                    rate=RATE,
-                    input=True,
-                    frames_per_buffer=CHUNK
-                )
-                
-                print("* 录音中... (请在5秒内开始说话)")
-                
-                silence_frames = 0  # 记录静音帧数
-                max_silence_frames = int(RATE / CHUNK * MAX_SILENCE_TIME)  # 最大静音帧数
-                initial_wait_frames = int(RATE / CHUNK * INITIAL_WAIT_TIME)  # 初始等待最大帧数
-                has_speech = False  # 标记是否检测到语音
-                initial_silence_frames = 0  # 记录初始静音帧数
-                
-                try:
-                    for i in range(0, int(RATE * 60 / CHUNK)):  # 最大录音时长60秒
-                        # 读取音频数据
-                        try:
-                            buf = stream.read(CHUNK, exception_on_overflow=False)
-                        except Exception as e:
-                            print(f"读取音频流时出错: {e}")
-                            continue
-                        
-                        # 判断是否为静音
-                        is_silence = is_silent(buf, SILENCE_THRESHOLD)
-                        
-                        # 检查是否超过初始等待时间
-                        if not has_speech:
-                            if is_silence:
-                                initial_silence_frames += 1
-                                if initial_silence_frames % 10 == 0:  # 每10帧输出一次
-                                    remaining = INITIAL_WAIT_TIME - (initial_silence_frames * CHUNK / RATE)
-                                    print(f"等待用户开始说话: 还剩 {remaining:.1f} 秒")
-                                
-                                if initial_silence_frames >= initial_wait_frames:
-                                    print("未检测到语音输入，自动关闭会话...")
-                                    continue_chat = False
-                                    ws.close()
-                                    break
-                            else:
-                                # 检测到用户开始说话
-                                has_speech = True
-                                print("检测到语音输入，开始录音...")
-                                # 预先创建 SparkAPI 实例
-                                if spark_model is None and spark_global is not None:
-                                    spark_model = spark_global
-                                    print("使用预初始化的星火大模型...")
-                                elif spark_model is None:
-                                    print("预先初始化星火大模型...")
-                                    try:
-                                        spark_model = SparkAPI()
-                                        print("星火大模型初始化成功。")
-                                    except Exception as e:
-                                        print(f"预先初始化星火大模型失败: {e}")
-                                        spark_model = None 
-                        
-                        # 如果已经检测到语音，则按正常的录音处理逻辑
-                        if has_speech:
-                            # 如果检测到声音，重置静音计数
-                            if not is_silence:
-                                silence_frames = 0
-                            # 只有在检测到语音后才开始计算静音时间
-                            else:
-                                silence_frames += 1
-                                if silence_frames % 10 == 0: # 每10帧输出一次
-                                    print(f"检测到停止说话: {silence_frames}/{max_silence_frames} 帧")
-                                
-                                if silence_frames >= max_silence_frames:
-                                    # 检测到持续静音，发送最后一帧并立即调用LLM
-                                    print("检测到持续静音，发送最后一帧并准备调用大模型...")
-                                    d = {
-                                        "data": {
-                                            "status": STATUS_LAST_FRAME,
-                                            "format": "audio/L16;rate=16000",
-                                            "audio": base64.b64encode(b'').decode(),
-                                            "encoding": "raw"
-                                        }
-                                    }
-                                    ws.send(json.dumps(d))
-                                    # 短暂等待，让on_message处理可能到来的最后消息
-                                    time.sleep(0.2) 
-                                    # 打印录音结束和最终文本
-                                    print("* 录音结束")
-                                    final_text = get_final_recognition_result(all_results)
-                                    
-                                    if final_text.strip():
-                                        print(f"最终确认文本: {final_text}")
-                                    else:
-                                        print("没有识别到有效内容")
-                                    
-                                    # 检查停止关键词
-                                    stop_keywords = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
-                                    for keyword in stop_keywords:
-                                        if keyword in final_text:
-                                            print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
-                                            continue_chat = False
-                                            ws.close()
-                                            return
-                                    
-                                    # 使用当前累积的结果调用LLM
-                                    if final_text.strip() and spark_model:
-                                        print(f"\n使用最终识别结果: {final_text}\n")
-                                        try:
-                                            # 设置 ASR 暂停标志
-                                            asr_paused = True
-                                            
-                                            # 调用星火大模型 (不使用回调参数)
-                                            response = spark_model.chat(final_text)
-                                            llm_called = True # 标记已调用
-                                            
-                                            # TTS 播放完成后在这里重置标志
-                                            # SparkAPI 的 chat 方法会等待 TTS 播放完成
-                                            print("TTS 播放完成，准备恢复语音识别...")
-                                            asr_paused = False
-                                            
-                                            ws.close()
-                                            print("ASR WebSocket连接已主动关闭")
-                                        except Exception as e:
-                                            print(f"\n调用星火大模型时发生错误: {e}")
-                                            # 确保出错时也重置暂停标志
-                                            asr_paused = False
-                                    elif not spark_model:
-                                         print("\n星火大模型未成功初始化，无法获取回复。")
-                                    else:
-                                         print("\n没有有效的实时识别内容。")
-                                    
-                                    break # 结束录音循环
-                        
-                        # 判断音频的状态
-                        if i == 0:
-                            # 第一帧音频
-                            status = STATUS_FIRST_FRAME
-                        elif i == int(RATE * 60 / CHUNK) - 1:
-                            # 最后一帧音频
-                            status = STATUS_LAST_FRAME
-                        else:
-                            # 中间帧音频
-                            status = STATUS_CONTINUE_FRAME
-                        
-                        # 第一帧发送业务和公共参数
-                        if status == STATUS_FIRST_FRAME:
-                            d = {
-                                "common": ws_param.CommonArgs,
-                                "business": ws_param.BusinessArgs,
-                                "data": {
-                                    "status": STATUS_FIRST_FRAME,
-                                    "format": "audio/L16;rate=16000",
-                                    "audio": base64.b64encode(buf).decode(),
-                                    "encoding": "raw"
-                                }
-                            }
-                            ws.send(json.dumps(d))
-                        
-                        # 中间帧只发送音频
-                        elif status == STATUS_CONTINUE_FRAME:
-                            d = {
-                                "data": {
-                                    "status": STATUS_CONTINUE_FRAME,
-                                    "format": "audio/L16;rate=16000",
-                                    "audio": base64.b64encode(buf).decode(),
-                                    "encoding": "raw"
-                                }
-                            }
-                            ws.send(json.dumps(d))
-                            
-                        # 最后一帧 (由于达到最大时长)
-                        elif status == STATUS_LAST_FRAME:
-                            print("达到最大录音时长，发送最后一帧并准备调用大模型...")
-                            d = {
-                                "data": {
-                                    "status": STATUS_LAST_FRAME,
-                                    "format": "audio/L16;rate=16000",
-                                    "audio": base64.b64encode(b'').decode(),
-                                    "encoding": "raw"
-                                }
-                            }
-                            ws.send(json.dumps(d))
-                            # 短暂等待
-                            time.sleep(0.2) 
-                            
-                            # 使用当前累积的结果调用LLM
-                            final_text = get_final_recognition_result(all_results)
-                            
-                            # 检查停止关键词
-                            stop_keywords = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
-                            for keyword in stop_keywords:
-                                if keyword in final_text:
-                                    print(f"\n检测到停止关键词: '{keyword}'，准备结束程序...")
-                                    continue_chat = False
-                                    ws.close()
-                                    return
-                            
-                            if final_text.strip() and spark_model:
-                                print(f"\n使用最终识别结果: {final_text}\n")
-                                try:
-                                    # 设置asr_paused标志
-                                    asr_paused = True
-                                    
-                                    # 定义TTS完成回调
-                                    def on_tts_complete():
-                                        global asr_paused
-                                        print("TTS播放完成，准备恢复语音识别...")
-                                        asr_paused = False
-                                    
-                                    # 使用全局TTS实例，如果可用
-                                    if tts_global is not None and spark_model.tts_api is None:
-                                        spark_model.tts_api = tts_global
-                                        spark_model.tts_initialized = True
-                                        print("使用预初始化的TTS服务...")
-                                    
-                                    # 带回调调用大模型
-                                    response = spark_model.chat(
-                                        final_text, 
-                                        on_tts_complete=on_tts_complete
-                                    )
-                                    llm_called = True # 标记已调用
-                                    ws.close()
-                                    print("ASR WebSocket连接已主动关闭")
-                                except Exception as e:
-                                    print(f"\n调用星火大模型时发生错误: {e}")
-                                    # 确保出错时重置暂停标志
-                                    asr_paused = False
-                            elif not spark_model:
-                                 print("\n星火大模型未成功初始化，无法获取回复。")
-                            else:
-                                 print("\n没有有效的实时识别内容。")
-                                 
-                            break # 结束录音循环
-                
-                except KeyboardInterrupt:
-                    # 用户手动结束
-                    print("用户中断录音")
-                except Exception as e:
-                    print(f"发送音频时发生错误: {e}")
-                
-                finally:
-                    # 关闭音频流
-                    try:
-                        stream.stop_stream()
-                        stream.close()
-                        p.terminate()
-                    except Exception as e:
-                        print(f"关闭音频流时出错: {e}")
-            
-            # 启动线程
-            thread.start_new_thread(run, ())
-            
-        return wrapper
-    
-    # 替换原始on_open回调
-    original_on_open = on_open
-    ws.on_open = on_open_wrapper(original_on_open)
+    # 连接建立后开始录音
+    ws.on_open = on_open
     
     # 运行WebSocket
     try:
@@ -1051,8 +765,10 @@ def voice_chat():
     except Exception as e:
         print(f"连接错误: {e}")
     
-    # 清理预连接标记
-    asr_preconnected_ws = None
+    # 清理预连接（本轮使用的连接已经结束，未使用的预连接关闭）
+    close_preconnect()
+    if admission is not None:
+        admission.release()
     return continue_chat  # 返回是否继续对话的标志
 
 
@@ -1066,42 +782,49 @@ def main():
     ws_param = WsParam()
     asr_paused = False  # 新增：控制ASR是否暂停
     
-    # 启动服务预初始化（在单独线程中进行，避免阻塞主流程）
-    import _thread as thread
-    thread.start_new_thread(init_services, ())
+    # 启动服务预初始化（在工作线程中进行，避免阻塞主流程）
+    submit_or_run(init_services, name="init-services")
     
     print("==== 讯飞语音识别 + 星火大模型交互系统 + 语音合成 ====")
     print("请对着麦克风说话，系统会识别您的语音并通过星火大模型给出回复")
     print("说话后停顿2秒会自动结束录音，大模型将对您的内容进行回复")
   
     # 主循环
-continue_chat = True
+    run_conversation()
+    print("\n程序已退出")
 
-while continue_chat:
+
+def run_conversation():
+    """
+    连续进行多轮语音对话，直到检测到停止关键词或用户长时间未说话
+    独立运行和唤醒模式共用此函数
+    """
+    global continue_chat
+    
+    continue_chat = True
+    
     try:
-        # 检查是否处于暂停状态
-        if asr_paused:
-            print("正在等待TTS播放完成...")
-            time.sleep(0.5)  # 短暂等待
-            continue  # 跳过本次循环
+        while continue_chat:
+            # 检查是否处于暂停状态
+            if asr_paused:
+                print("正在等待TTS播放完成...")
+                time.sleep(0.5)  # 短暂等待
+                continue  # 跳过本次循环
+                
+            # 预连接ASR
+            submit_or_run(preconnect_asr, name="asr-preconnect")
             
-        # 预连接ASR
-        thread.start_new_thread(preconnect_asr, ())
-        
-        # 进行语音对话
-        continue_chat = voice_chat()
-        
-        # 检查是否需要退出
-        if not continue_chat:
-            print("\n收到停止指令，程序正在退出...")
-            break
+            # 进行语音对话
+            continue_chat = voice_chat()
             
-    except KeyboardInterrupt:
-        print("\n收到键盘中断，程序正在退出...")
-        continue_chat = False
-        break
-    
-    print("\n程序已退出")
+            # 检查是否需要结束
+            if not continue_chat:
+                print("\n收到停止指令，对话结束...")
+                break
+    finally:
+        # 对话结束：取消本会话还在调度器排队的星火请求
+        if spark_global is not None:
+            spark_global.end_session()
 
 
 if __name__ == "__main__":
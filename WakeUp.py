@@ -5,19 +5,23 @@
 # 需要安装以下依赖:
 # pip install vosk pyaudio dotenv
 
-import os
-import json
-import pyaudio
 import threading
 import time
-from vosk import Model, KaldiRecognizer
-import dotenv
 import sys
 import array
 
-# 导入语音助手模块中的相关组件
-from tts_api import TTSApi
-from spark_api import SparkAPI
+# 启动管理：配置只加载一次，重量级依赖（vosk、pyaudio、websocket等）延迟导入或后台预热
+from startup import load_config, startup_timer, warm_up, run_in_background
+# 导入共享的配置快照（解析一次，热加载时整体替换）
+from settings import get_settings, watch_settings
+# 导入关键词匹配模块
+from command_matcher import KeywordMatcher
+# 导入共享Vosk模型缓存（离线识别后端使用同一份模型）
+from asr_backends import get_shared_model
+# 导入事件日志模块
+from event_log import log, DEBUG, INFO
+# 导入JSON编解码模块（逐帧解析Vosk识别结果，使用可用的最快实现）
+from json_codec import loads, dumps
 
 # 从ASR1.5.py导入静音检测函数
 def is_silent(audio_data, threshold):
@@ -28,22 +32,18 @@ def is_silent(audio_data, threshold):
     :return: 是否为静音
     """
     # 将字节数据转换为short数组
-    fmt = 'h' * (len(audio_data) // 2)  # 'h'表示short类型
     shorts = array.array('h', audio_data)
+    if not shorts:
+        return True
     
-    # 计算音量 - 使用简单的最大绝对值
-    max_volume = 0
-    for sample in shorts:
-        abs_sample = abs(sample)
-        if abs_sample > max_volume:
-            max_volume = abs_sample
+    # 计算音量 - 使用简单的最大绝对值（内置max/min，避免逐个样本的Python循环）
+    max_volume = max(max(shorts), -min(shorts))
     
     # 判断是否为静音
     return max_volume < threshold
 
-# 加载环境变量
-dotenv.load_dotenv()
-dotenv.load_dotenv(override=True)
+# 加载环境变量（整个进程只加载一次）
+load_config()
 
 # 全局变量
 wakeup_detected = False
@@ -51,150 +51,284 @@ vosk_running = True
 asr_running = False
 tts_api = None
 spark_model = None
+services_thread = None  # 后台初始化服务的线程
+resource_monitor = None  # 长时间运行模式下的资源监控
 
 class VoskWakeup:
     """
     使用Vosk进行唤醒词检测
+    常驻引擎：识别器、PyAudio和音频流只创建一次，对话期间暂停，对话结束后直接恢复
     """
-    def __init__(self, model_path, wake_words=None):
+    def __init__(self, model_path, wake_words=None, mode=None):
         """
         初始化Vosk唤醒词检测
         :param model_path: Vosk模型路径
-        :param wake_words: 唤醒词列表，默认为 ["一二三"]
+        :param wake_words: 唤醒词列表，默认使用配置中的 WAKE_WORDS（配置热加载后在下次恢复监听时生效）
+        :param mode: 识别模式，"kws" 为限定语法的关键词检测，"full" 为完整识别，默认使用配置中的 WAKE_MODE
         """
         self.model_path = model_path
-        self.is_running = False
+        self._fixed_words = wake_words
+        self._fixed_mode = mode.strip().lower() if mode else None
+        self._last_partial = ""
         self.wake_thread = None
-        self.should_stop = threading.Event()
+        self.should_stop = threading.Event()  # 设置后暂停监听
+        self._resume = threading.Event()  # 设置后恢复监听
+        self._closed = threading.Event()  # 设置后退出常驻线程
+        self.listening = threading.Event()  # 已开始读取音频
+        self.paused = threading.Event()  # 监听线程已停止音频流、释放麦克风（只由监听线程设置）
+        self.paused.set()
+        self._control_lock = threading.Lock()  # 串行化 start/stop
+        self.resume_time = 0.0  # 最近一次恢复监听的时刻
+        self.resume_latency = None  # 最近一次从恢复到读取首帧的耗时（秒）
         
-        # 设置默认唤醒词
-        if wake_words is None:
-            self.wake_words = ["一二三"]
-        else:
-            self.wake_words = wake_words
-            
+        # 设置唤醒词和识别模式
+        self.settings = None
+        self.wake_words = None
+        self.mode = None
+        self._apply_settings(get_settings())
         print(f"唤醒词设置为: {', '.join(self.wake_words)}")
         
-        # 尝试加载模型
+        # 尝试加载模型（进程内共享）
         try:
-            self.model = Model(self.model_path)
-            print(f"Vosk模型已加载: {self.model_path}")
+            self.model = get_shared_model(self.model_path)
         except Exception as e:
             print(f"加载Vosk模型出错: {e}")
             print("请确保您已下载Vosk模型并放置在正确的路径。")
             sys.exit(1)
     
+    def _apply_settings(self, settings):
+        """
+        使用一份配置快照：设置唤醒词和识别模式，编译匹配器和关键词检测语法
+        :param settings: Settings
+        :return: 识别器是否需要重新创建（模式或语法变化）
+        """
+        self.settings = settings
+        wake_words = list(self._fixed_words if self._fixed_words is not None else settings.wake_words)
+        mode = self._fixed_mode or settings.wake_mode
+        if wake_words == self.wake_words and mode == self.mode:
+            return False
+        self.wake_words = wake_words
+        self.mode = mode
+        
+        # 编译唤醒词匹配器（Vosk中文结果以空格分词，匹配前会去掉空格）
+        self.wake_matcher = KeywordMatcher([word.replace(" ", "") for word in self.wake_words])
+        
+        # 关键词检测模式的语法：唤醒词加上垃圾词 [unk]
+        self.grammar = dumps(self.wake_words + ["[unk]"])
+        return True
+    
+    @property
+    def is_running(self):
+        """
+        监听线程存在且没有暂停
+        """
+        return self.wake_thread is not None and self.wake_thread.is_alive() and not self.paused.is_set()
+    
     def start(self):
         """
-        启动唤醒词监听
+        启动唤醒词监听，常驻线程已存在时直接恢复
         """
-        if not self.is_running:
-            self.is_running = True
-            self.should_stop.clear()
+        with self._control_lock:
+            alive = self.wake_thread is not None and self.wake_thread.is_alive()
+            if alive and not self.paused.is_set():
+                if not self.should_stop.is_set():
+                    return  # 正在监听
+                # 线程正在暂停（例如刚检测到唤醒词），等它停止音频流后再恢复，避免恢复信号被暂停流程吞掉
+                self.paused.wait(timeout=2)
             
-            # 创建并启动监听线程
-            self.wake_thread = threading.Thread(target=self._listen_for_wakeword)
-            self.wake_thread.daemon = True
-            self.wake_thread.start()
+            self.should_stop.clear()
+            self.listening.clear()
+            self.resume_time = time.perf_counter()
+            self.paused.clear()
+            if alive:
+                # 常驻线程处于暂停状态，直接唤醒
+                self._resume.set()
+            else:
+                # 创建并启动监听线程
+                self._closed.clear()
+                self.wake_thread = threading.Thread(target=self._listen_for_wakeword, name="vosk-wakeup")
+                self.wake_thread.daemon = True
+                self.wake_thread.start()
             
             print("唤醒词监听已启动，等待唤醒...")
     
-    def stop(self):
+    def stop(self, timeout=2):
         """
-        停止唤醒词监听
+        暂停唤醒词监听，保留识别器和音频设备以便快速恢复
+        等到监听线程停止音频流后才返回，之后可以安全地打开麦克风录音
+        :param timeout: 最长等待时间（秒）
+        :return: 是否已暂停
         """
-        if self.is_running:
-            print("正在停止唤醒词监听...")
+        with self._control_lock:
+            if not self.is_running:
+                return True
+            print("正在暂停唤醒词监听...")
             self.should_stop.set()
-            self.is_running = False
-            
-            # 等待线程结束
-            if self.wake_thread and self.wake_thread.is_alive():
-                self.wake_thread.join(timeout=2)
-            
-            print("唤醒词监听已停止")
+            if not self.paused.wait(timeout):
+                print("唤醒词监听未能在规定时间内暂停")
+                return False
+            print("唤醒词监听已暂停")
+            return True
+    
+    def close(self):
+        """
+        停止唤醒词监听并释放识别器和音频设备
+        """
+        print("正在停止唤醒词监听...")
+        self.should_stop.set()
+        self._closed.set()
+        self._resume.set()
+        
+        # 等待线程结束
+        if self.wake_thread and self.wake_thread.is_alive():
+            self.wake_thread.join(timeout=2)
+        
+        print("唤醒词监听已停止")
+    
+    def _create_recognizer(self, rate):
+        """
+        创建语音识别器
+        关键词检测模式下只识别唤醒词和 [unk]，并且不输出逐字时间信息
+        :param rate: 采样率
+        :return: KaldiRecognizer对象
+        """
+        from vosk import KaldiRecognizer
+        
+        self._last_partial = ""
+        if self.mode == "kws":
+            return KaldiRecognizer(self.model, rate, self.grammar)
+        
+        recognizer = KaldiRecognizer(self.model, rate)
+        recognizer.SetWords(True)  # 启用逐字识别
+        return recognizer
+    
+    def _match_wake_word(self, text):
+        """
+        在识别文本中查找唤醒词
+        :param text: Vosk识别文本
+        :return: 唤醒词，未找到时返回None
+        """
+        return self.wake_matcher.first(text.replace("[unk]", "").replace(" ", ""))
+    
+    def process_audio(self, recognizer, data):
+        """
+        将一帧音频送入识别器并检查唤醒词
+        :param recognizer: 识别器
+        :param data: 音频数据
+        :return: 检测到的唤醒词，未检测到时返回None
+        """
+        # 添加语音数据到识别器
+        if recognizer.AcceptWaveform(data):
+            self._last_partial = ""
+            result = loads(recognizer.Result())
+            text = result.get("text", "").replace("[unk]", "").strip()
+            if text:
+                log(DEBUG, "wake.text", f"识别到: {text}")
+                wake_word = self._match_wake_word(text)
+                if wake_word:
+                    print(f"检测到唤醒词: {wake_word}")
+                    return wake_word
+            return None
+        
+        # 处理部分结果，只有部分结果变化时才解析
+        partial = recognizer.PartialResult()
+        if partial == self._last_partial:
+            return None
+        self._last_partial = partial
+        
+        partial_text = loads(partial).get("partial", "")
+        if partial_text:
+            wake_word = self._match_wake_word(partial_text)
+            if wake_word:
+                print(f"检测到唤醒词(部分识别): {wake_word}")
+                return wake_word
+        return None
     
     def _listen_for_wakeword(self):
         """
-        监听唤醒词的线程函数
+        常驻监听线程：循环执行 监听 -> 暂停 -> 重置识别器 -> 恢复
         """
         global wakeup_detected, vosk_running
+        import pyaudio
+        from resample import open_capture
+        from audio_frontend import get_frontend
         
         # 音频参数
         CHUNK = 1280  # 每一帧的音频大小
-        FORMAT = pyaudio.paInt16  # 16位深度
-        CHANNELS = 1  # 单声道
         RATE = 16000  # 16000采样频率
         SILENCE_THRESHOLD = 500  # 静音检测阈值
         
         # 创建PyAudio对象
         p = pyaudio.PyAudio()
+        stream = None
         
         try:
-            # 创建语音识别器
-            recognizer = KaldiRecognizer(self.model, RATE)
-            recognizer.SetWords(True)  # 启用逐字识别
-            
-            # 打开音频流
-            stream = p.open(
-                format=FORMAT,
-                channels=CHANNELS,
-                rate=RATE,
-                input=True,
-                frames_per_buffer=CHUNK
-            )
+            # 创建语音识别器（只创建一次，之后通过Reset复用）
+            recognizer = self._create_recognizer(RATE)
             
-            print("* 开始监听唤醒词...")
+            # 打开音频流（只打开一次，暂停时停止流但不关闭设备；设备不支持16kHz时在进程内转换）
+            stream = open_capture(p, RATE, CHUNK)
+            # 与对话录音共用同一套前端处理（高通、降噪、自动增益）
+            frontend = get_frontend("wake")
             
-            while not self.should_stop.is_set():
-                # 读取音频数据
-                data = stream.read(CHUNK, exception_on_overflow=False)
+            while not self._closed.is_set():
+                print(f"* 开始监听唤醒词... (模式: {self.mode})")
+                first_frame = True
                 
-                # 如果有明显声音才进行处理（优化CPU使用）
-                if not is_silent(data, SILENCE_THRESHOLD):
-                    # 添加语音数据到识别器
-                    if recognizer.AcceptWaveform(data):
-                        result = json.loads(recognizer.Result())
-                        if "text" in result and result["text"]:
-                            text = result["text"].lower()
-                            print(f"识别到: {text}")
-                            
-                            # 检查是否包含唤醒词
-                            for wake_word in self.wake_words:
-                                if wake_word.lower() in text:
-                                    print(f"检测到唤醒词: {wake_word}")
-                                    wakeup_detected = True
-                                    vosk_running = False
-                                    self.should_stop.set()  # 设置停止标志
-                                    break
+                while not self.should_stop.is_set():
+                    # 读取音频数据
+                    data = frontend.process(stream.read(CHUNK, exception_on_overflow=False))
+                    if first_frame:
+                        first_frame = False
+                        self.resume_latency = time.perf_counter() - self.resume_time
+                        self.listening.set()
                     
-                    # 处理部分结果，用于实时反馈
-                    partial_result = json.loads(recognizer.PartialResult())
-                    if "partial" in partial_result and partial_result["partial"]:
-                        partial_text = partial_result["partial"].lower()
-                        
-                        # 检查部分结果是否包含唤醒词
-                        for wake_word in self.wake_words:
-                            if wake_word.lower() in partial_text:
-                                print(f"检测到唤醒词(部分识别): {wake_word}")
-                                wakeup_detected = True
-                                vosk_running = False
-                                self.should_stop.set()  # 设置停止标志
-                                break
+                    # 如果有明显声音才进行处理（优化CPU使用）
+                    if not is_silent(data, SILENCE_THRESHOLD):
+                        wake_word = self.process_audio(recognizer, data)
+                        if wake_word:
+                            wakeup_detected = True
+                            vosk_running = False
+                            self.should_stop.set()  # 设置停止标志
+                    
+                    # 检查是否应该停止
+                    if wakeup_detected or self.should_stop.is_set():
+                        break
+                
+                # 暂停：停止音频流，释放麦克风给ASR使用，但保留设备和识别器；音频流停止后才通知 stop() 返回
+                stream.stop_stream()
+                self.listening.clear()
+                self.paused.set()
                 
-                # 检查是否应该停止
-                if wakeup_detected or self.should_stop.is_set():
+                self._resume.wait()
+                self._resume.clear()
+                if self._closed.is_set():
                     break
+                self.paused.clear()
                 
-            # 关闭流
-            stream.stop_stream()
-            stream.close()
+                # 恢复：重置识别器状态并重新启动音频流；配置热加载改变了唤醒词或模式时重新创建识别器
+                settings = get_settings()
+                if settings is not self.settings and self._apply_settings(settings):
+                    print(f"唤醒词更新为: {', '.join(self.wake_words)} (模式: {self.mode})")
+                    recognizer = self._create_recognizer(RATE)
+                else:
+                    recognizer.Reset()
+                frontend.restart()
+                self._last_partial = ""
+                stream.start_stream()
         
         except Exception as e:
             print(f"唤醒词监听过程中出错: {e}")
         finally:
+            # 关闭流
+            if stream is not None:
+                try:
+                    stream.close()
+                except Exception as e:
+                    print(f"关闭音频流时出错: {e}")
             p.terminate()
-            self.is_running = False
+            self.listening.clear()
+            self.paused.set()
 
 
 def initialize_services():
@@ -202,6 +336,8 @@ def initialize_services():
     预初始化TTS和Spark服务
     """
     global tts_api, spark_model
+    from tts_api import TTSApi
+    from spark_api import SparkAPI
     
     print("正在初始化语音服务...")
     
@@ -231,6 +367,10 @@ def handle_wakeup():
     global tts_api, spark_model, asr_running, vosk_running
     
     try:
+        # 等待后台服务初始化完成
+        if services_thread is not None:
+            services_thread.join()
+        
         # 播放欢迎语
         if tts_api:
             print("播放欢迎语...")
@@ -241,12 +381,16 @@ def handle_wakeup():
         # 设置对话标志
         asr_running = True
         
-        # 导入ASR模块中的相关函数
-        from ASR import voice_chat, continue_chat
+        # 导入ASR模块（通常已在后台预热），并复用已初始化的服务
+        import ASR
+        if ASR.spark_global is None:
+            ASR.spark_global = spark_model
+        if ASR.tts_global is None:
+            ASR.tts_global = tts_api
         
-        # 执行语音对话
+        # 执行多轮语音对话，直到说出停止关键词或无人说话
         print("启动语音对话...")
-        voice_chat_result = voice_chat()
+        ASR.run_conversation()
         
         # 对话结束后，重置标志
         asr_running = False
@@ -259,31 +403,62 @@ def handle_wakeup():
         # 确保重置标志
         asr_running = False
         vosk_running = True
+    finally:
+        # 对话结束（包括出错时）：取消本会话还在调度器排队的星火请求
+        if spark_model is not None:
+            spark_model.end_session()
+        # 长时间运行模式：每次唤醒对话结束后回收并记录资源占用
+        if resource_monitor is not None:
+            resource_monitor.checkpoint("唤醒对话")
+            from worker_pool import pool_report
+            log(INFO, "pool.stats", pool_report())
+            from quota import quota_report
+            report = quota_report()
+            if report:
+                log(INFO, "quota.stats", report)
+            from hedging import hedging_report
+            report = hedging_report()
+            if report:
+                log(INFO, "hedge.stats", report)
+            from spark_scheduler import scheduler_report
+            report = scheduler_report()
+            if report:
+                log(INFO, "scheduler.stats", report)
 
 
 def main():
     """
     主程序入口
     """
-    global wakeup_detected, vosk_running, asr_running
+    global wakeup_detected, vosk_running, asr_running, services_thread, resource_monitor
     
-    # 获取Vosk模型路径（从环境变量或使用默认值）
-    vosk_model_path = os.getenv("VOSK_MODEL_PATH", "./vosk-model-small-cn")
+    settings = get_settings()
+    # 配置热加载：.env修改或收到SIGHUP时更新发音人、提示词、唤醒词等，无需重启
+    watch_settings()
     
-    # 获取唤醒词（从环境变量或使用默认值）
-    wake_words_str = os.getenv("WAKE_WORDS", "一二三,你好小知,小智小智,小知小知")
-    wake_words = [word.strip() for word in wake_words_str.split(",")]
+    # 长时间（7x24）运行模式：监控内存、文件描述符、线程和子进程
+    if settings.long_session:
+        from resource_monitor import ResourceMonitor
+        resource_monitor = ResourceMonitor().start()
     
-    # 初始化服务
-    initialize_services()
+    # 阶段1: 后台预热唤醒后才需要的依赖，并初始化TTS和星火服务
+    warm_up(["websocket", "numpy", "ASR"])
+    services_thread = run_in_background("初始化语音服务", initialize_services)
     
-    # 创建唤醒检测器
-    wakeup_detector = VoskWakeup(vosk_model_path, wake_words)
+    # 阶段2: 加载Vosk模型（模型路径和唤醒词来自配置快照）
+    wakeup_detector = VoskWakeup(settings.vosk_model_path)
+    startup_timer.mark("加载Vosk模型")
     
     print("==== 语音唤醒 + 语音助手系统 ====")
-    print(f"唤醒词: {', '.join(wake_words)}")
+    print(f"唤醒词: {', '.join(wakeup_detector.wake_words)}")
     print("请说唤醒词来启动助手")
     
+    # 阶段3: 打开麦克风，开始监听唤醒词
+    wakeup_detector.start()
+    if wakeup_detector.listening.wait(timeout=10):
+        startup_timer.mark("打开麦克风并开始监听")
+    startup_timer.report("启动到开始监听唤醒词")
+    
     try:
         # 主循环
         while True:
@@ -309,9 +484,10 @@ def main():
     except Exception as e:
         print(f"\n程序发生错误: {e}")
     finally:
-        # 确保停止唤醒检测器
-        if wakeup_detector.is_running:
-            wakeup_detector.stop()
+        # 确保停止唤醒检测器并释放音频设备
+        wakeup_detector.close()
+        if resource_monitor is not None:
+            resource_monitor.stop()
         
         print("\n程序已退出")
 
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 可插拔的语音识别后端：讯飞云端听写 + 本地Vosk离线识别
+# 云端和离线识别并行运行，录音结束后按策略选出最终文本：
+#
+# 环境变量:
+#   ASR_FALLBACK_MODE: 离线识别策略
+#       off      - 只使用云端识别，保持原有行为（默认）
+#       fallback - 离线识别并行运行，云端在延迟预算内没有返回最终结果或出错时使用离线结果
+#       race     - 先到先得：离线结果置信度达到阈值时不再等待云端
+#   ASR_CLOUD_BUDGET_MS: 录音结束后等待云端最终结果的延迟预算，默认1500毫秒
+#   ASR_OFFLINE_MIN_CONFIDENCE: race模式下直接采用离线结果的最低置信度，默认0.7
+#   ASR_OFFLINE_MODEL_PATH: 离线识别使用的Vosk模型，默认与唤醒词共用 VOSK_MODEL_PATH
+#
+# 唤醒模式下离线识别与唤醒词检测共用进程内已加载的Vosk模型，不会重复加载
+
+import abc
+import json
+import os
+import queue
+import threading
+import time
+
+from audio_uplink import STATUS_FIRST_FRAME, STATUS_CONTINUE_FRAME
+from settings import get_settings
+from session_recorder import record_mark, MARK_SPEECH_END, MARK_ASR_RESULT
+
+# 进程内共享的Vosk模型缓存，同一路径的模型只加载一次
+_model_cache = {}
+_model_lock = threading.Lock()
+
+# 多通道唤醒服务启动forkserver时临时设置该变量（见 wake_service.py），forkserver进程预导入本模块时加载模型
+PRELOAD_MODEL_ENV = "VOSK_PRELOAD_MODEL_PATH"
+
+
+def get_shared_model(model_path):
+    """
+    获取共享的Vosk模型，同一进程内只加载一次
+    跨进程共享只发生在forkserver预加载的情况下：从预加载了模型的forkserver中fork出的工作进程直接复用缓存，
+    模型内存以写时复制的方式共享；以spawn方式启动的进程各自加载一份
+    :param model_path: Vosk模型路径
+    :return: Model对象
+    """
+    with _model_lock:
+        model = _model_cache.get(model_path)
+        if model is None:
+            from vosk import Model
+            start_time = time.perf_counter()
+            model = Model(model_path)
+            _model_cache[model_path] = model
+            print(f"Vosk模型已加载: {model_path} ({(time.perf_counter() - start_time) * 1000:.0f} 毫秒)")
+        return model
+
+
+class ASRResult:
+    """
+    一个后端的最终识别结果
+    """
+    def __init__(self, text, source, confidence=1.0, latency=None, final=True):
+        """
+        :param text: 识别文本
+        :param source: 结果来源（后端名称）
+        :param confidence: 置信度 0~1
+        :param latency: 录音结束到拿到结果的耗时（秒）
+        :param final: 是否为后端确认的最终结果（云端超时时用实时结果兜底，final为False）
+        """
+        self.text = text
+        self.source = source
+        self.confidence = confidence
+        self.latency = latency
+        self.final = final
+
+
+class ASRBackend(abc.ABC):
+    """
+    识别后端接口：start -> feed* -> finish -> wait_final -> close
+    子类通过 deliver/fail 提交结果
+    """
+    name = "base"
+
+    def __init__(self):
+        self.result = None  # ASRResult
+        self.error = None  # 失败原因
+        self.finish_time = None  # 录音结束时刻
+        self.on_done = None  # 结果或失败时的回调，由HybridRecognizer设置
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def start(self):
+        """
+        开始一轮识别
+        """
+
+    @abc.abstractmethod
+    def feed(self, audio):
+        """
+        送入一帧16kHz单声道16位PCM音频
+        """
+
+    def finish(self):
+        """
+        音频输入结束
+        """
+        if self.finish_time is None:
+            self.finish_time = time.perf_counter()
+
+    def deliver(self, text, confidence=1.0):
+        """
+        提交最终识别结果，只有第一次提交有效
+        """
+        if self.done:
+            return
+        latency = time.perf_counter() - self.finish_time if self.finish_time is not None else None
+        self.result = ASRResult(text, self.name, confidence, latency)
+        self._set_done()
+
+    def fail(self, reason):
+        """
+        标记识别失败
+        """
+        if self.done:
+            return
+        self.error = reason
+        self._set_done()
+
+    def _set_done(self):
+        self._done.set()
+        if self.on_done:
+            self.on_done(self)
+
+    def wait_final(self, timeout=None):
+        """
+        等待最终结果
+        :return: ASRResult，超时或失败时返回None
+        """
+        self._done.wait(timeout)
+        return self.result
+
+    def close(self):
+        """
+        释放资源
+        """
+
+
+class IflytekASRBackend(ASRBackend):
+    """
+    讯飞云端听写后端：音频通过AudioSender上行，结果由WebSocket消息回调提交
+    """
+    name = "cloud"
+
+    def __init__(self, sender, partial_getter=None):
+        """
+        :param sender: AudioSender对象
+        :param partial_getter: 获取当前实时识别文本的函数，云端没有返回最终结果时兜底
+        """
+        super().__init__()
+        self.sender = sender
+        self.partial_getter = partial_getter
+
+    def feed(self, audio):
+        self.sender.send_audio(STATUS_CONTINUE_FRAME if self.sender.started else STATUS_FIRST_FRAME, audio)
+
+    def finish(self):
+        # 先记录结束时刻，延迟预算从用户停止说话开始计算
+        super().finish()
+        self.sender.finish()
+
+    def partial_result(self):
+        """
+        用当前实时识别文本生成非最终结果
+        """
+        text = self.partial_getter() if self.partial_getter else ""
+        return ASRResult(text, self.name, final=False)
+
+
+class VoskASRBackend(ASRBackend):
+    """
+    Vosk离线识别后端：在独立线程中识别，不阻塞录音线程
+    """
+    name = "offline"
+
+    def __init__(self, model_path, rate=16000):
+        """
+        :param model_path: Vosk模型路径
+        :param rate: 采样率
+        """
+        super().__init__()
+        self.model = get_shared_model(model_path)
+        self.rate = rate
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="asr-offline", daemon=True)
+        self._thread.start()
+
+    def feed(self, audio):
+        self._queue.put(audio)
+
+    def finish(self):
+        super().finish()
+        self._queue.put(None)
+
+    def _run(self):
+        """
+        识别线程：逐帧送入识别器，收到结束标记后输出最终结果
+        """
+        from vosk import KaldiRecognizer
+        try:
+            recognizer = KaldiRecognizer(self.model, self.rate)
+            recognizer.SetWords(True)  # 输出逐字置信度
+            sentences = []
+            while True:
+                audio = self._queue.get()
+                if audio is None:
+                    sentences.append(json.loads(recognizer.FinalResult()))
+                    break
+                if recognizer.AcceptWaveform(audio):
+                    sentences.append(json.loads(recognizer.Result()))
+            text, confidence = self._combine(sentences)
+            self.deliver(text, confidence)
+        except Exception as e:
+            self.fail(f"离线识别出错: {e}")
+
+    @staticmethod
+    def _combine(sentences):
+        """
+        合并各句识别结果
+        :return: (文本, 平均逐字置信度)
+        """
+        # 中文模型输出的词之间带空格
+        text = "".join(s.get("text", "").replace(" ", "") for s in sentences)
+        confs = [w.get("conf", 0.0) for s in sentences for w in s.get("result", [])]
+        confidence = sum(confs) / len(confs) if confs else 0.0
+        return text, confidence
+
+    def close(self):
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=2)
+
+
+class HybridRecognizer:
+    """
+    云端 + 离线并行识别，录音结束后选出最终结果
+    """
+    def __init__(self, primary, fallback=None, mode=None, cloud_budget=None, min_confidence=None):
+        """
+        :param primary: 云端后端
+        :param fallback: 离线后端，None表示只使用云端
+        :param mode: off / fallback / race
+        :param cloud_budget: 等待云端最终结果的延迟预算（秒）
+        :param min_confidence: race模式下直接采用离线结果的最低置信度
+        """
+        settings = get_settings()
+        self.primary = primary
+        self.fallback = fallback
+        self.mode = mode or settings.asr_fallback_mode
+        if fallback is None:
+            self.mode = "off"
+        if cloud_budget is None:
+            cloud_budget = settings.asr_cloud_budget_ms / 1000
+        self.cloud_budget = cloud_budget
+        if min_confidence is None:
+            min_confidence = settings.asr_offline_min_confidence
+        self.min_confidence = min_confidence
+        self.chosen = None  # 最终采用的ASRResult
+
+        self._changed = threading.Event()
+        for backend in self.backends:
+            backend.on_done = lambda backend: self._changed.set()
+            backend.start()
+
+    @property
+    def backends(self):
+        return [b for b in (self.primary, self.fallback) if b is not None]
+
+    def feed(self, audio):
+        """
+        将一帧音频同时送入所有后端
+        """
+        for backend in self.backends:
+            backend.feed(audio)
+
+    def finish_and_resolve(self):
+        """
+        结束音频输入并选出最终识别结果
+        :return: ASRResult
+        """
+        record_mark(MARK_SPEECH_END)
+        # 离线后端先结束（只放入结束标记），云端后端会等待发送队列清空
+        for backend in reversed(self.backends):
+            backend.finish()
+        self.chosen = self._resolve()
+        record_mark(MARK_ASR_RESULT, self.chosen.source)
+        return self.chosen
+
+    def _resolve(self):
+        if self.mode == "off":
+            # 与原有行为一致：最后一帧发出后最多等待0.2秒
+            result = self.primary.wait_final(0.2)
+            return result if result is not None else self.primary.partial_result()
+
+        deadline = self.primary.finish_time + self.cloud_budget
+        while True:
+            cloud = self.primary.result
+            if cloud is not None and cloud.text.strip():
+                return cloud
+            offline = self.fallback.result
+            if (self.mode == "race" and offline is not None and offline.text.strip()
+                    and offline.confidence >= self.min_confidence):
+                return offline
+            remaining = deadline - time.perf_counter()
+            # 云端已结束（出错或结果为空）或超出预算时改用离线结果
+            if self.primary.done or remaining <= 0:
+                break
+            # 任一后端有结果时醒来重新检查
+            self._changed.wait(remaining)
+            self._changed.clear()
+
+        if self.primary.error:
+            print(f"云端识别失败: {self.primary.error}，使用离线识别结果")
+        elif not self.primary.done:
+            print(f"云端识别超过 {self.cloud_budget * 1000:.0f} 毫秒未返回，使用离线识别结果")
+
+        # 离线识别通常已完成，最多再等待一个预算
+        offline = self.fallback.wait_final(self.cloud_budget)
+        if offline is not None and offline.text.strip():
+            return offline
+        return self.primary.partial_result()
+
+    def close(self):
+        """
+        释放所有后端
+        """
+        for backend in self.backends:
+            backend.close()
+
+    def report(self):
+        """
+        生成一行识别结果摘要
+        """
+        parts = []
+        for backend in self.backends:
+            result = backend.result
+            if result is not None and result.latency is not None:
+                parts.append(f"{backend.name} {result.latency * 1000:.0f} 毫秒")
+            elif backend.error:
+                parts.append(f"{backend.name} 失败")
+            else:
+                parts.append(f"{backend.name} 未返回")
+        source = self.chosen.source if self.chosen else "无"
+        return f"识别统计: 采用 {source} 结果, " + ", ".join(parts)
+
+
+_offline_unavailable = False
+
+
+def offline_model_path():
+    """
+    离线识别模型路径，默认与唤醒词共用同一个模型
+    """
+    return os.getenv("ASR_OFFLINE_MODEL_PATH") or get_settings().vosk_model_path
+
+
+def preload_offline_model():
+    """
+    预加载离线识别模型（已加载时直接返回）
+    :return: 离线识别是否可用
+    """
+    global _offline_unavailable
+    if _offline_unavailable or get_settings().asr_fallback_mode == "off":
+        return False
+    try:
+        get_shared_model(offline_model_path())
+        return True
+    except Exception as e:
+        _offline_unavailable = True
+        print(f"离线识别不可用，只使用云端识别: {e}")
+        return False
+
+
+def create_offline_backend():
+    """
+    创建离线识别后端，vosk或模型不可用时返回None（只提示一次）
+    """
+    global _offline_unavailable
+    if _offline_unavailable or get_settings().asr_fallback_mode == "off":
+        return None
+    try:
+        return VoskASRBackend(offline_model_path())
+    except Exception as e:
+        _offline_unavailable = True
+        print(f"离线识别不可用，只使用云端识别: {e}")
+        return None
+
+
+def create_recognizer(sender, partial_getter=None):
+    """
+    创建一轮对话使用的识别器
+    :param sender: 云端上行的AudioSender对象
+    :param partial_getter: 获取云端实时识别文本的函数
+    :return: HybridRecognizer对象
+    """
+    return HybridRecognizer(IflytekASRBackend(sender, partial_getter), create_offline_backend())
+
+
+# forkserver预加载：在forkserver进程中加载模型，之后从它fork出的唤醒工作进程共享这份模型
+if os.environ.get(PRELOAD_MODEL_ENV):
+    try:
+        get_shared_model(os.environ[PRELOAD_MODEL_ENV])
+    except Exception as e:
+        # 预加载失败时工作进程各自加载，不影响forkserver启动
+        print(f"预加载Vosk模型失败: {e}")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 识别后端回放对比：用录制好的音频比较云端听写和Vosk离线识别的延迟与一致性
+#
+# 录音目录: <录音目录>/*.wav，16kHz、单声道、16位PCM
+# 可选: 同名 .txt 文件写入参考文本，用于计算字错误率
+#
+# 统计内容:
+#   - 各后端录音结束到拿到最终结果的延迟（平均 / P50 / P90）
+#   - 云端与离线结果的一致率和字差异率
+#   - 有参考文本时各后端和最终采用结果的字错误率
+#   - 按当前 ASR_FALLBACK_MODE / ASR_CLOUD_BUDGET_MS 策略最终采用的来源
+#
+# 用法:
+#   python asr_replay.py ./asr_corpus              # 只回放离线识别
+#   python asr_replay.py ./asr_corpus --cloud      # 同时连接讯飞云端（需要.env中的API密钥）
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import wave
+
+from startup import load_config
+from asr_backends import (HybridRecognizer, IflytekASRBackend, VoskASRBackend,
+                          offline_model_path)
+
+CHUNK = 1280  # 与录音线程一致的帧大小（采样点数）
+RATE = 16000
+PUNCTUATION = set("，。！？、；：,.!?;: ")
+
+
+def load_wav(path):
+    """
+    读取WAV文件
+    :param path: 文件路径
+    :return: PCM字节数据
+    """
+    with wave.open(path, "rb") as wav:
+        if wav.getframerate() != RATE or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise ValueError(f"{path} 不是16kHz单声道16位PCM音频")
+        return wav.readframes(wav.getnframes())
+
+
+def load_reference(path):
+    """
+    读取参考文本
+    :return: 参考文本，没有时返回None
+    """
+    ref_path = os.path.splitext(path)[0] + ".txt"
+    if not os.path.exists(ref_path):
+        return None
+    with open(ref_path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def normalize(text):
+    """
+    去掉标点和空格后比较
+    """
+    return "".join(c for c in text if c not in PUNCTUATION)
+
+
+def char_error_rate(reference, hypothesis):
+    """
+    字错误率（编辑距离 / 参考文本长度）
+    """
+    ref, hyp = normalize(reference), normalize(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        current = [i]
+        for j, h in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def open_cloud_backend():
+    """
+    建立讯飞听写连接并返回云端后端
+    回放时不开启动态修正(wpgs)，结果按顺序追加
+    """
+    import websocket
+    from audio_uplink import AudioSender
+    from xf_auth import get_signer
+
+    url = get_signer(os.getenv("API_KEY"), os.getenv("API_SECRET"), os.getenv("ASR_BASE_URL")).sign()
+    ws = websocket.create_connection(url)
+    business = {"domain": "iat", "language": "zh_cn", "accent": "mandarin", "vad_eos": 5000}
+    sender = AudioSender(ws, {"app_id": os.getenv("APPID")}, business)
+    backend = IflytekASRBackend(sender)
+
+    def receive():
+        parts = []
+        try:
+            while True:
+                message = json.loads(ws.recv())
+                if message.get("code", 0) != 0:
+                    backend.fail(f"错误码 {message.get('code')}: {message.get('message')}")
+                    return
+                data = message.get("data") or {}
+                for item in (data.get("result") or {}).get("ws", []):
+                    parts.extend(w.get("w", "") for w in item.get("cw", []))
+                if data.get("status") == 2:
+                    backend.deliver("".join(parts))
+                    return
+        except Exception as e:
+            backend.fail(str(e))
+        finally:
+            sender.close()
+            ws.close()
+
+    threading.Thread(target=receive, name="asr-replay-recv", daemon=True).start()
+    return backend
+
+
+def replay_file(pcm, use_cloud, speed):
+    """
+    按录音节奏回放一段音频
+    :param pcm: PCM字节数据
+    :param use_cloud: 是否同时使用云端识别
+    :param speed: 回放倍速（云端接口要求接近实时）
+    :return: (HybridRecognizer, 最终采用的ASRResult)
+    """
+    offline = VoskASRBackend(offline_model_path())
+    if use_cloud:
+        recognizer = HybridRecognizer(open_cloud_backend(), offline)
+    else:
+        # 没有云端时只运行离线后端，直接等待其结果
+        recognizer = HybridRecognizer(offline, None)
+
+    frame_bytes = CHUNK * 2
+    interval = CHUNK / RATE / speed
+    next_time = time.perf_counter()
+    for offset in range(0, len(pcm), frame_bytes):
+        recognizer.feed(pcm[offset:offset + frame_bytes])
+        next_time += interval
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+
+    if use_cloud:
+        chosen = recognizer.finish_and_resolve()
+        # 为了统计两边的延迟，等待较慢的一方也返回
+        for backend in recognizer.backends:
+            backend.wait_final(10)
+    else:
+        offline.finish()
+        chosen = offline.wait_final(30)
+        recognizer.chosen = chosen
+    recognizer.close()
+    return recognizer, chosen
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="识别后端回放对比")
+    parser.add_argument("corpus", help="录音目录")
+    parser.add_argument("--cloud", action="store_true", help="同时连接讯飞云端识别")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，使用云端时建议保持1.0")
+    args = parser.parse_args()
+
+    load_config()
+    files = sorted(glob.glob(os.path.join(args.corpus, "*.wav")))
+    if not files:
+        print(f"{args.corpus} 中没有WAV文件")
+        return
+
+    latencies = {"cloud": [], "offline": []}
+    errors = {"cloud": [], "offline": [], "chosen": []}
+    agreements = []
+    differences = []
+    sources = {}
+
+    for path in files:
+        pcm = load_wav(path)
+        reference = load_reference(path)
+        recognizer, chosen = replay_file(pcm, args.cloud, args.speed)
+
+        texts = {}
+        for backend in recognizer.backends:
+            result = backend.result
+            if result is None:
+                print(f"  {backend.name}: 失败 {backend.error or '超时'}")
+                continue
+            texts[backend.name] = result.text
+            latencies[backend.name].append(result.latency * 1000)
+            if reference is not None:
+                errors[backend.name].append(char_error_rate(reference, result.text))
+
+        source = chosen.source if chosen else "无"
+        sources[source] = sources.get(source, 0) + 1
+        if reference is not None and chosen is not None:
+            errors["chosen"].append(char_error_rate(reference, chosen.text))
+        if "cloud" in texts and "offline" in texts:
+            agreements.append(normalize(texts["cloud"]) == normalize(texts["offline"]))
+            differences.append(char_error_rate(texts["cloud"], texts["offline"]))
+
+        print(f"{os.path.basename(path)}: " + ", ".join(f"{name}='{text}'" for name, text in texts.items())
+              + f", 采用 {source}")
+
+    print(f"==== {len(files)} 条录音 ====")
+    for name, values in latencies.items():
+        if values:
+            print(f"{name} 延迟: 平均 {sum(values) / len(values):.0f} 毫秒, P50 {percentile(values, 0.5):.0f} 毫秒, "
+                  f"P90 {percentile(values, 0.9):.0f} 毫秒")
+    if agreements:
+        print(f"云端与离线一致率: {sum(agreements) / len(agreements) * 100:.1f}%, "
+              f"平均字差异率: {sum(differences) / len(differences) * 100:.1f}%")
+    for name, values in errors.items():
+        if values:
+            print(f"{name} 字错误率: {sum(values) / len(values) * 100:.1f}%")
+    print("最终采用来源: " + ", ".join(f"{name} {count} 条" for name, count in sources.items()))
+
+
+if __name__ == "__main__":
+    main()
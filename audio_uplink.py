@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ASR音频上行模块：将麦克风采集与WebSocket发送解耦
+# 采集线程只负责读麦克风并放入有界队列，独立的发送线程从队列取出并发送；
+# 网络变慢时按策略丢弃或合并积压的音频帧，避免阻塞麦克风读取导致溢出
+#
+# 环境变量:
+#   ASR_SEND_QUEUE_FRAMES: 发送队列最多缓存的帧数，默认25（约1秒音频）
+#   ASR_SEND_POLICY: 队列满时的策略
+#       drop_oldest - 丢弃最早的中间帧（默认）
+#       drop_newest - 丢弃新采集的帧
+#       coalesce    - 合并积压的中间帧，合并后仍超过上限时丢弃最早的帧
+#   ASR_FRAME_AGGREGATION: 发送时的多帧聚合模式
+#       off      - 每个采集块单独发送
+#       adaptive - 链路正常时单独发送以保证低延迟，队列积压达到阈值时合并为一条消息（默认）
+#       always   - 总是合并队列中已有的帧
+#   ASR_AGGREGATE_THRESHOLD: adaptive模式下开始合并的队列深度，默认3
+#   ASR_MAX_FRAME_BYTES: 单条消息的最大音频字节数，默认7680
+#   ASR_UPLINK_CODEC: 上行音频编码（raw/speex-wb/lame），见 uplink_codec.py
+#
+# 慢速链路模拟: python audio_uplink.py
+# 本地替身服务器基准测试: python uplink_bench.py
+
+import base64
+import threading
+import time
+from collections import deque
+
+from settings import get_settings
+from uplink_codec import create_uplink_codec, AUDIO_FORMAT
+from json_codec import loads, dumps
+
+# 帧状态，与ASR.py保持一致
+STATUS_FIRST_FRAME = 0  # 第一帧的标识
+STATUS_CONTINUE_FRAME = 1  # 中间帧标识
+STATUS_LAST_FRAME = 2  # 最后帧的标识
+
+
+class AudioSender:
+    """
+    有界队列 + 独立发送线程的音频上行发送器
+    """
+    def __init__(self, ws, common_args, business_args, max_frames=None, policy=None,
+                 audio_format=AUDIO_FORMAT, codec=None, aggregation=None):
+        """
+        :param ws: WebSocket对象（需要提供send方法）
+        :param common_args: 公共参数，随第一帧发送
+        :param business_args: 业务参数，随第一帧发送
+        :param max_frames: 队列最多缓存的帧数
+        :param policy: 队列满时的策略
+        :param audio_format: 音频格式
+        :param codec: 上行编码器，None时按 ASR_UPLINK_CODEC 为本次会话创建
+        :param aggregation: 多帧聚合模式
+        """
+        settings = get_settings()
+        self.ws = ws
+        self.common_args = common_args
+        self.business_args = business_args
+        self.max_frames = max_frames or settings.asr_send_queue_frames
+        self.policy = (policy or settings.asr_send_policy).strip().lower()
+        self.audio_format = audio_format
+        # 编码器状态属于本次会话，帧在入队前按顺序编码
+        self.codec = codec or create_uplink_codec()
+        self.encoding = self.codec.encoding
+        self.aggregation = (aggregation or settings.asr_frame_aggregation).strip().lower()
+        self.aggregate_threshold = settings.asr_aggregate_threshold
+        self.max_frame_bytes = settings.asr_max_frame_bytes
+        self.started = False  # 是否已发送第一帧
+
+        self._queue = deque()  # [状态, 音频, 入队时刻]
+        self._cond = threading.Condition()
+        self._closed = False
+        self._sending = False
+
+        # 统计计数
+        self.counters = {
+            "enqueued": 0,  # 入队帧数
+            "sent": 0,  # 发送消息数
+            "dropped": 0,  # 丢弃帧数
+            "coalesced": 0,  # 队列满时被合并的帧数
+            "batched": 0,  # 发送时被聚合的帧数
+            "sent_bytes": 0,  # 发送的消息字节数
+            "capture_overflows": 0,  # 麦克风溢出次数
+            "capture_errors": 0,  # 麦克风读取错误次数
+            "send_errors": 0,  # 发送失败次数
+            "max_queue_depth": 0  # 最大队列深度
+        }
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="asr-sender", daemon=True)
+        self._thread.start()
+
+    def send_audio(self, status, audio):
+        """
+        将一帧音频放入发送队列（不阻塞）
+        :param status: 帧状态
+        :param audio: 音频数据
+        """
+        if status == STATUS_FIRST_FRAME:
+            self.started = True
+        audio = self.codec.encode(audio) if audio else b""
+        if status == STATUS_LAST_FRAME:
+            audio += self.codec.flush()
+        elif status == STATUS_CONTINUE_FRAME and not audio:
+            return  # 不足一个压缩帧，等下一块音频
+        item = [status, audio, time.perf_counter()]
+        with self._cond:
+            self.counters["enqueued"] += 1
+            if status == STATUS_CONTINUE_FRAME and len(self._queue) >= self.max_frames:
+                self._on_full(item)
+            else:
+                self._queue.append(item)
+            depth = len(self._queue)
+            if depth > self.counters["max_queue_depth"]:
+                self.counters["max_queue_depth"] = depth
+            self._cond.notify()
+
+    def _on_full(self, item):
+        """
+        队列已满时按策略处理新帧（调用方需持有锁）
+        """
+        if self.policy == "drop_newest":
+            self.counters["dropped"] += 1
+            return
+
+        if self.policy == "coalesce" and self._coalesce():
+            self._queue.append(item)
+            return
+
+        # drop_oldest：丢弃最早的中间帧，第一帧和最后一帧不丢弃
+        for index, queued in enumerate(self._queue):
+            if queued[0] == STATUS_CONTINUE_FRAME:
+                del self._queue[index]
+                self.counters["dropped"] += 1
+                break
+        self._queue.append(item)
+
+    def _coalesce(self):
+        """
+        合并队列中最早的两个相邻中间帧（调用方需持有锁）
+        :return: 是否合并成功
+        """
+        for index in range(len(self._queue) - 1):
+            first, second = self._queue[index], self._queue[index + 1]
+            if (first[0] == STATUS_CONTINUE_FRAME and second[0] == STATUS_CONTINUE_FRAME
+                    and len(first[1]) + len(second[1]) <= self.max_frame_bytes):
+                first[1] = first[1] + second[1]
+                del self._queue[index + 1]
+                self.counters["coalesced"] += 1
+                return True
+        return False
+
+    def _should_aggregate(self):
+        """
+        判断本次发送是否合并多帧（调用方需持有锁）
+        """
+        if self.aggregation == "always":
+            return True
+        if self.aggregation == "adaptive":
+            # 取出当前帧后队列中仍积压的帧数达到阈值，说明链路跟不上
+            return len(self._queue) + 1 >= self.aggregate_threshold
+        return False
+
+    def _aggregate(self, audio):
+        """
+        将队列头部连续的中间帧合并到当前帧（调用方需持有锁）
+        :param audio: 当前帧音频
+        :return: 合并后的音频
+        """
+        parts = [audio]
+        size = len(audio)
+        while (self._queue and self._queue[0][0] == STATUS_CONTINUE_FRAME
+               and size + len(self._queue[0][1]) <= self.max_frame_bytes):
+            chunk = self._queue.popleft()[1]
+            parts.append(chunk)
+            size += len(chunk)
+            self.counters["batched"] += 1
+        return b"".join(parts) if len(parts) > 1 else audio
+
+    def record_overflow(self):
+        """
+        记录一次麦克风输入溢出（可能在采集回调线程中调用）
+        """
+        with self._cond:
+            self.counters["capture_overflows"] += 1
+
+    def record_capture_error(self):
+        """
+        记录一次麦克风读取错误
+        """
+        with self._cond:
+            self.counters["capture_errors"] += 1
+
+    def _build_message(self, status, audio):
+        """
+        构建发送给讯飞的JSON消息
+        """
+        d = {
+            "data": {
+                "status": status,
+                "format": self.audio_format,
+                "audio": base64.b64encode(audio).decode(),
+                "encoding": self.encoding
+            }
+        }
+        # 第一帧发送业务和公共参数
+        if status == STATUS_FIRST_FRAME:
+            d["common"] = self.common_args
+            d["business"] = self.business_args
+        return dumps(d)
+
+    def _run(self):
+        """
+        发送线程：从队列取出音频帧并发送
+        """
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                status, audio, enqueued_at = self._queue.popleft()
+                if status == STATUS_CONTINUE_FRAME and self._should_aggregate():
+                    audio = self._aggregate(audio)
+                self._sending = True
+
+            try:
+                message = self._build_message(status, audio)
+                self.ws.send(message)
+                latency = time.perf_counter() - enqueued_at
+                with self._cond:
+                    self.counters["sent_bytes"] += len(message)
+                    self.counters["sent"] += 1
+                    self._latency_total += latency
+                    if latency > self._latency_max:
+                        self._latency_max = latency
+            except Exception as e:
+                with self._cond:
+                    self.counters["send_errors"] += 1
+                    first_error = self.counters["send_errors"] == 1
+                if first_error:
+                    print(f"发送音频帧失败: {e}")
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def finish(self, timeout=2.0):
+        """
+        发送最后一帧并等待队列发送完毕
+        :param timeout: 最长等待时间（秒）
+        :return: 是否在超时前发送完毕
+        """
+        self.send_audio(STATUS_LAST_FRAME, b"")
+        return self.flush(timeout)
+
+    def flush(self, timeout=2.0):
+        """
+        等待队列中的帧全部发送
+        :return: 是否在超时前发送完毕
+        """
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            while self._queue or self._sending:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        """
+        停止发送线程，丢弃未发送的帧
+        """
+        with self._cond:
+            self.counters["dropped"] += sum(1 for item in self._queue if item[0] == STATUS_CONTINUE_FRAME)
+            self._queue.clear()
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=2)
+        self.codec.close()
+
+    def stats(self):
+        """
+        获取统计计数
+        :return: 计数字典，包含当前队列深度和发送延迟
+        """
+        with self._cond:
+            stats = dict(self.counters)
+            stats["queue_depth"] = len(self._queue)
+            latency_total, latency_max = self._latency_total, self._latency_max
+        sent = stats["sent"]
+        stats["send_latency_avg_ms"] = latency_total / sent * 1000 if sent else 0.0
+        stats["send_latency_max_ms"] = latency_max * 1000
+        stats["encode_cpu_ms"] = self.codec.cpu_time * 1000
+        return stats
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        s = self.stats()
+        return (f"上行统计: 入队 {s['enqueued']} 帧, 发送 {s['sent']} 条, 丢弃 {s['dropped']} 帧, "
+                f"合并 {s['coalesced']} 帧, 聚合 {s['batched']} 帧, 上行 {s['sent_bytes']} 字节, 最大队列深度 {s['max_queue_depth']}, "
+                f"麦克风溢出 {s['capture_overflows']} 次, 发送延迟 平均 {s['send_latency_avg_ms']:.1f} 毫秒 / "
+                f"最大 {s['send_latency_max_ms']:.1f} 毫秒, 编码 {self.encoding}（CPU {s['encode_cpu_ms']:.1f} 毫秒）")
+
+
+# 测试代码：模拟慢速链路
+if __name__ == "__main__":
+    import random
+
+    class SlowLink:
+        """
+        模拟慢速链路：每次发送耗时随机，期间会出现一段网络卡顿
+        """
+        def __init__(self, base_delay, stall_at, stall_time):
+            self.base_delay = base_delay
+            self.stall_at = stall_at
+            self.stall_time = stall_time
+            self.messages = []
+            self.bytes = 0
+
+        def send(self, message):
+            if len(self.messages) == self.stall_at:
+                time.sleep(self.stall_time)
+            time.sleep(self.base_delay * random.uniform(0.5, 1.5))
+            self.messages.append(loads(message)["data"]["status"])
+            self.bytes += len(message)
+
+    random.seed(0)
+    frame_interval = 0.01  # 加速4倍的40毫秒帧间隔
+    frames = 150
+    chunk = b"\x01\x00" * 640
+
+    for policy in ("drop_oldest", "drop_newest", "coalesce"):
+        link = SlowLink(base_delay=0.012, stall_at=30, stall_time=0.5)
+        sender = AudioSender(link, {"app_id": "test"}, {"domain": "iat"}, max_frames=10, policy=policy)
+
+        capture_lag = 0.0
+        next_time = time.perf_counter()
+        for i in range(frames):
+            # 采集线程按固定节奏产生帧，send_audio 不应阻塞采集
+            start = time.perf_counter()
+            sender.send_audio(STATUS_FIRST_FRAME if i == 0 else STATUS_CONTINUE_FRAME, chunk)
+            capture_lag = max(capture_lag, time.perf_counter() - start)
+            next_time += frame_interval
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+        sender.finish(timeout=10)
+        sender.close()
+
+        assert link.messages[0] == STATUS_FIRST_FRAME and link.messages[-1] == STATUS_LAST_FRAME
+        print(f"[{policy}] 采集线程最长阻塞 {capture_lag * 1000:.2f} 毫秒, 上行 {link.bytes} 字节")
+        print(f"[{policy}] {sender.report()}")
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 关键词/命令匹配模块：基于Aho-Corasick自动机的多关键词匹配
+# 用于停止关键词、唤醒词以及无需调用大模型的本地命令（音量、停止、重复等）
+#
+# 匹配规则:
+#   - 停止类意图优先：句子中任何位置出现停止关键词都按停止处理（"大声点……再见" 结束对话）
+#   - 其他本地命令必须（几乎）是整句话，只允许前后有"请""一下""吧"等语气词，
+#     "大声点读一下这首诗" 这样的句子仍交给大模型
+#
+# 用法示例:
+#   matcher = load_command_matcher()
+#   intent, phrase = matcher.match("声音大一点")   # -> ("volume_up", "声音大一点")
+
+import os
+from collections import deque
+
+# 本地命令意图
+INTENT_STOP = "stop"  # 结束对话
+INTENT_VOLUME_UP = "volume_up"  # 调大音量
+INTENT_VOLUME_DOWN = "volume_down"  # 调小音量
+INTENT_REPEAT = "repeat"  # 重复上一次回复
+
+# 优先处理的意图，句子中任何位置出现即匹配，按顺序优先
+PRIORITY_INTENTS = (INTENT_STOP,)
+
+# 整句匹配时命令短语前后允许出现的礼貌用语和语气词
+FILLER_WORDS = ("麻烦", "帮我", "一下", "请", "你", "吧", "啊", "呀", "呢", "嘛", "了", "哦")
+
+# 整句匹配前去掉的标点和空白
+_PUNCTUATION = set(" \t\r\n,.!?;:'\"，。！？；：、…“”‘’（）()~～")
+
+# 默认停止关键词
+DEFAULT_STOP_KEYWORDS = ["停止", "退出", "结束程序", "关闭", "拜拜", "再见"]
+
+# 默认本地命令，格式: 意图:短语1|短语2;意图:短语...
+DEFAULT_LOCAL_COMMANDS = (
+    "volume_up:大声点|大声一点|声音大一点|音量调大|调大音量;"
+    "volume_down:小声点|小声一点|声音小一点|音量调小|调小音量;"
+    "repeat:再说一遍|重复一遍|再说一次|没听清"
+)
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick多关键词匹配器
+    一次扫描即可找出文本中出现的所有关键词，复杂度与关键词数量无关
+    """
+    def __init__(self, keywords, ignore_case=True):
+        """
+        编译关键词自动机
+        :param keywords: 关键词列表
+        :param ignore_case: 是否忽略大小写
+        """
+        self.ignore_case = ignore_case
+        # 去重并去掉空关键词，保持原有顺序
+        self.keywords = []
+        for keyword in keywords:
+            keyword = keyword.strip()
+            if keyword and keyword not in self.keywords:
+                self.keywords.append(keyword)
+
+        # 状态转移表、失败指针和每个状态的输出（关键词下标）
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for index, keyword in enumerate(self.keywords):
+            self._add(self._normalize(keyword), index)
+        self._build()
+
+    def _normalize(self, text):
+        return text.lower() if self.ignore_case else text
+
+    def _add(self, keyword, index):
+        """
+        将关键词插入字典树
+        """
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = self._output[state] + (index,)
+
+    def _build(self):
+        """
+        广度优先计算失败指针，并合并后缀状态的输出
+        """
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def step(self, state, char):
+        """
+        自动机单步转移
+        :param state: 当前状态
+        :param char: 输入字符（需已规范化）
+        :return: 新状态
+        """
+        goto = self._goto
+        while True:
+            next_state = goto[state].get(char)
+            if next_state is not None:
+                return next_state
+            if state == 0:
+                return 0
+            state = self._fail[state]
+
+    def find_all(self, text):
+        """
+        查找文本中出现的所有关键词
+        :param text: 待匹配文本
+        :return: [(结束位置, 关键词), ...]，按出现位置排序
+        """
+        matches = []
+        state = 0
+        for pos, char in enumerate(self._normalize(text)):
+            state = self.step(state, char)
+            for index in self._output[state]:
+                matches.append((pos, self.keywords[index]))
+        return matches
+
+    def first(self, text):
+        """
+        查找文本中最先出现的关键词
+        :param text: 待匹配文本
+        :return: 关键词，未找到时返回None
+        """
+        state = 0
+        for char in self._normalize(text):
+            state = self.step(state, char)
+            if self._output[state]:
+                return self.keywords[self._output[state][0]]
+        return None
+
+    def scanner(self):
+        """
+        创建增量扫描器
+        """
+        return IncrementalScanner(self)
+
+
+class IncrementalScanner:
+    """
+    增量扫描器：只扫描新追加或被替换的文本
+    实时识别结果会被不断追加或替换（wpgs的rpl），这里保存每个位置的自动机状态，
+    新文本只需从与上一次文本的公共前缀之后继续扫描
+    """
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.reset()
+
+    def reset(self):
+        """
+        清空扫描状态，开始新的一轮识别时调用
+        """
+        self._text = ""
+        self._states = [0]
+
+    def feed(self, text):
+        """
+        扫描最新的完整文本，返回新出现的关键词
+        :param text: 当前累积的完整文本
+        :return: [(结束位置, 关键词), ...]
+        """
+        text = self.matcher._normalize(text)
+        previous = self._text
+
+        # 计算与上一次文本的公共前缀长度
+        if text.startswith(previous):
+            common = len(previous)
+        else:
+            common = 0
+            limit = min(len(text), len(previous))
+            while common < limit and text[common] == previous[common]:
+                common += 1
+
+        # 回退到公共前缀处的状态
+        del self._states[common + 1:]
+        state = self._states[common]
+
+        matches = []
+        output = self.matcher._output
+        keywords = self.matcher.keywords
+        for pos in range(common, len(text)):
+            state = self.matcher.step(state, text[pos])
+            self._states.append(state)
+            for index in output[state]:
+                matches.append((pos, keywords[index]))
+
+        self._text = text
+        return matches
+
+
+class CommandMatcher:
+    """
+    本地命令匹配器：将短语映射到意图
+    """
+    def __init__(self, commands):
+        """
+        :param commands: {意图: [短语, ...]}
+        """
+        self.phrase_intents = {}
+        for intent, phrases in commands.items():
+            for phrase in phrases:
+                phrase = phrase.strip()
+                if phrase:
+                    self.phrase_intents.setdefault(phrase.lower(), intent)
+        self.matcher = KeywordMatcher(list(self.phrase_intents.keys()))
+
+    def match(self, text):
+        """
+        匹配文本中的命令：停止类意图出现在任何位置都优先返回，其他命令需要是整句话
+        :param text: 识别文本
+        :return: (意图, 短语)，未匹配时返回 (None, None)
+        """
+        if not text:
+            return None, None
+        text = "".join(char for char in text if char not in _PUNCTUATION)
+        matches = self.matcher.find_all(text)
+        for intent in PRIORITY_INTENTS:
+            for _, phrase in matches:
+                if self.phrase_intents[phrase] == intent:
+                    return intent, phrase
+        # 同一位置结束的多个短语中优先取最长的（例如"声音大一点"而不是"大一点"）
+        for end, phrase in sorted(matches, key=lambda item: -len(item[1])):
+            start = end - len(phrase) + 1
+            if _only_fillers(text[:start].lower()) and _only_fillers(text[end + 1:].lower()):
+                return self.phrase_intents[phrase], phrase
+        return None, None
+
+    def scanner(self):
+        """
+        创建增量扫描器，用于实时识别结果
+        """
+        return CommandScanner(self)
+
+
+def _only_fillers(text):
+    """
+    判断文本是否只由语气词组成（可以为空）
+    """
+    while text:
+        for word in FILLER_WORDS:
+            if text.startswith(word):
+                text = text[len(word):]
+                break
+        else:
+            return False
+    return True
+
+
+class CommandScanner:
+    """
+    命令增量扫描器：在IncrementalScanner基础上返回意图
+    """
+    def __init__(self, command_matcher):
+        self.phrase_intents = command_matcher.phrase_intents
+        self._scanner = command_matcher.matcher.scanner()
+
+    def reset(self):
+        """
+        清空扫描状态
+        """
+        self._scanner.reset()
+
+    def feed(self, text):
+        """
+        扫描最新的完整文本，返回新出现的命令
+        :param text: 当前累积的完整文本
+        :return: [(意图, 短语), ...]
+        """
+        return [(self.phrase_intents[phrase], phrase) for _, phrase in self._scanner.feed(text)]
+
+
+def parse_keywords(value, default):
+    """
+    解析逗号分隔的关键词配置
+    """
+    if not value:
+        return list(default)
+    return [word.strip() for word in value.split(",") if word.strip()]
+
+
+def parse_commands(value):
+    """
+    解析本地命令配置，格式: 意图:短语1|短语2;意图:短语...
+    :return: {意图: [短语, ...]}
+    """
+    commands = {}
+    for item in value.split(";"):
+        if ":" not in item:
+            continue
+        intent, phrases = item.split(":", 1)
+        intent = intent.strip()
+        if intent:
+            commands.setdefault(intent, []).extend(p.strip() for p in phrases.split("|") if p.strip())
+    return commands
+
+
+def load_command_matcher():
+    """
+    从环境变量构建命令匹配器
+    STOP_KEYWORDS: 停止关键词，逗号分隔
+    LOCAL_COMMANDS: 本地命令，格式同 DEFAULT_LOCAL_COMMANDS
+    """
+    commands = {INTENT_STOP: parse_keywords(os.getenv("STOP_KEYWORDS"), DEFAULT_STOP_KEYWORDS)}
+    for intent, phrases in parse_commands(os.getenv("LOCAL_COMMANDS", DEFAULT_LOCAL_COMMANDS)).items():
+        commands.setdefault(intent, []).extend(phrases)
+    return CommandMatcher(commands)
+
+
+# 测试代码：几百个短语下的匹配性能对比
+if __name__ == "__main__":
+    import random
+    import time
+
+    random.seed(0)
+    alphabet = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+
+    def random_phrase(min_len=2, max_len=5):
+        return "".join(random.choice(alphabet) for _ in range(random.randint(min_len, max_len)))
+
+    phrases = list({random_phrase() for _ in range(400)})
+    commands = {}
+    for i, phrase in enumerate(phrases):
+        commands.setdefault(f"intent_{i % 20}", []).append(phrase)
+    commands[INTENT_STOP] = list(DEFAULT_STOP_KEYWORDS)
+    matcher = CommandMatcher(commands)
+    print(f"短语数量: {len(matcher.phrase_intents)}, 自动机状态数: {len(matcher.matcher._goto)}")
+
+    # 模拟一轮实时识别：文本不断追加，偶尔替换末尾
+    sentence = "".join(random_phrase(1, 1) for _ in range(120))
+    stream = []
+    text = ""
+    for char in sentence:
+        if random.random() < 0.2 and text:
+            text = text[:-1] + random_phrase(1, 1)
+            stream.append(text)
+        text += char
+        stream.append(text)
+
+    all_phrases = list(matcher.phrase_intents.keys())
+    rounds = 20
+
+    # 原有方式：每条消息对完整文本逐个关键词 in 判断
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in stream:
+            for keyword in all_phrases:
+                if keyword in text:
+                    break
+    naive_time = time.perf_counter() - start
+
+    # 自动机：每条消息扫描完整文本
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in stream:
+            matcher.match(text)
+    full_time = time.perf_counter() - start
+
+    # 增量扫描：只扫描新增部分
+    start = time.perf_counter()
+    for _ in range(rounds):
+        scanner = matcher.scanner()
+        for text in stream:
+            scanner.feed(text)
+    incremental_time = time.perf_counter() - start
+
+    messages = rounds * len(stream)
+    print(f"消息数: {messages}, 平均文本长度: {sum(map(len, stream)) / len(stream):.0f} 字")
+    print(f"逐个关键词 in 判断: {naive_time / messages * 1e6:.1f} 微秒/消息")
+    print(f"Aho-Corasick 全量扫描: {full_time / messages * 1e6:.1f} 微秒/消息")
+    print(f"Aho-Corasick 增量扫描: {incremental_time / messages * 1e6:.1f} 微秒/消息")
+
+    # 正确性校验：增量扫描结果与全量扫描一致
+    scanner = matcher.scanner()
+    for text in stream:
+        scanner.feed(text)
+    fresh = matcher.scanner()
+    fresh.feed(stream[-1])
+    assert fresh._scanner._states == scanner._scanner._states
+    print("增量扫描结果校验通过")
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 事件日志模块：代替热路径上的print（每个实时识别结果、每10个静音帧、每个大模型token等）
+# 事件先缓存在内存中，由后台线程按批写入列式二进制文件，热路径上没有同步的控制台I/O
+#
+# 环境变量:
+#   EVENT_LOG_PATH: 日志文件路径。未设置时为控制台模式，事件直接print（与原有输出一致）
+#   EVENT_LOG_LEVEL: 写入文件的最低级别，默认DEBUG
+#   EVENT_LOG_CONSOLE_LEVEL: 文件模式下仍然同步输出到控制台的最低级别，默认WARNING
+#   EVENT_LOG_SAMPLE: 按事件采样，每N条保留1条，例如 asr.partial=5,spark.token=10
+#   EVENT_LOG_FLUSH_MS: 后台写入间隔，默认1000毫秒
+#
+# 文件格式（小端）: 文件头 b"BEL1"，之后为若干批次，每批:
+#   批次字节数(uint32) + 行数N(uint32)
+#   + 事件名表: 个数(uint16) + [长度(uint16) + UTF-8]...
+#   + 时间戳列 N*double + 级别列 N*uint8 + 事件ID列 N*uint16
+#   + 消息结束偏移列 N*uint32 + 消息UTF-8拼接
+#
+# 查看日志: python event_log.py view logs/events.bel --level INFO --event asr.
+#           python event_log.py stats logs/events.bel
+
+import array
+import os
+import struct
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+MAGIC = b"BEL1"
+BATCH_HEADER = struct.Struct("<II")
+MAX_BUFFERED = 100000  # 内存中最多缓存的事件数，写入跟不上时丢弃并计数
+
+
+def _parse_level(value, default):
+    value = (value or "").strip().upper()
+    for level, name in LEVEL_NAMES.items():
+        if value == name:
+            return level
+    return default
+
+
+def _parse_sampling(value):
+    """
+    解析采样配置
+    :param value: 例如 "asr.partial=5,spark.token=10"
+    :return: {事件名: N}
+    """
+    sampling = {}
+    for item in (value or "").split(","):
+        name, _, n = item.partition("=")
+        if name.strip() and n.strip().isdigit() and int(n) > 1:
+            sampling[name.strip()] = int(n)
+    return sampling
+
+
+class EventLog:
+    """
+    缓冲式列式事件日志
+    """
+    def __init__(self, path=None, level=DEBUG, console_level=WARNING, sampling=None, flush_interval=1.0):
+        """
+        :param path: 日志文件路径，None表示控制台模式
+        :param level: 记录的最低级别
+        :param console_level: 文件模式下同步输出到控制台的最低级别
+        :param sampling: {事件名: N}，每N条保留1条
+        :param flush_interval: 后台写入间隔（秒）
+        """
+        self.path = path
+        self.level = level
+        self.console_level = console_level
+        self.sampling = sampling or {}
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+
+        self._counters = {}
+        self._rows = []  # [(时间戳, 级别, 事件名, 消息), ...]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._file = None
+        self._thread = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+            self._file = open(path, "ab")
+            if is_new:
+                self._file.write(MAGIC)
+            self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+            self._thread.start()
+
+    @property
+    def console_mode(self):
+        return self._file is None
+
+    def log(self, level, event, message, end="\n", console=True):
+        """
+        记录一条事件
+        :param level: 级别
+        :param event: 事件名，例如 asr.partial
+        :param message: 消息文本
+        :param end: 控制台输出的结尾（与print的end参数相同）
+        :param console: 控制台模式下是否输出
+        """
+        if self._file is None:
+            # 控制台模式：保持原有的print输出
+            if console and level >= self.level:
+                print(message, end=end, flush=end != "\n")
+            return
+
+        if level < self.level:
+            return
+        n = self.sampling.get(event)
+        if n:
+            count = self._counters.get(event, 0)
+            self._counters[event] = count + 1
+            if count % n:
+                return
+        if level >= self.console_level:
+            print(message, end=end, flush=end != "\n")
+
+        with self._lock:
+            if len(self._rows) >= MAX_BUFFERED:
+                self.dropped += 1
+                return
+            self._rows.append((time.time(), level, event, message))
+
+    def _run(self):
+        """
+        后台写入线程
+        """
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        把缓存的事件写入文件
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows or self._file is None:
+            return
+        try:
+            self._file.write(encode_batch(rows))
+            self._file.flush()
+            self.written += len(rows)
+        except (OSError, ValueError) as e:
+            self.dropped += len(rows)
+            print(f"写入事件日志失败: {e}", file=sys.stderr)
+
+    def close(self):
+        """
+        写出剩余事件并关闭文件
+        """
+        if self._file is None:
+            return
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self.flush()
+        self._file.close()
+        self._file = None
+
+
+def encode_batch(rows):
+    """
+    把一批事件编码为列式二进制块
+    :param rows: [(时间戳, 级别, 事件名, 消息), ...]
+    :return: 字节
+    """
+    names = {}
+    timestamps = array.array("d")
+    levels = bytearray()
+    event_ids = array.array("H")
+    ends = array.array("I")
+    messages = []
+    offset = 0
+    for timestamp, level, event, message in rows:
+        timestamps.append(timestamp)
+        levels.append(level)
+        event_ids.append(names.setdefault(event, len(names)))
+        encoded = message.encode("utf-8")
+        messages.append(encoded)
+        offset += len(encoded)
+        ends.append(offset)
+
+    table = [struct.pack("<H", len(names))]
+    for name in names:
+        encoded = name.encode("utf-8")
+        table.append(struct.pack("<H", len(encoded)) + encoded)
+
+    if sys.byteorder != "little":
+        for column in (timestamps, event_ids, ends):
+            column.byteswap()
+    body = b"".join(table) + timestamps.tobytes() + bytes(levels) + event_ids.tobytes() + ends.tobytes() + b"".join(messages)
+    return BATCH_HEADER.pack(len(body), len(rows)) + body
+
+
+def read_events(path):
+    """
+    读取日志文件
+    :param path: 日志文件路径
+    :return: 生成器，每项为 (时间戳, 级别, 事件名, 消息)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} 不是事件日志文件")
+        while True:
+            header = f.read(BATCH_HEADER.size)
+            if len(header) < BATCH_HEADER.size:
+                return
+            size, count = BATCH_HEADER.unpack(header)
+            body = f.read(size)
+            # 进程异常退出时最后一批可能不完整
+            if len(body) < size:
+                return
+
+            pos = 0
+            (name_count,) = struct.unpack_from("<H", body, pos)
+            pos += 2
+            names = []
+            for _ in range(name_count):
+                (length,) = struct.unpack_from("<H", body, pos)
+                pos += 2
+                names.append(body[pos:pos + length].decode("utf-8"))
+                pos += length
+
+            def column(typecode, itemsize):
+                nonlocal pos
+                values = array.array(typecode)
+                values.frombytes(body[pos:pos + count * itemsize])
+                if sys.byteorder != "little":
+                    values.byteswap()
+                pos += count * itemsize
+                return values
+
+            timestamps = column("d", 8)
+            levels = body[pos:pos + count]
+            pos += count
+            event_ids = column("H", 2)
+            ends = column("I", 4)
+            blob = body[pos:]
+
+            start = 0
+            for i in range(count):
+                yield timestamps[i], levels[i], names[event_ids[i]], blob[start:ends[i]].decode("utf-8")
+                start = ends[i]
+
+
+_event_log = None
+_event_log_lock = threading.Lock()
+
+
+def get_event_log():
+    """
+    获取进程内共享的事件日志（按配置快照创建）
+    """
+    global _event_log
+    if _event_log is None:
+        with _event_log_lock:
+            if _event_log is None:
+                # settings 导入本模块记录热加载事件，这里在首次使用时再导入
+                from settings import get_settings
+                settings = get_settings()
+                path = settings.event_log_path
+                event_log = EventLog(path,
+                                     level=_parse_level(settings.event_log_level, DEBUG),
+                                     console_level=_parse_level(settings.event_log_console_level, WARNING),
+                                     sampling=_parse_sampling(settings.event_log_sample),
+                                     flush_interval=settings.event_log_flush_ms / 1000)
+                if path:
+                    import atexit
+                    atexit.register(event_log.close)
+                _event_log = event_log
+    return _event_log
+
+
+def log(level, event, message, end="\n", console=True):
+    """
+    记录一条事件（参数见 EventLog.log）
+    """
+    get_event_log().log(level, event, message, end, console)
+
+
+def _view(path, min_level, prefix, tail):
+    rows = [row for row in read_events(path) if row[1] >= min_level and row[2].startswith(prefix)]
+    if tail:
+        rows = rows[-tail:]
+    for timestamp, level, event, message in rows:
+        clock = time.strftime("%H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp * 1000) % 1000:03d}"
+        print(f"{clock} {LEVEL_NAMES.get(level, level):<7} {event:<16} {message}")
+
+
+def _stats(path):
+    counts = {}
+    first = last = None
+    for timestamp, level, event, message in read_events(path):
+        counts[event] = counts.get(event, 0) + 1
+        first = timestamp if first is None else first
+        last = timestamp
+    if first is None:
+        print("没有事件")
+        return
+    print(f"时间范围: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))} ~ "
+          f"{time.strftime('%H:%M:%S', time.localtime(last))}, 共 {sum(counts.values())} 条")
+    for event, count in sorted(counts.items(), key=lambda item: -item[1]):
+        print(f"  {event:<20} {count}")
+
+
+# 查看工具与性能测试
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="事件日志查看工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    view_parser = subparsers.add_parser("view", help="格式化输出事件")
+    view_parser.add_argument("path", help="日志文件路径")
+    view_parser.add_argument("--level", default="DEBUG", help="最低级别")
+    view_parser.add_argument("--event", default="", help="事件名前缀，例如 asr.")
+    view_parser.add_argument("--tail", type=int, default=0, help="只显示最后N条")
+    stats_parser = subparsers.add_parser("stats", help="按事件统计条数")
+    stats_parser.add_argument("path", help="日志文件路径")
+    subparsers.add_parser("bench", help="比较同步print和缓冲写入的热路径耗时")
+    args = parser.parse_args()
+
+    if args.command == "view":
+        _view(args.path, _parse_level(args.level, DEBUG), args.event, args.tail)
+    elif args.command == "stats":
+        _stats(args.path)
+    else:
+        rounds = 20000
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.bel")
+            event_log = EventLog(path)
+            start = time.perf_counter()
+            for i in range(rounds):
+                event_log.log(DEBUG, "asr.partial", f"实时识别片段: 第{i}个结果")
+            buffered = time.perf_counter() - start
+            event_log.close()
+            assert sum(1 for _ in read_events(path)) == rounds
+
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                start = time.perf_counter()
+                for i in range(rounds):
+                    print(f"实时识别片段: 第{i}个结果", flush=True)
+                printed = time.perf_counter() - start
+                sys.stdout = stdout
+        print(f"同步print(到/dev/null): {printed / rounds * 1e6:.2f} 微秒/条")
+        print(f"缓冲写入: {buffered / rounds * 1e6:.2f} 微秒/条, 文件 {os.path.basename(path)} 已校验 {rounds} 条")
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 星火和语音合成的尾延迟保护：对冲请求 + 熔断
+#
+# - 对冲请求: 记录每个连接从建立到收到首个token/首个音频块的延迟，超过近期延迟的分位数（默认P95）仍未收到时，
+#   再发出一个相同的请求，先返回的连接生效，另一个关闭。额外的请求量约为 (100 - 分位数)%
+# - 熔断: 连续失败达到次数后停止向该接口发送请求，直接返回提示；冷却时间后放行一个探测请求，成功则恢复
+#
+# 环境变量:
+#   HEDGE_ENABLED: 是否启用对冲请求，默认关闭（对冲会增加请求量，按需开启）
+#   HEDGE_PERCENTILE: 触发对冲的延迟分位数，默认95
+#   HEDGE_MIN_DELAY_MS / HEDGE_MAX_DELAY_MS: 对冲等待时间的下限和上限（样本不足时使用上限），默认300 / 3000
+#   BREAKER_FAILURES: 连续失败多少次后熔断，默认3
+#   BREAKER_RESET_SECONDS: 熔断后多久放行探测请求，默认30
+#
+# 对抖动的本地替身服务比较P99延迟（需要websocket-client）: python hedging.py
+
+import os
+import threading
+import time
+from collections import deque
+
+from event_log import log, INFO, WARNING
+from settings import get_settings
+
+# 熔断器状态
+CLOSED = "closed"  # 正常
+OPEN = "open"  # 熔断中，拒绝请求
+HALF_OPEN = "half_open"  # 放行了一个探测请求，等待结果
+
+
+class HedgePolicy:
+    """
+    根据首包延迟的分位数决定何时发出对冲请求
+    """
+    def __init__(self, name, enabled=None, percentile=None, min_delay=None, max_delay=None, min_samples=20, window=200):
+        """
+        :param name: 接口名称，例如 spark
+        :param enabled: 是否启用
+        :param percentile: 触发对冲的延迟分位数（0-100）
+        :param min_delay: 对冲等待时间下限（秒）
+        :param max_delay: 对冲等待时间上限（秒），样本不足时使用
+        :param min_samples: 开始使用分位数所需的样本数
+        :param window: 保留最近的样本数
+        """
+        settings = get_settings()
+        self.name = name
+        self.enabled = settings.hedge_enabled if enabled is None else enabled
+        self.percentile = percentile or settings.hedge_percentile
+        self.min_delay = min_delay if min_delay is not None else settings.hedge_min_delay_ms / 1000
+        self.max_delay = max_delay if max_delay is not None else settings.hedge_max_delay_ms / 1000
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=window)
+        self.hedged = 0  # 发出的对冲请求数
+        self.hedge_wins = 0  # 对冲请求先返回的次数
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        记录一个连接的首包延迟
+        :param latency: 延迟（秒）
+        """
+        with self._lock:
+            self.samples.append(latency)
+
+    def latency(self, percentile):
+        """
+        近期首包延迟的分位数
+        :param percentile: 分位数（0-100）
+        :return: 秒，没有样本时返回None
+        """
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def delay(self):
+        """
+        当前的对冲等待时间
+        :return: 秒
+        """
+        if len(self.samples) < self.min_samples:
+            return self.max_delay
+        return max(self.min_delay, min(self.max_delay, self.latency(self.percentile)))
+
+    def on_hedge(self):
+        """
+        发出了一个对冲请求
+        """
+        with self._lock:
+            self.hedged += 1
+        log(INFO, "hedge.fire", f"{self.name} 首包超过 {self.delay() * 1000:.0f} 毫秒未到达，发出对冲请求", console=False)
+
+    def on_win(self, hedge):
+        """
+        对冲后记录哪个请求先返回
+        :param hedge: 是否为对冲请求先返回
+        """
+        if hedge:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        return (f"{self.name} 对冲: 等待 {self.delay() * 1000:.0f} 毫秒（P{self.percentile:.0f}，样本 {len(self.samples)}），"
+                f"对冲 {self.hedged} 次，对冲先返回 {self.hedge_wins} 次")
+
+
+class CircuitBreaker:
+    """
+    连续失败后熔断，冷却后放行探测请求
+    """
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        """
+        :param name: 接口名称
+        :param failure_threshold: 连续失败多少次后熔断
+        :param reset_timeout: 熔断后多久放行探测请求（秒）
+        """
+        settings = get_settings()
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.breaker_failures
+        self.reset_timeout = reset_timeout or settings.breaker_reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def allow(self):
+        """
+        是否允许发出请求；熔断冷却结束后放行一个探测请求
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            # 熔断冷却结束，或上一个探测请求迟迟没有结果时，再放行一个探测请求
+            if ((self.state == OPEN and now - self.opened_at >= self.reset_timeout)
+                    or (self.state == HALF_OPEN and now - self.probe_at >= self.reset_timeout)):
+                self.state = HALF_OPEN
+                self.probe_at = now
+                log(INFO, "breaker.probe", f"{self.name} 熔断冷却结束，发出探测请求", console=False)
+                return True
+            self.rejected += 1
+            return False
+
+    def on_success(self):
+        """
+        请求成功（收到首个token或音频）
+        """
+        with self._lock:
+            if self.state != CLOSED:
+                log(INFO, "breaker.close", f"{self.name} 探测成功，恢复正常")
+            self.state = CLOSED
+            self.failures = 0
+
+    def on_failure(self):
+        """
+        请求失败（连接错误、服务端错误或超时）
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                log(WARNING, "breaker.open",
+                    f"{self.name} 连续失败 {self.failures} 次，暂停请求 {self.reset_timeout:.0f} 秒")
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        return f"{self.name} 熔断: 状态 {self.state}，连续失败 {self.failures} 次，熔断期间拒绝 {self.rejected} 次"
+
+
+_policies = {}
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def get_hedge_policy(name):
+    """
+    获取某个接口的对冲策略（进程内共享，延迟样本在各实例间累积）
+    :param name: spark / tts
+    """
+    with _registry_lock:
+        if name not in _policies:
+            _policies[name] = HedgePolicy(name)
+        return _policies[name]
+
+
+def get_breaker(name):
+    """
+    获取某个接口的熔断器（进程内共享）
+    :param name: spark / tts
+    """
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def hedging_report():
+    """
+    所有接口的对冲和熔断统计摘要
+    :return: 每个接口一行
+    """
+    lines = [policy.report() for policy in list(_policies.values())]
+    lines += [breaker.report() for breaker in list(_breakers.values())]
+    return "\n".join(lines)
+
+
+# 基准测试：替身服务的首包延迟大多在百毫秒级，少量连接卡住数秒，比较关闭和开启对冲时每轮耗时的分位数
+if __name__ == "__main__":
+    import argparse
+    import importlib.util
+    import random
+    import sys
+
+    from xf_standin import StandInServer, spark_handler, tts_handler
+
+    parser = argparse.ArgumentParser(description="对冲请求基准测试")
+    parser.add_argument("--turns", type=int, default=60, help="每种模式的请求数")
+    parser.add_argument("--warmup", type=int, default=20, help="预热请求数（积累延迟样本）")
+    parser.add_argument("--stall-rate", type=float, default=0.04, help="卡住的连接比例")
+    parser.add_argument("--stall", type=float, default=2.0, help="卡住的时长（秒）")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("websocket") is None:
+        print("需要安装 websocket-client: pip install websocket-client")
+        sys.exit(1)
+
+    rng = random.Random(42)
+    rng_lock = threading.Lock()
+
+    def jitter():
+        # 大多数连接80-250毫秒，少量连接卡住
+        with rng_lock:
+            if rng.random() < args.stall_rate:
+                return args.stall
+            return rng.uniform(0.08, 0.25)
+
+    def jittery_handler(conn, path):
+        time.sleep(jitter())
+        if "tts" in path:
+            tts_handler(conn, path, chunks=1)
+        else:
+            spark_handler(conn, path)
+
+    server = StandInServer(jittery_handler).start()
+    from settings import override_settings
+    override_settings({"APPID": "bench", "API_KEY": "bench", "API_SECRET": "bench", "QUOTA_ENABLED": "0", "TTS_LOCAL_MODE": "off",
+                       "SPARK_BASE_URL": server.url("/v1.1/chat"), "TTS_BASE_URL": server.url("/v2/tts")})
+
+    from spark_api import SparkAPI
+    from tts_api import TTSApi
+
+    # 只测试首包延迟，星火不初始化TTS，合成不播放
+
+    def drain_playback(self):
+        self.is_playing = True
+
+        def drain():
+            while self.audio_queue.get() is not None:
+                pass
+            self.is_playing = False
+        self.playback_thread = threading.Thread(target=drain, name="bench-playback", daemon=True)
+        self.playback_thread.start()
+    TTSApi._start_playback = drain_playback
+
+    def percentiles(values):
+        ordered = sorted(values)
+        pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+        return f"P50 {pick(50):.0f} / P95 {pick(95):.0f} / P99 {pick(99):.0f} / 最大 {ordered[-1] * 1000:.0f} 毫秒"
+
+    for service in ("spark", "tts"):
+        for enabled in (False, True):
+            policy = HedgePolicy(service, enabled=enabled, min_delay=0.1)
+            if service == "spark":
+                client = SparkAPI(init_tts=False)
+                client.hedge = policy
+                call = lambda: client.chat("你好")
+            else:
+                client = TTSApi()
+                client.hedge = policy
+                call = lambda: client.speak("你好，我在。")
+            timings = []
+            devnull = open(os.devnull, "w")
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                for turn in range(args.warmup + args.turns):
+                    start = time.perf_counter()
+                    call()
+                    if turn >= args.warmup:
+                        timings.append(time.perf_counter() - start)
+                    if service == "spark":
+                        client.reset_conversation()
+            finally:
+                sys.stdout = stdout
+                devnull.close()
+            label = "对冲" if enabled else "关闭"
+            print(f"[{service:>5} {label}] {percentiles(timings)}；{policy.report()}")
+    server.stop()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 讯飞WebSocket消息的JSON编解码：听写结果、星火token帧、合成音频帧的解析，上行音频帧和请求的序列化都经过这里
+# 导入时选择可用的最快实现：orjson > ujson > 标准库json（pip install orjson 后自动使用，无需配置）
+# 选择前先加载.env（startup.load_config，整个进程只加载一次），.env中的 JSON_BACKEND 同样生效；
+# 导入后各模块已绑定所选实现的函数，修改 JSON_BACKEND 需要重启进程
+# 合成音频帧中base64音频占消息的绝大部分：parse_tts_frame 先把音频字符串切出来，只解析剩下的骨架，
+# 解析器不再扫描、转义检查和复制整段音频；音频中带转义字符等少见情况按完整消息解析
+# 序列化输出紧凑格式、中文不转义（与讯飞接口要求的UTF-8一致，消息更短）
+#
+# 环境变量:
+#   JSON_BACKEND: auto（默认）/ orjson / ujson / json，指定实现（用于对比或排查问题）
+#
+# 对比各实现的耗时（会话录制文件或本地生成的消息流）: python json_codec.py [session-*.bsr ...]
+
+import json
+import os
+import re
+
+from startup import load_config
+
+BACKENDS = ("orjson", "ujson", "json")
+
+_AUDIO_FIELD = re.compile(r'"audio"\s*:\s*"')
+
+
+class JsonCodec:
+    """
+    一种JSON实现的编解码函数
+    """
+    def __init__(self, backend="auto"):
+        """
+        :param backend: auto / orjson / ujson / json，指定的实现没有安装时按auto选择
+        """
+        backend = backend.strip().lower()
+        candidates = BACKENDS if backend not in BACKENDS else (backend,) + BACKENDS
+        for name in candidates:
+            if self._load(name):
+                break
+        if backend not in ("auto", self.name):
+            print(f"JSON实现 {backend} 不可用，使用 {self.name}")
+
+    def _load(self, name):
+        if name == "orjson":
+            try:
+                import orjson
+            except ImportError:
+                return False
+            self.loads = orjson.loads
+            self.dumps = lambda obj: orjson.dumps(obj).decode()
+            self.JSONDecodeError = orjson.JSONDecodeError
+        elif name == "ujson":
+            try:
+                import ujson
+            except ImportError:
+                return False
+            self.loads = ujson.loads
+            self.dumps = lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+            self.JSONDecodeError = ujson.JSONDecodeError
+        else:
+            self.loads = json.loads
+            self.dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+            self.JSONDecodeError = json.JSONDecodeError
+        self.name = name
+        return True
+
+    def parse_tts_frame(self, message):
+        """
+        解析一条合成响应，base64音频不经过JSON解析
+        兼容普通合成（code、data.status、data.audio）和超拟人合成（header.code、header.status、payload.audio.audio）
+        :param message: 响应文本
+        :return: (错误码, 错误信息, 状态, base64音频字符串)，没有音频时为None
+        """
+        if isinstance(message, (bytes, bytearray)):
+            message = message.decode("utf-8")
+        audio = None
+        match = _AUDIO_FIELD.search(message)
+        if match is not None:
+            start = match.end()
+            end = message.find('"', start)
+            if end > 0 and message.find("\\", start, end) < 0:
+                audio = message[start:end]
+                message = message[:start] + message[end:]  # 剩下的骨架中音频为空字符串
+        frame = self.loads(message)
+
+        header = frame.get("header")
+        if header is not None:
+            # 超拟人合成
+            if audio is None:
+                audio = ((frame.get("payload") or {}).get("audio") or {}).get("audio")
+            return header.get("code", 0), header.get("message"), header.get("status", 1), audio or None
+        data = frame.get("data") or {}
+        if audio is None:
+            audio = data.get("audio")
+        return frame.get("code", 0), frame.get("message"), data.get("status", 1), audio or None
+
+
+# 进程内使用的实现：先加载.env，再按 JSON_BACKEND 选择
+load_config()
+_codec = JsonCodec(os.getenv("JSON_BACKEND", "auto"))
+BACKEND = _codec.name
+loads = _codec.loads
+dumps = _codec.dumps
+JSONDecodeError = _codec.JSONDecodeError
+parse_tts_frame = _codec.parse_tts_frame
+
+
+if __name__ == "__main__":
+    import argparse
+    import base64
+    import random
+    import time
+    from session_recorder import read_session, KIND_IAT, KIND_SPARK, KIND_TTS
+
+    parser = argparse.ArgumentParser(description="JSON实现对比")
+    parser.add_argument("paths", nargs="*", help="会话录制文件（SESSION_RECORD_DIR 下的 .bsr），不指定时使用本地生成的消息流")
+    parser.add_argument("--repeat", type=int, default=20, help="每组消息重复解析的次数")
+    args = parser.parse_args()
+
+    streams = {KIND_IAT: [], KIND_SPARK: [], KIND_TTS: []}
+    if args.paths:
+        for path in args.paths:
+            _, records = read_session(path)
+            for kind, _, payload in records:
+                if kind in streams:
+                    streams[kind].append(payload.decode("utf-8"))
+    else:
+        # 与讯飞接口格式相同的消息：逐步修正的听写结果、逐token的星火回复、每条约4KB音频的合成帧
+        random.seed(0)
+        for i in range(60):
+            words = [{"cw": [{"w": "你好" if n % 2 else "今天", "sc": 0}]} for n in range(i % 12 + 1)]
+            streams[KIND_IAT].append(json.dumps({"code": 0, "message": "success", "sid": "iat000a1b2c@dx",
+                                                 "data": {"result": {"sn": i + 1, "ls": i == 59, "bg": 0, "ed": 0, "pgs": "rpl",
+                                                                     "rg": [1, i + 1], "ws": words}, "status": 2 if i == 59 else 1}},
+                                                ensure_ascii=False))
+        for i in range(200):
+            streams[KIND_SPARK].append(json.dumps({"header": {"code": 0, "message": "Success", "sid": "cht000b1c2d@dx",
+                                                              "status": 2 if i == 199 else 1},
+                                                   "payload": {"choices": {"status": 2 if i == 199 else 1, "seq": i,
+                                                                           "text": [{"content": "今天天气不错，", "role": "assistant", "index": 0}]}}},
+                                                  ensure_ascii=False))
+        for i in range(40):
+            audio = base64.b64encode(random.randbytes(4096)).decode()
+            streams[KIND_TTS].append(json.dumps({"code": 0, "message": "success", "sid": "tts000c1d2e@dx",
+                                                 "data": {"audio": audio, "status": 2 if i == 39 else 1, "ced": str(i * 10)}}))
+    uplink = [{"data": {"status": 1, "format": "audio/L16;rate=16000", "encoding": "raw",
+                        "audio": base64.b64encode(bytes(1280)).decode()}} for _ in range(100)]
+
+    def per_message(func, items):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for item in items:
+                func(item)
+        return (time.perf_counter() - start) / (args.repeat * len(items)) * 1e6
+
+    print(f"消息数: 听写 {len(streams[KIND_IAT])}，星火 {len(streams[KIND_SPARK])}，合成 {len(streams[KIND_TTS])}"
+          f"（平均 {sum(map(len, streams[KIND_TTS])) / max(1, len(streams[KIND_TTS])) / 1024:.1f}KB）；每条消息的微秒数")
+    for name in BACKENDS:
+        codec = JsonCodec(name)
+        if codec.name != name:
+            print(f"[{name:>6}] 未安装")
+            continue
+
+        def full_tts(message, codec=codec):
+            frame = codec.loads(message)
+            return (frame.get("data") or (frame.get("payload") or {}).get("audio") or {}).get("audio")
+
+        row = [per_message(codec.loads, streams[KIND_IAT]) if streams[KIND_IAT] else 0.0,
+               per_message(codec.loads, streams[KIND_SPARK]) if streams[KIND_SPARK] else 0.0,
+               per_message(full_tts, streams[KIND_TTS]) if streams[KIND_TTS] else 0.0,
+               per_message(codec.parse_tts_frame, streams[KIND_TTS]) if streams[KIND_TTS] else 0.0,
+               per_message(codec.dumps, uplink)]
+        print(f"[{name:>6}] 听写解析 {row[0]:.1f} / 星火解析 {row[1]:.1f} / 合成完整解析 {row[2]:.1f} / "
+              f"合成音频提取 {row[3]:.1f} / 上行序列化 {row[4]:.1f}")
+    print(f"当前使用: {BACKEND}")
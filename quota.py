@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 讯飞接口配额控制：按APPID和服务（听写iat、星火spark、合成tts）限制并发连接数和每秒请求数
+#
+# - 每个服务一个并发信号量 + 令牌桶（每秒补充qps个令牌，最多积累burst个）
+# - 请求在截止时间内排队等待；预计无法按时获得令牌或排队已满时立即拒绝（QuotaExceeded），不再发出注定被拒的握手
+# - 服务端返回流控错误码时清空令牌桶，后续请求自动放慢
+# - 统计放行/拒绝数、排队等待时间和当前并发，stats()/report() 输出
+#
+# 环境变量（SERVICE为IAT、SPARK、TTS）:
+#   QUOTA_ENABLED: 是否启用，默认开启
+#   QUOTA_<SERVICE>_QPS: 每秒请求数上限
+#   QUOTA_<SERVICE>_CONCURRENCY: 并发连接数上限
+#   QUOTA_<SERVICE>_BURST: 令牌桶容量，默认等于QPS
+#   QUOTA_<SERVICE>_QPS_<APPID> 等: 针对某个APPID的单独配置
+#   QUOTA_MAX_WAIT_MS: 最长排队时间，默认2000毫秒
+#
+# 压力测试: python quota.py
+
+import threading
+import time
+
+from event_log import log, WARNING
+from settings import get_settings
+
+# 各服务的默认限制（QPS, 并发），与讯飞开放平台免费额度相当，可在.env中按实际购买的额度调整
+DEFAULT_LIMITS = {
+    "iat": (50, 50),
+    "spark": (2, 2),
+    "tts": (20, 20)
+}
+
+# 讯飞返回的流控错误码：日流控、秒级流控、并发流控超限
+THROTTLE_CODES = {11201, 11202, 11203}
+
+
+class QuotaExceeded(Exception):
+    """
+    请求无法在截止时间内获得配额
+    """
+    pass
+
+
+class RequestCancelled(Exception):
+    """
+    排队中的请求因会话结束被取消
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    令牌桶
+    """
+    def __init__(self, rate, burst):
+        """
+        :param rate: 每秒补充的令牌数
+        :param burst: 最多积累的令牌数
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait):
+        """
+        预约一个令牌（调用方负责加锁）
+        :param max_wait: 最多愿意等待的秒数
+        :return: 需要等待的秒数；超过max_wait时返回None且不消耗令牌
+        """
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def drain(self):
+        """
+        清空令牌（服务端返回流控错误时调用）
+        """
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0)
+
+
+class Admission:
+    """
+    一次放行，连接结束时调用 release()（也可以用 with 语句）
+    """
+    def __init__(self, quota):
+        self._quota = quota
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._quota._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class ServiceQuota:
+    """
+    单个服务的并发和QPS控制
+    """
+    def __init__(self, name, qps, concurrency, burst=None, max_wait=2.0, max_queue=16):
+        """
+        :param name: 名称，例如 spark
+        :param qps: 每秒请求数上限
+        :param concurrency: 并发连接数上限
+        :param burst: 令牌桶容量，默认等于qps
+        :param max_wait: 默认最长排队时间（秒）
+        :param max_queue: 最多排队的请求数，超过时直接拒绝
+        """
+        self.name = name
+        self.qps = qps
+        self.concurrency = concurrency
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.bucket = TokenBucket(qps, burst or max(1, qps))
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+
+        # 统计
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self, timeout=None):
+        """
+        申请一次请求配额，必要时排队
+        :param timeout: 最长排队时间（秒），None使用默认值
+        :return: Admission
+        :raises QuotaExceeded: 无法在截止时间内获得配额
+        """
+        timeout = self.max_wait if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                self._reject(f"排队请求已达上限 {self.max_queue}")
+            self.waiting += 1
+            try:
+                # 等待并发名额
+                while self.in_flight >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(f"并发连接已达上限 {self.concurrency}")
+                    self._cond.wait(remaining)
+                # 预约令牌，预计等待超过截止时间时立即拒绝
+                wait = self.bucket.reserve(deadline - time.monotonic())
+                if wait is None:
+                    self._reject(f"每秒请求数已达上限 {self.qps}")
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+
+        if wait > 0:
+            time.sleep(wait)
+        waited = time.monotonic() - start
+        with self._cond:
+            self.admitted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return Admission(self)
+
+    def _reject(self, reason):
+        # 调用方已持有锁
+        self.rejected += 1
+        log(WARNING, "quota.reject", f"{self.name} 请求被拒绝: {reason}", console=False)
+        raise QuotaExceeded(f"{self.name} 请求过多，{reason}")
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def on_error_code(self, code):
+        """
+        服务端返回错误码时调用，流控错误会清空令牌桶
+        :param code: 错误码
+        :return: 是否为流控错误
+        """
+        if code not in THROTTLE_CODES:
+            return False
+        with self._cond:
+            self.throttled += 1
+            self.bucket.drain()
+        log(WARNING, "quota.throttled", f"{self.name} 服务端流控，错误码 {code}")
+        return True
+
+    def stats(self):
+        """
+        获取统计数据
+        """
+        with self._cond:
+            return {
+                "qps": self.qps,
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+                "wait_avg_ms": self.wait_total / (self.admitted or 1) * 1000,
+                "wait_max_ms": self.wait_max * 1000
+            }
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        s = self.stats()
+        return (f"{self.name}: 并发 {s['in_flight']}/{self.concurrency}，排队 {s['waiting']}，放行 {s['admitted']}，"
+                f"拒绝 {s['rejected']}，服务端流控 {s['throttled']}，"
+                f"排队等待 平均 {s['wait_avg_ms']:.1f} / 最大 {s['wait_max_ms']:.1f} 毫秒")
+
+
+class _Unlimited:
+    """
+    未启用配额控制时使用，所有请求直接放行
+    """
+    def acquire(self, timeout=None):
+        return Admission(self)
+
+    def _release(self):
+        pass
+
+    def on_error_code(self, code):
+        return code in THROTTLE_CODES
+
+
+_UNLIMITED = _Unlimited()
+_quotas = {}
+_quotas_lock = threading.Lock()
+
+
+def _limit(limits, name, appid, default):
+    # 先找针对APPID的配置，再找通用配置
+    for key in ((f"{name}_{appid}",) if appid else ()) + (name,):
+        if key in limits:
+            return limits[key]
+    return default
+
+
+def get_quota(service, appid=None):
+    """
+    获取某个APPID下某个服务的配额控制（进程内共享）
+    :param service: iat / spark / tts
+    :param appid: APPID，默认读取环境变量
+    :return: ServiceQuota
+    """
+    settings = get_settings()
+    if not settings.quota_enabled:
+        return _UNLIMITED
+    appid = appid or settings.appid or ""
+    key = (appid, service)
+    quota = _quotas.get(key)
+    if quota is None:
+        with _quotas_lock:
+            quota = _quotas.get(key)
+            if quota is None:
+                prefix = f"QUOTA_{service.upper()}"
+                limits = dict(settings.quota_limits)
+                default_qps, default_concurrency = DEFAULT_LIMITS.get(service, (10, 10))
+                qps = _limit(limits, f"{prefix}_QPS", appid, default_qps)
+                quota = ServiceQuota(service, qps,
+                                     max(1, int(_limit(limits, f"{prefix}_CONCURRENCY", appid, default_concurrency))),
+                                     burst=_limit(limits, f"{prefix}_BURST", appid, qps),
+                                     max_wait=settings.quota_max_wait_ms / 1000)
+                _quotas[key] = quota
+    return quota
+
+
+def quota_stats():
+    """
+    所有已创建的配额控制的统计数据
+    :return: {"APPID/服务": 统计字典}
+    """
+    return {f"{appid}/{service}": quota.stats() for (appid, service), quota in list(_quotas.items())}
+
+
+def quota_report():
+    """
+    所有已创建的配额控制的统计摘要
+    :return: 每个服务一行
+    """
+    return "\n".join(quota.report() for quota in list(_quotas.values()))
+
+
+# 压力测试：替身服务器记录每个连接的开始时间和并发数，验证配额控制下不会超过服务端限制
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from xf_standin import StandInServer, StandInClient
+
+    parser = argparse.ArgumentParser(description="配额控制压力测试")
+    parser.add_argument("--clients", type=int, default=40, help="并发客户端数")
+    parser.add_argument("--requests", type=int, default=5, help="每个客户端的请求数")
+    parser.add_argument("--qps", type=float, default=10, help="每秒请求数上限")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发连接数上限")
+    parser.add_argument("--hold", type=float, default=0.2, help="每个请求占用连接的秒数")
+    parser.add_argument("--max-wait", type=float, default=1.0, help="最长排队时间（秒）")
+    args = parser.parse_args()
+
+    lock = threading.Lock()
+    server_state = {"active": 0, "peak": 0, "starts": [], "over_limit": 0}
+
+    def handler(conn, path):
+        # 与讯飞服务端一样，超过并发上限的连接直接返回流控错误
+        with lock:
+            server_state["starts"].append(time.monotonic())
+            if server_state["active"] >= args.concurrency:
+                server_state["over_limit"] += 1
+                conn.send(json.dumps({"code": 11203, "message": "concurrency limit"}))
+                conn.close()
+                return
+            server_state["active"] += 1
+            server_state["peak"] = max(server_state["peak"], server_state["active"])
+        try:
+            conn.recv()
+            time.sleep(args.hold)
+            conn.send(json.dumps({"code": 0}))
+        finally:
+            with lock:
+                server_state["active"] -= 1
+            conn.close()
+
+    def run(governed):
+        server = StandInServer(handler).start()
+        server_state.update(active=0, peak=0, starts=[], over_limit=0)
+        quota = ServiceQuota("bench", args.qps, args.concurrency, max_wait=args.max_wait, max_queue=args.clients)
+        results = {"ok": 0, "rejected": 0, "throttled": 0}
+
+        def client():
+            for _ in range(args.requests):
+                try:
+                    admission = quota.acquire() if governed else Admission(_UNLIMITED)
+                except QuotaExceeded:
+                    with lock:
+                        results["rejected"] += 1
+                    continue
+                try:
+                    ws = StandInClient(server.url("/bench"))
+                    ws.send("{}")
+                    reply = json.loads(ws.recv())
+                    ws.close()
+                finally:
+                    admission.release()
+                with lock:
+                    results["ok" if reply["code"] == 0 else "throttled"] += 1
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=client) for _ in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+        server.stop()
+
+        # 任意1秒窗口内的连接数不应超过 令牌桶容量 + QPS
+        starts = sorted(server_state["starts"])
+        window_peak = 0
+        left = 0
+        for right, t in enumerate(starts):
+            while t - starts[left] > 1.0:
+                left += 1
+            window_peak = max(window_peak, right - left + 1)
+        return results, window_peak, elapsed, quota
+
+    for governed in (False, True):
+        results, window_peak, elapsed, quota = run(governed)
+        label = "配额控制" if governed else "不限制"
+        print(f"[{label}] 成功 {results['ok']}，服务端流控 {results['throttled']}，本地拒绝 {results['rejected']}，"
+              f"服务端峰值并发 {server_state['peak']}，1秒内最多 {window_peak} 个连接，耗时 {elapsed:.1f} 秒")
+        if governed:
+            print("  " + quota.report())
+            assert server_state["over_limit"] == 0 and results["throttled"] == 0
+            assert server_state["peak"] <= args.concurrency
+            assert window_peak <= quota.bucket.burst + args.qps
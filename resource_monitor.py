@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 资源监控模块：长时间运行（LONG_SESSION）时统计内存、文件描述符、线程和子进程
+#
+# - snapshot() 采集一次当前进程的资源占用
+# - ResourceMonitor 在后台定期采样，保留有限的历史，超过增长阈值时输出警告
+# - 可选的HTTP看板: 设置 RESOURCE_DASHBOARD_PORT 后访问 http://127.0.0.1:<端口>/ 查看，同时显示讯飞接口的配额统计
+#
+# 环境变量:
+#   RESOURCE_SAMPLE_SECONDS: 采样间隔，默认30秒
+#   RESOURCE_RSS_GROWTH_MB: 常驻内存相对基线增长超过该值时警告，默认50
+#   RESOURCE_FD_GROWTH: 文件描述符相对基线增长超过该值时警告，默认32
+#   RESOURCE_DASHBOARD_PORT: HTTP看板端口，留空不开启
+
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from event_log import log, INFO, WARNING
+from quota import quota_stats, quota_report
+from settings import get_settings
+
+
+def rss_bytes():
+    """
+    当前常驻内存（字节），无法获取时返回None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # 非Linux平台只能拿到峰值；macOS单位为字节，其他为KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def open_fd_count():
+    """
+    当前打开的文件描述符数量，无法获取时返回None
+    """
+    for path in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return None
+
+
+def child_pids():
+    """
+    当前进程仍存活（含未回收的僵尸进程）的子进程ID列表
+    """
+    pid = os.getpid()
+    children = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 进程名可能包含空格和括号，从最后一个右括号之后解析
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[1]) == pid:
+                children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def process_memory(pid):
+    """
+    某个进程的内存占用（只支持Linux）
+    RSS 中与其他进程共享的页面（例如写时复制共享的模型）按全额计算，PSS 按共享进程数平摊
+    :param pid: 进程ID
+    :return: (RSS字节, PSS字节)，无法获取的项为None
+    """
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    values[key] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if "Rss" not in values:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                values["Rss"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+    return values.get("Rss"), values.get("Pss")
+
+
+def snapshot():
+    """
+    采集一次资源占用
+    :return: 字典
+    """
+    rss = rss_bytes()
+    return {
+        "time": time.time(),
+        "rss_mb": round(rss / 1024 / 1024, 1) if rss is not None else None,
+        "fds": open_fd_count(),
+        "threads": threading.active_count(),
+        "children": len(child_pids()),
+        "gc_objects": sum(gc.get_count())
+    }
+
+
+def format_snapshot(s):
+    """
+    把快照格式化为一行
+    """
+    rss = f"{s['rss_mb']:.1f} MB" if s["rss_mb"] is not None else "未知"
+    fds = s["fds"] if s["fds"] is not None else "未知"
+    return f"内存 {rss}, 文件描述符 {fds}, 线程 {s['threads']}, 子进程 {s['children']}"
+
+
+class ResourceMonitor:
+    """
+    后台资源采样与增长告警
+    """
+    def __init__(self, interval=None, rss_growth_mb=None, fd_growth=None, history=240):
+        """
+        :param interval: 采样间隔（秒）
+        :param rss_growth_mb: 内存增长告警阈值（MB）
+        :param fd_growth: 文件描述符增长告警阈值
+        :param history: 保留的采样条数
+        """
+        settings = get_settings()
+        self.interval = interval or settings.resource_sample_seconds
+        self.rss_growth_mb = rss_growth_mb or settings.resource_rss_growth_mb
+        self.fd_growth = fd_growth or settings.resource_fd_growth
+        self.history = deque(maxlen=history)
+        self.baseline = None
+        self.checkpoints = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def start(self):
+        """
+        记录基线并开始后台采样
+        """
+        self.baseline = snapshot()
+        self.history.append(self.baseline)
+        self._thread = threading.Thread(target=self._run, name="resource-monitor", daemon=True)
+        self._thread.start()
+        log(INFO, "resource.baseline", f"资源基线: {format_snapshot(self.baseline)}")
+        port = get_settings().resource_dashboard_port
+        if port is not None:
+            self.serve_dashboard(port)
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        采样一次并检查增长
+        :return: 快照
+        """
+        current = snapshot()
+        self.history.append(current)
+        self._check(current)
+        return current
+
+    def checkpoint(self, name):
+        """
+        在一个阶段结束时（例如一轮对话结束）回收垃圾并采样
+        :param name: 阶段名称
+        :return: 快照
+        """
+        gc.collect()
+        self.checkpoints += 1
+        current = self.sample()
+        log(INFO, "resource.checkpoint", f"[{name} #{self.checkpoints}] {format_snapshot(current)}")
+        return current
+
+    def _check(self, current):
+        if self.baseline is None:
+            return
+        base = self.baseline
+        if (current["rss_mb"] is not None and base["rss_mb"] is not None
+                and current["rss_mb"] - base["rss_mb"] > self.rss_growth_mb):
+            log(WARNING, "resource.rss", f"常驻内存比基线增长 {current['rss_mb'] - base['rss_mb']:.1f} MB: {format_snapshot(current)}")
+        if current["fds"] is not None and base["fds"] is not None and current["fds"] - base["fds"] > self.fd_growth:
+            log(WARNING, "resource.fds", f"文件描述符比基线增加 {current['fds'] - base['fds']} 个: {format_snapshot(current)}")
+
+    def report(self):
+        """
+        生成看板数据
+        """
+        current = self.history[-1] if self.history else snapshot()
+        return {
+            "baseline": self.baseline,
+            "current": current,
+            "checkpoints": self.checkpoints,
+            "history": list(self.history),
+            "quota": quota_stats()
+        }
+
+    def serve_dashboard(self, port):
+        """
+        在后台线程中提供HTTP看板，/ 为文本摘要，/json 为完整数据
+        :param port: 端口
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        monitor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = monitor.report()
+                if self.path.startswith("/json"):
+                    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                    content_type = "application/json; charset=utf-8"
+                else:
+                    lines = [f"基线: {format_snapshot(data['baseline'])}" if data["baseline"] else "基线: 无",
+                             f"当前: {format_snapshot(snapshot())}",
+                             f"对话轮数: {data['checkpoints']}", quota_report(), ""]
+                    for s in data["history"][-20:]:
+                        lines.append(time.strftime("%m-%d %H:%M:%S", time.localtime(s["time"])) + "  " + format_snapshot(s))
+                    body = "\n".join(lines).encode("utf-8")
+                    content_type = "text/plain; charset=utf-8"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 不输出每个请求的访问日志
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="resource-dashboard", daemon=True).start()
+        print(f"资源看板: http://127.0.0.1:{port}/")
+
+    def stop(self):
+        """
+        停止采样和看板
+        """
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
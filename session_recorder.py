@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 会话录制模块：把一次运行中的麦克风PCM和各服务收到的原始消息写入追加式二进制文件，
+# 用于离线回放、复现慢请求（回放和时间线工具见 session_replay.py）
+#
+# 默认关闭，设置环境变量后开启:
+#   SESSION_RECORD_DIR: 录制文件目录，每次运行生成一个 session-<时间>-<进程号>.bsr 文件
+#
+# 文件格式（小端）:
+#   文件头: 魔数 b"BSR1" + 录制开始的Unix时间(double)
+#   记录:   类型(uint8) + 距录制开始的单调时钟纳秒数(uint64) + 负载长度(uint32) + 负载
+# 负载: 麦克风为原始PCM，讯飞消息为原始JSON文本(UTF-8)，标记为事件名(可带 "\t详情")
+
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"BSR1"
+FILE_HEADER = struct.Struct("<4sd")
+RECORD_HEADER = struct.Struct("<BQI")
+
+# 记录类型
+KIND_MIC = 1  # 麦克风PCM
+KIND_IAT = 2  # 听写结果消息（ASR.on_message）
+KIND_SPARK = 3  # 星火大模型消息（SparkAPI.on_message）
+KIND_TTS = 4  # 语音合成消息（TTSApi._on_message）
+KIND_MARK = 5  # 流程标记
+
+KIND_NAMES = {
+    KIND_MIC: "mic",
+    KIND_IAT: "iat",
+    KIND_SPARK: "spark",
+    KIND_TTS: "tts",
+    KIND_MARK: "mark"
+}
+
+# 流程标记
+MARK_TURN_START = "turn_start"  # 开始录音
+MARK_SPEECH_END = "speech_end"  # 检测到说话结束
+MARK_ASR_RESULT = "asr_result"  # 确定最终识别结果
+MARK_LLM_REQUEST = "llm_request"  # 调用大模型
+MARK_TTS_REQUEST = "tts_request"  # 调用语音合成
+MARK_PLAYBACK_DONE = "playback_done"  # 播放完成
+
+
+class SessionRecorder:
+    """
+    追加式会话录制器，线程安全
+    """
+    def __init__(self, path):
+        """
+        :param path: 录制文件路径
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.monotonic_ns()
+        self._file = open(path, "wb", buffering=256 * 1024)
+        self._file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.records = 0
+        self.bytes = FILE_HEADER.size
+
+    def write(self, kind, payload):
+        """
+        追加一条记录
+        :param kind: 记录类型
+        :param payload: 字节或字符串
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        header = RECORD_HEADER.pack(kind, time.monotonic_ns() - self._start, len(payload))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header)
+            self._file.write(payload)
+            self.records += 1
+            self.bytes += len(header) + len(payload)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """
+        写出缓冲并关闭文件
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_recorder = None
+_resolved = False
+_resolve_lock = threading.Lock()
+
+
+def _open_from_env():
+    """
+    按环境变量创建录制器，整个进程只检查一次
+    """
+    global _recorder, _resolved
+    with _resolve_lock:
+        if not _resolved:
+            directory = os.getenv("SESSION_RECORD_DIR", "").strip()
+            if directory:
+                try:
+                    import atexit
+                    os.makedirs(directory, exist_ok=True)
+                    name = time.strftime("session-%Y%m%d-%H%M%S") + f"-{os.getpid()}.bsr"
+                    path = os.path.join(directory, name)
+                    _recorder = SessionRecorder(path)
+                    atexit.register(_recorder.close)
+                    print(f"会话录制已开启: {path}")
+                except OSError as e:
+                    print(f"无法开启会话录制: {e}")
+            _resolved = True
+    return _recorder
+
+
+def record(kind, payload):
+    """
+    录制一条记录，未开启录制时直接返回
+    :param kind: 记录类型
+    :param payload: 字节或字符串
+    """
+    recorder = _recorder if _resolved else _open_from_env()
+    if recorder is not None:
+        recorder.write(kind, payload)
+
+
+def record_mark(name, detail=None):
+    """
+    录制一个流程标记
+    :param name: 标记名称
+    :param detail: 附加信息
+    """
+    record(KIND_MARK, name if detail is None else f"{name}\t{detail}")
+
+
+def read_session(path):
+    """
+    读取录制文件
+    :param path: 录制文件路径
+    :return: (录制开始的Unix时间, 记录生成器)，记录为 (类型, 距开始秒数, 负载字节)
+    """
+    f = open(path, "rb")
+    magic, start_time = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        f.close()
+        raise ValueError(f"{path} 不是会话录制文件")
+
+    def records():
+        with f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                kind, offset_ns, length = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                # 进程异常退出时最后一条记录可能不完整
+                if len(payload) < length:
+                    return
+                yield kind, offset_ns / 1e9, payload
+
+    return start_time, records()
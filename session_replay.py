@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 会话回放工具：读取 session_recorder 录制的文件
+#
+#   timeline - 打印每轮对话各阶段的时间线（录音、识别、大模型、合成、播放）
+#   replay   - 按原始节奏（或加速）把录制的消息重新送入各模块的消息处理函数，
+#              网络连接用空对象代替，统计每类消息的处理耗时和回放滞后
+#   dump     - 逐条列出记录
+#
+# 用法:
+#   python session_replay.py timeline recordings/session-xxx.bsr
+#   python session_replay.py replay recordings/session-xxx.bsr --speed 4
+#   python session_replay.py dump recordings/session-xxx.bsr --kinds iat,spark
+
+import argparse
+import time
+
+from session_recorder import (read_session, KIND_NAMES, KIND_MIC, KIND_IAT, KIND_SPARK, KIND_TTS, KIND_MARK,
+                              MARK_TURN_START, MARK_SPEECH_END, MARK_ASR_RESULT, MARK_LLM_REQUEST,
+                              MARK_TTS_REQUEST, MARK_PLAYBACK_DONE)
+
+# 时间线中各事件的显示名称
+EVENT_LABELS = {
+    MARK_TURN_START: "开始录音",
+    "first_mic": "首个麦克风帧",
+    "first_iat": "首个识别结果",
+    MARK_SPEECH_END: "检测到说话结束",
+    "last_iat": "最后一个识别结果",
+    MARK_ASR_RESULT: "确定识别结果",
+    MARK_LLM_REQUEST: "调用大模型",
+    "first_spark": "大模型首个token",
+    "last_spark": "大模型回复完成",
+    MARK_TTS_REQUEST: "调用语音合成",
+    "first_tts": "首个音频块",
+    "last_tts": "音频接收完成",
+    MARK_PLAYBACK_DONE: "播放完成"
+}
+
+# 阶段耗时: (名称, 起点事件, 终点事件)
+STAGES = [
+    ("识别尾延迟", MARK_SPEECH_END, MARK_ASR_RESULT),
+    ("大模型首token", MARK_LLM_REQUEST, "first_spark"),
+    ("大模型完整回复", MARK_LLM_REQUEST, "last_spark"),
+    ("合成首包", MARK_TTS_REQUEST, "first_tts"),
+    ("说完到听到回复", MARK_SPEECH_END, "first_tts")
+]
+
+
+def split_mark(payload):
+    """
+    解析标记负载
+    :return: (标记名称, 详情)
+    """
+    name, _, detail = payload.decode("utf-8").partition("\t")
+    return name, detail
+
+
+def build_turns(records):
+    """
+    按 turn_start 标记把记录分成若干轮，记录每轮各事件第一次（或最后一次）出现的时刻
+    :param records: (类型, 时刻, 负载) 序列
+    :return: [{事件: 时刻}, ...]，第0轮为第一次录音前的事件（例如唤醒欢迎语）
+    """
+    turns = [{}]
+    for kind, t, payload in records:
+        turn = turns[-1]
+        if kind == KIND_MARK:
+            name, detail = split_mark(payload)
+            if name == MARK_TURN_START:
+                turn = {}
+                turns.append(turn)
+            turn.setdefault(name, t)
+            if name == MARK_ASR_RESULT and detail:
+                turn["asr_source"] = detail
+        elif kind in (KIND_MIC, KIND_IAT, KIND_SPARK, KIND_TTS):
+            name = KIND_NAMES[kind]
+            turn.setdefault(f"first_{name}", t)
+            turn[f"last_{name}"] = t
+            turn[f"{name}_count"] = turn.get(f"{name}_count", 0) + 1
+            turn[f"{name}_bytes"] = turn.get(f"{name}_bytes", 0) + len(payload)
+    return [turn for turn in turns if turn]
+
+
+def print_timeline(path):
+    """
+    打印每轮对话的阶段时间线
+    """
+    start_time, records = read_session(path)
+    turns = build_turns(records)
+    print(f"录制开始: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}, 共 {len(turns)} 段")
+
+    for index, turn in enumerate(turns):
+        events = sorted((t, name) for name, t in turn.items() if name in EVENT_LABELS)
+        if not events:
+            continue
+        origin = turn.get(MARK_TURN_START, events[0][0])
+        title = f"第 {index} 轮" if MARK_TURN_START in turn else "录音前"
+        print(f"\n==== {title} (录制后 {origin:.3f} 秒) ====")
+        previous = origin
+        for t, name in events:
+            label = EVENT_LABELS[name]
+            if name == MARK_ASR_RESULT and turn.get("asr_source"):
+                label += f" ({turn['asr_source']})"
+            print(f"  +{(t - origin) * 1000:9.1f} 毫秒  (+{(t - previous) * 1000:7.1f})  {label}")
+            previous = t
+
+        counts = ", ".join(f"{name} {turn[name + '_count']} 条/{turn[name + '_bytes']} 字节"
+                           for name in ("mic", "iat", "spark", "tts") if turn.get(name + "_count"))
+        if counts:
+            print(f"  消息: {counts}")
+        stages = [f"{name} {(turn[end] - turn[begin]) * 1000:.0f} 毫秒"
+                  for name, begin, end in STAGES if begin in turn and end in turn and turn[end] >= turn[begin]]
+        if stages:
+            print(f"  阶段: {', '.join(stages)}")
+
+
+def dump(path, kinds=None):
+    """
+    逐条列出记录
+    :param kinds: 只列出这些类型（名称集合），None表示全部
+    """
+    _, records = read_session(path)
+    for kind, t, payload in records:
+        name = KIND_NAMES.get(kind, str(kind))
+        if kinds and name not in kinds:
+            continue
+        if kind == KIND_MIC:
+            summary = f"{len(payload)} 字节PCM"
+        else:
+            text = payload.decode("utf-8", errors="replace")
+            summary = text if len(text) <= 120 else text[:120] + f"...（共 {len(text)} 字符）"
+        print(f"{t * 1000:10.1f}  {name:<5}  {summary}")
+
+
+class _StubWebSocket:
+    """
+    回放时代替真实连接，发送和关闭都不做任何事
+    """
+    sock = None
+
+    def send(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(path, speed=1.0):
+    """
+    按录制节奏把消息送回各模块的处理函数
+    :param path: 录制文件路径
+    :param speed: 回放倍速，0表示不等待尽快回放
+    """
+    import ASR
+    from spark_api import SparkAPI
+    from tts_api import TTSApi
+
+    ws = _StubWebSocket()
+    # 回放时不初始化真实的TTS
+    spark = SparkAPI(init_tts=False)
+    tts = TTSApi()
+
+    def no_playback():
+        # 不启动ffmpeg播放，只丢弃音频块
+        while not tts.audio_queue.empty():
+            tts.audio_queue.get_nowait()
+    tts._start_playback = no_playback
+
+    def on_mark(payload):
+        name, _ = split_mark(payload)
+        if name == MARK_TURN_START:
+            ASR.all_results = []
+            ASR.current_combined_result = ""
+            ASR.command_scanner.reset()
+        elif name == MARK_LLM_REQUEST:
+            spark.current_response = ""
+            spark.done = False
+            spark.first_token_received = False
+        elif name == MARK_TTS_REQUEST:
+            tts.audio_done = False
+            tts.is_playing = False
+
+    handlers = {
+        KIND_MIC: lambda payload: ASR.is_silent(payload, 500),
+        KIND_IAT: lambda payload: ASR.on_message(ws, payload.decode("utf-8")),
+        KIND_SPARK: lambda payload: spark.on_message(ws, payload.decode("utf-8")),
+        KIND_TTS: lambda payload: tts._on_message(ws, payload.decode("utf-8")),
+        KIND_MARK: on_mark
+    }
+    stats = {name: [0, 0.0, 0.0] for name in KIND_NAMES.values()}  # [条数, 总耗时, 最大耗时]
+    max_lag = 0.0
+
+    _, records = read_session(path)
+    replay_start = time.perf_counter()
+    for kind, t, payload in records:
+        if speed > 0:
+            delay = replay_start + t / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        handler = handlers.get(kind)
+        if handler is None:
+            continue
+        start = time.perf_counter()
+        try:
+            handler(payload)
+        except Exception as e:
+            print(f"回放 {KIND_NAMES[kind]} 消息出错: {e}")
+        elapsed = time.perf_counter() - start
+        entry = stats[KIND_NAMES[kind]]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+    print(f"\n==== 回放完成: {time.perf_counter() - replay_start:.2f} 秒, 最大回放滞后 {max_lag * 1000:.1f} 毫秒 ====")
+    for name, (count, total, worst) in stats.items():
+        if count:
+            print(f"  {name}: {count} 条, 平均处理 {total / count * 1000:.3f} 毫秒, 最长 {worst * 1000:.3f} 毫秒")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="会话录制回放工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    timeline_parser = subparsers.add_parser("timeline", help="打印每轮对话的阶段时间线")
+    timeline_parser.add_argument("path", help="录制文件路径")
+
+    replay_parser = subparsers.add_parser("replay", help="回放录制的消息")
+    replay_parser.add_argument("path", help="录制文件路径")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0表示尽快回放")
+
+    dump_parser = subparsers.add_parser("dump", help="逐条列出记录")
+    dump_parser.add_argument("path", help="录制文件路径")
+    dump_parser.add_argument("--kinds", help="只列出这些类型，逗号分隔: mic,iat,spark,tts,mark")
+
+    args = parser.parse_args()
+    if args.command == "timeline":
+        print_timeline(args.path)
+    elif args.command == "replay":
+        replay(args.path, args.speed)
+        print_timeline(args.path)
+    else:
+        dump(args.path, set(args.kinds.split(",")) if args.kinds else None)
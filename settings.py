@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 类型化配置快照：讯飞接口、星火、语音合成和唤醒，以及音频前端、上行编码、离线识别、并行合成、本地合成、
+# 对冲熔断、配额、星火调度、线程池、事件日志和资源监控的配置解析、校验一次，生成不可变的 Settings
+# WsParam、SparkAPI、TTSApi、VoskWakeup 和每轮对话创建的 AudioSender、HybridRecognizer 等共用同一份快照，
+# 请求路径上只比较快照对象是否变化，不再逐次读取和解析环境变量
+# 音频前端、对冲熔断、配额、星火调度、线程池、事件日志等进程内共享的对象在首次使用时按当时的快照创建，修改这些配置需要重启
+# 热加载：.env 文件修改或收到 SIGHUP 时重新读取并整体替换快照（发音人、语速、提示词、唤醒词等无需重启即可生效）
+# 新快照在下一次识别、对话、合成或恢复唤醒监听时生效，进行中的请求继续使用旧快照
+# 配置值格式错误时打印警告并使用默认值，不会让热加载中断服务
+#
+# 环境变量:
+#   CONFIG_RELOAD: 1开启热加载（默认），0关闭
+#   CONFIG_RELOAD_INTERVAL: 检查.env修改时间的间隔（秒），默认2
+#
+# 用法示例:
+#   from settings import get_settings
+#   settings = get_settings()
+#   settings.tts_voice
+#
+# 查看当前配置（密钥脱敏）: python settings.py
+
+import os
+import re
+import signal
+import threading
+from typing import NamedTuple, Optional, Tuple
+
+from startup import load_config
+from event_log import log, INFO, WARNING
+
+
+def _env_flag(name, default="1"):
+    return os.getenv(name, default).strip().lower() not in ("0", "false", "no", "off")
+
+
+class Settings(NamedTuple):
+    """
+    一份不可变的配置快照
+    """
+    # 讯飞开放平台
+    appid: Optional[str]
+    api_key: Optional[str]
+    api_secret: Optional[str]
+    asr_base_url: Optional[str]
+    # 星火大模型
+    spark_base_url: Optional[str]
+    spark_api_version: str
+    spark_system_prompt: str
+    spark_max_history: int
+    # 语音合成
+    tts_base_url: Optional[str]
+    tts_voice: str
+    tts_speed: int
+    tts_volume: int
+    tts_pitch: int
+    tts_prepare_text: bool
+    tts_chunk_retries: int
+    tts_chunk_timeout: float
+    # 超拟人语音合成（语速、音量、音高为None时使用普通合成的设置）
+    super_tts_base_url: Optional[str]
+    super_tts_voice_id: str
+    super_tts_oral_level: str
+    super_tts_speed: Optional[float]
+    super_tts_volume: Optional[int]
+    super_tts_pitch: Optional[int]
+    super_tts_sample_rate: int
+    # 语音唤醒
+    vosk_model_path: str
+    wake_words: Tuple[str, ...]
+    wake_mode: str
+    long_session: bool
+    # 麦克风音频前端
+    audio_frontend: bool
+    frontend_highpass_hz: float
+    frontend_noise_suppression_db: float
+    frontend_agc_target_dbfs: float
+    frontend_agc_max_gain_db: float
+    # 听写音频上行
+    asr_send_queue_frames: int
+    asr_send_policy: str
+    asr_frame_aggregation: str
+    asr_aggregate_threshold: int
+    asr_max_frame_bytes: int
+    asr_uplink_codec: str
+    asr_speex_quality: int
+    asr_mp3_bitrate: int
+    # 离线识别兜底
+    asr_fallback_mode: str
+    asr_cloud_budget_ms: int
+    asr_offline_min_confidence: float
+    # 合成文本分段、并行合成和下行编码
+    tts_chunk_chars: int
+    tts_first_chunk_chars: int
+    tts_parallel: int
+    tts_parallel_max: int
+    tts_parallel_adaptive: bool
+    tts_rate_limit_codes: Tuple[int, ...]
+    tts_downlink_codec: str
+    tts_raw_min_realtime: float
+    tts_codec_probe_every: int
+    # 本地合成
+    tts_local_mode: str
+    tts_local_command: str
+    tts_local_raw_rate: Optional[int]
+    tts_local_max_chars: int
+    tts_local_slow_ms: float
+    tts_local_slow_max_chars: int
+    # 对冲请求和熔断
+    hedge_enabled: bool
+    hedge_percentile: float
+    hedge_min_delay_ms: float
+    hedge_max_delay_ms: float
+    breaker_failures: int
+    breaker_reset_seconds: float
+    # 配额（quota_limits 为 QUOTA_<SERVICE>_QPS 等按名称排序的 (环境变量名, 数值)）
+    quota_enabled: bool
+    quota_max_wait_ms: float
+    quota_limits: Tuple[Tuple[str, float], ...]
+    # 星火请求调度（spark_max_in_flight 为None时等于星火配额的并发连接数）
+    spark_scheduler: str
+    spark_max_in_flight: Optional[int]
+    spark_queue_max_wait_ms: float
+    spark_queue_max: int
+    # 共享线程池
+    worker_pool_size: int
+    worker_pool_queue: int
+    # 事件日志
+    event_log_path: Optional[str]
+    event_log_level: str
+    event_log_console_level: str
+    event_log_sample: str
+    event_log_flush_ms: int
+    # 资源监控
+    resource_sample_seconds: float
+    resource_rss_growth_mb: float
+    resource_fd_growth: int
+    resource_dashboard_port: Optional[int]
+
+
+def _number(name, default, kind=int, low=None, high=None):
+    """
+    读取数值配置，格式错误或超出范围时使用默认值
+    """
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        number = kind(value)
+    except ValueError:
+        print(f"警告: {name} 参数格式不正确，使用默认值 {default}")
+        return default
+    if (low is not None and number < low) or (high is not None and number > high):
+        if high is None:
+            limit = f"不小于 {low}"
+        elif low is None:
+            limit = f"不大于 {high}"
+        else:
+            limit = f"在 {low}-{high} 之间"
+        print(f"警告: {name} 应{limit}，使用默认值 {default}")
+        return default
+    return number
+
+
+def _choice(name, default, choices):
+    """
+    读取枚举配置，不在可选值中时使用默认值
+    """
+    value = os.getenv(name, default).strip().lower()
+    if value not in choices:
+        print(f"警告: {name} 只能为 {'/'.join(choices)}，使用默认值 {default}")
+        return default
+    return value
+
+
+def _codes(name, default):
+    """
+    读取逗号分隔的错误码列表，格式错误时使用默认值
+    """
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return tuple(int(code) for code in value.split(",") if code.strip())
+    except ValueError:
+        print(f"警告: {name} 应为逗号分隔的错误码，使用默认值 {','.join(map(str, default))}")
+        return default
+
+
+_QUOTA_KEY = re.compile(r"QUOTA_(IAT|SPARK|TTS)_(QPS|CONCURRENCY|BURST)(_.+)?$")
+
+
+def _quota_limits():
+    """
+    读取所有配额上限（含针对APPID的配置），格式错误或不为正数的项忽略（使用默认上限）
+    """
+    limits = []
+    for name in sorted(os.environ):
+        value = os.environ[name].strip()
+        if not value or not _QUOTA_KEY.match(name):
+            continue
+        try:
+            number = float(value)
+        except ValueError:
+            number = 0
+        if number > 0:
+            limits.append((name, number))
+        else:
+            print(f"警告: {name} 应为正数，忽略该项")
+    return tuple(limits)
+
+
+def parse_settings():
+    """
+    从当前环境变量解析并校验配置
+    :return: Settings
+    """
+    wake_words = tuple(word.strip() for word in os.getenv("WAKE_WORDS", "一二三,你好小知,小智小智,小知小知").split(",")
+                       if word.strip())
+    return Settings(
+        appid=os.getenv("APPID"),
+        api_key=os.getenv("API_KEY"),
+        api_secret=os.getenv("API_SECRET"),
+        asr_base_url=os.getenv("ASR_BASE_URL"),
+        spark_base_url=os.getenv("SPARK_BASE_URL"),
+        spark_api_version=os.getenv("SPARK_API_VERSION", "lite").strip() or "lite",
+        spark_system_prompt=os.getenv("SPARK_SYSTEM_PROMPT", ""),
+        spark_max_history=_number("SPARK_MAX_HISTORY", 20, low=0),
+        tts_base_url=os.getenv("TTS_BASE_URL"),
+        tts_voice=os.getenv("TTS_VOICE", "xiaoyan").strip() or "xiaoyan",
+        tts_speed=_number("TTS_SPEED", 50, low=0, high=100),
+        tts_volume=_number("TTS_VOLUME", 70, low=0, high=100),
+        tts_pitch=_number("TTS_PITCH", 50, low=0, high=100),
+        tts_prepare_text=_env_flag("TTS_PREPARE_TEXT"),
+        tts_chunk_retries=_number("TTS_CHUNK_RETRIES", 1, low=0),
+        tts_chunk_timeout=_number("TTS_CHUNK_TIMEOUT", 15.0, float, low=0.1),
+        super_tts_base_url=os.getenv("SUPER_TTS_BASE_URL"),
+        super_tts_voice_id=os.getenv("SUPER_TTS_VOICE_ID", "x4_lingxiaoli_oral").strip() or "x4_lingxiaoli_oral",
+        super_tts_oral_level=_choice("SUPER_TTS_ORAL_LEVEL", "mid", ("low", "mid", "high")),
+        super_tts_speed=_number("SUPER_TTS_SPEED", None, float, low=0, high=100),
+        super_tts_volume=_number("SUPER_TTS_VOLUME", None, low=0, high=100),
+        super_tts_pitch=_number("SUPER_TTS_PITCH", None, low=0, high=100),
+        super_tts_sample_rate=_number("SUPER_TTS_SAMPLE_RATE", 24000, low=8000, high=48000),
+        vosk_model_path=os.getenv("VOSK_MODEL_PATH", "./vosk-model-small-cn"),
+        wake_words=wake_words or ("一二三",),
+        wake_mode=_choice("WAKE_MODE", "full", ("kws", "full")),
+        long_session=os.getenv("LONG_SESSION", "").strip().lower() in ("1", "true", "yes", "on"),
+        audio_frontend=_env_flag("AUDIO_FRONTEND"),
+        frontend_highpass_hz=_number("FRONTEND_HIGHPASS_HZ", 80.0, float, low=0, high=4000),
+        frontend_noise_suppression_db=_number("FRONTEND_NOISE_SUPPRESSION_DB", 12.0, float, low=0, high=60),
+        frontend_agc_target_dbfs=_number("FRONTEND_AGC_TARGET_DBFS", -20.0, float, low=-60, high=0),
+        frontend_agc_max_gain_db=_number("FRONTEND_AGC_MAX_GAIN_DB", 12.0, float, low=0, high=40),
+        asr_send_queue_frames=_number("ASR_SEND_QUEUE_FRAMES", 25, low=1),
+        asr_send_policy=_choice("ASR_SEND_POLICY", "drop_oldest", ("drop_oldest", "drop_newest", "coalesce")),
+        asr_frame_aggregation=_choice("ASR_FRAME_AGGREGATION", "adaptive", ("off", "adaptive", "always")),
+        asr_aggregate_threshold=_number("ASR_AGGREGATE_THRESHOLD", 3, low=1),
+        # 讯飞要求base64编码后单帧不超过13000字节，即原始音频不超过9750字节
+        asr_max_frame_bytes=_number("ASR_MAX_FRAME_BYTES", 7680, low=320, high=9750),
+        asr_uplink_codec=_choice("ASR_UPLINK_CODEC", "raw", ("raw", "speex-wb", "lame")),
+        asr_speex_quality=_number("ASR_SPEEX_QUALITY", 8, low=0, high=10),
+        asr_mp3_bitrate=_number("ASR_MP3_BITRATE", 32, low=8, high=320),
+        asr_fallback_mode=_choice("ASR_FALLBACK_MODE", "off", ("off", "fallback", "race")),
+        asr_cloud_budget_ms=_number("ASR_CLOUD_BUDGET_MS", 1500, low=0),
+        asr_offline_min_confidence=_number("ASR_OFFLINE_MIN_CONFIDENCE", 0.7, float, low=0, high=1),
+        tts_chunk_chars=_number("TTS_CHUNK_CHARS", 150, low=10),
+        tts_first_chunk_chars=_number("TTS_FIRST_CHUNK_CHARS", 40, low=1),
+        tts_parallel=_number("TTS_PARALLEL", 2, low=1),
+        tts_parallel_max=_number("TTS_PARALLEL_MAX", 4, low=1),
+        tts_parallel_adaptive=_env_flag("TTS_PARALLEL_ADAPTIVE"),
+        tts_rate_limit_codes=_codes("TTS_RATE_LIMIT_CODES", (11202, 11203)),
+        tts_downlink_codec=_choice("TTS_DOWNLINK_CODEC", "auto", ("auto", "raw", "lame", "speex-wb")),
+        tts_raw_min_realtime=_number("TTS_RAW_MIN_REALTIME", 1.5, float, low=0.1),
+        tts_codec_probe_every=_number("TTS_CODEC_PROBE_EVERY", 20, low=1),
+        tts_local_mode=_choice("TTS_LOCAL_MODE", "fallback", ("off", "fallback", "auto", "always")),
+        tts_local_command=os.getenv("TTS_LOCAL_COMMAND", "").strip(),
+        tts_local_raw_rate=_number("TTS_LOCAL_RAW_RATE", None, low=8000, high=48000),
+        tts_local_max_chars=_number("TTS_LOCAL_MAX_CHARS", 12, low=1),
+        tts_local_slow_ms=_number("TTS_LOCAL_SLOW_MS", 1500.0, float, low=1),
+        tts_local_slow_max_chars=_number("TTS_LOCAL_SLOW_MAX_CHARS", 60, low=1),
+        hedge_enabled=_env_flag("HEDGE_ENABLED", "0"),
+        hedge_percentile=_number("HEDGE_PERCENTILE", 95.0, float, low=50, high=99.9),
+        hedge_min_delay_ms=_number("HEDGE_MIN_DELAY_MS", 300.0, float, low=0),
+        hedge_max_delay_ms=_number("HEDGE_MAX_DELAY_MS", 3000.0, float, low=1),
+        breaker_failures=_number("BREAKER_FAILURES", 3, low=1),
+        breaker_reset_seconds=_number("BREAKER_RESET_SECONDS", 30.0, float, low=0.1),
+        quota_enabled=_env_flag("QUOTA_ENABLED"),
+        quota_max_wait_ms=_number("QUOTA_MAX_WAIT_MS", 2000.0, float, low=0),
+        quota_limits=_quota_limits(),
+        spark_scheduler=_choice("SPARK_SCHEDULER", "fair", ("fair", "fifo", "off")),
+        spark_max_in_flight=_number("SPARK_MAX_IN_FLIGHT", None, low=1),
+        spark_queue_max_wait_ms=_number("SPARK_QUEUE_MAX_WAIT_MS", 10000.0, float, low=0),
+        spark_queue_max=_number("SPARK_QUEUE_MAX", 64, low=1),
+        worker_pool_size=_number("WORKER_POOL_SIZE", 8, low=1),
+        worker_pool_queue=_number("WORKER_POOL_QUEUE", 64, low=0),
+        event_log_path=os.getenv("EVENT_LOG_PATH", "").strip() or None,
+        event_log_level=_choice("EVENT_LOG_LEVEL", "debug", ("debug", "info", "warning", "error")),
+        event_log_console_level=_choice("EVENT_LOG_CONSOLE_LEVEL", "warning", ("debug", "info", "warning", "error")),
+        event_log_sample=os.getenv("EVENT_LOG_SAMPLE", "").strip(),
+        event_log_flush_ms=_number("EVENT_LOG_FLUSH_MS", 1000, low=10),
+        resource_sample_seconds=_number("RESOURCE_SAMPLE_SECONDS", 30.0, float, low=0.1),
+        resource_rss_growth_mb=_number("RESOURCE_RSS_GROWTH_MB", 50.0, float, low=0),
+        resource_fd_growth=_number("RESOURCE_FD_GROWTH", 32, low=1),
+        resource_dashboard_port=_number("RESOURCE_DASHBOARD_PORT", None, low=1, high=65535),
+    )
+
+
+_settings = None
+_settings_lock = threading.Lock()
+_listeners = []
+_watcher = None
+
+
+def get_settings():
+    """
+    获取当前配置快照（进程内共享，首次调用时解析）
+    """
+    settings = _settings
+    if settings is None:
+        load_config()
+        with _settings_lock:
+            if _settings is None:
+                _install(parse_settings())
+            settings = _settings
+    return settings
+
+
+def _install(settings):
+    global _settings
+    _settings = settings  # 引用赋值是原子的，读取方拿到的总是完整的一份快照
+
+
+def on_reload(callback):
+    """
+    注册配置变化的回调（在热加载线程中调用）
+    :param callback: callback(old, new)
+    """
+    with _settings_lock:
+        _listeners.append(callback)
+
+
+def reload_settings(reload_file=True):
+    """
+    重新解析配置并替换快照
+    :param reload_file: 是否先重新读取.env（.env中的值覆盖环境变量，与启动时一致）；False时只按当前环境变量解析
+    :return: 新快照，配置没有变化时返回原快照
+    """
+    if reload_file:
+        import dotenv
+        path = dotenv.find_dotenv(usecwd=True) or dotenv.find_dotenv()
+        if path:
+            for name, value in dotenv.dotenv_values(path).items():
+                if value is not None:
+                    os.environ[name] = value
+    with _settings_lock:
+        old = _settings
+        new = parse_settings()
+        if new == old:
+            return old
+        _install(new)
+        listeners = list(_listeners)
+    if old is not None:
+        changed = [field for field in Settings._fields if getattr(old, field) != getattr(new, field)]
+        log(INFO, "config.reload", f"配置已重新加载，变化的项: {', '.join(changed)}")
+        for callback in listeners:
+            try:
+                callback(old, new)
+            except Exception as e:
+                log(WARNING, "config.reload", f"配置变化回调出错: {e}")
+    return new
+
+
+def override_settings(values):
+    """
+    改写环境变量并重新解析配置（基准和浸泡测试把地址、密钥改为本地替身时使用）
+    先加载.env，避免之后首次加载配置时被.env中的值覆盖
+    :param values: {环境变量名: 值}
+    :return: 新快照
+    """
+    load_config()
+    os.environ.update(values)
+    return reload_settings(reload_file=False)
+
+
+class _SettingsWatcher:
+    """
+    监视.env的修改时间，变化时重新加载；SIGHUP只设置标志，由监视线程执行加载（信号处理函数中不做I/O）
+    """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.mtime = self._mtime()
+        self.thread = threading.Thread(target=self._run, name="settings-watcher", daemon=True)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _run(self):
+        while True:
+            signaled = self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            mtime = self._mtime()
+            if signaled or mtime != self.mtime:
+                self.mtime = mtime
+                try:
+                    reload_settings()
+                except Exception as e:
+                    log(WARNING, "config.reload", f"重新加载配置失败，继续使用原配置: {e}")
+
+
+def watch_settings():
+    """
+    开启热加载：后台线程检查.env修改时间，主线程中调用时同时注册SIGHUP
+    CONFIG_RELOAD=0 时不开启
+    :return: 是否已开启
+    """
+    global _watcher
+    if not _env_flag("CONFIG_RELOAD"):
+        return False
+    with _settings_lock:
+        if _watcher is not None:
+            return True
+        import dotenv
+        path = dotenv.find_dotenv(usecwd=True) or dotenv.find_dotenv()
+        _watcher = _SettingsWatcher(path, _number("CONFIG_RELOAD_INTERVAL", 2.0, float, low=0.1))
+    get_settings()
+    _watcher.thread.start()
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: _watcher.wakeup.set())
+    return True
+
+
+if __name__ == "__main__":
+    for field, value in get_settings()._asdict().items():
+        if field in ("api_key", "api_secret") and value:
+            value = value[:4] + "****"
+        print(f"{field} = {value!r}")
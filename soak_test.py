@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 长时间运行浸泡测试：对本地替身接口连续模拟数千轮对话，检查内存、文件描述符、线程和子进程是否保持平稳
+#
+# 每轮对话:
+#   1. 听写：AudioSender + 识别器，通过替身听写接口完成一次识别
+#   2. 大模型 + 语音合成：SparkAPI.chat 连接替身星火接口，回复后调用 TTSApi.speak（不启动ffmpeg播放）
+#      需要安装 websocket-client，未安装时只测试听写
+#
+# 替身服务器运行在单独的进程中，只统计本进程的资源占用
+#
+# 用法:
+#   python soak_test.py                    # 默认1000轮
+#   python soak_test.py --turns 5000 --rss-tolerance 8
+
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from audio_uplink import AudioSender
+from asr_backends import HybridRecognizer, IflytekASRBackend
+from resource_monitor import snapshot, format_snapshot
+from xf_standin import StandInServer, StandInClient, route_handler
+
+CHUNK = b"\x01\x00" * 640  # 1280字节 = 40毫秒16k单声道音频
+
+
+def _server_process(ready_queue, stop_event):
+    """
+    替身服务器进程：按路径分发听写、大模型和语音合成请求
+    """
+    server = StandInServer(route_handler).start()
+    ready_queue.put(server.port)
+    stop_event.wait()
+    server.stop()
+
+
+def run_iat_turn(base_url, frames):
+    """
+    模拟一次听写
+    :return: 识别文本
+    """
+    ws = StandInClient(base_url + "/v2/iat")
+    sender = AudioSender(ws, {"app_id": "soak"}, {"domain": "iat"})
+    backend = IflytekASRBackend(sender)
+
+    def receive():
+        try:
+            message = ws.recv()
+            if message is None:
+                backend.fail("连接已关闭")
+                return
+            words = json.loads(message)["data"]["result"]["ws"]
+            backend.deliver("".join(w["w"] for item in words for w in item["cw"]))
+        except Exception as e:
+            backend.fail(str(e))
+
+    receiver = threading.Thread(target=receive, name="soak-iat-recv", daemon=True)
+    receiver.start()
+    recognizer = HybridRecognizer(backend, None)
+    try:
+        for _ in range(frames):
+            recognizer.feed(CHUNK)
+        return recognizer.finish_and_resolve().text
+    finally:
+        recognizer.close()
+        receiver.join(timeout=5)
+        sender.close()
+        ws.close()
+
+
+def create_dialog(base_url):
+    """
+    创建连接替身接口的星火和语音合成实例，没有websocket-client时返回None
+    """
+    try:
+        from spark_api import SparkAPI
+        from tts_api import TTSApi
+        from settings import override_settings
+    except ImportError as e:
+        print(f"未安装 {e.name}，只测试听写")
+        return None
+
+    # 先加载.env，再改写为替身地址和测试密钥并重新解析配置快照
+    override_settings({
+        "APPID": "soak", "API_KEY": "soak", "API_SECRET": "soak",
+        "SPARK_BASE_URL": base_url + "/v1.1/chat",
+        "TTS_BASE_URL": base_url + "/v2/tts",
+        "SUPER_TTS_BASE_URL": base_url + "/v1/private/soak"
+    })
+
+    def drain_playback(self):
+        # 不启动ffmpeg，只消费音频块，保持与真实播放相同的线程生命周期
+        self.is_playing = True
+
+        def drain():
+            while self.audio_queue.get() is not None:
+                pass
+            self.is_playing = False
+        self.playback_thread = threading.Thread(target=drain, name="soak-playback", daemon=True)
+        self.playback_thread.start()
+    TTSApi._start_playback = drain_playback
+
+    spark = SparkAPI()
+    spark.tts_api = TTSApi()
+    spark.tts_initialized = True
+    return spark
+
+
+def main():
+    parser = argparse.ArgumentParser(description="长时间运行浸泡测试")
+    parser.add_argument("--turns", type=int, default=1000, help="模拟的对话轮数")
+    parser.add_argument("--warmup", type=int, default=50, help="预热轮数，之后记录基线")
+    parser.add_argument("--frames", type=int, default=25, help="每轮听写发送的音频帧数")
+    parser.add_argument("--report-every", type=int, default=100, help="每N轮输出一次资源占用")
+    parser.add_argument("--rss-tolerance", type=float, default=8.0, help="允许的常驻内存增长（MB）")
+    parser.add_argument("--fd-tolerance", type=int, default=4, help="允许的文件描述符增长")
+    parser.add_argument("--thread-tolerance", type=int, default=4, help="允许的线程数增长")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    ready_queue, stop_event = ctx.Queue(), ctx.Event()
+    server = ctx.Process(target=_server_process, args=(ready_queue, stop_event), daemon=True)
+    server.start()
+    base_url = f"ws://127.0.0.1:{ready_queue.get(timeout=10)}"
+
+    spark = create_dialog(base_url)
+    baseline = None
+    peak_rss = 0.0
+    failures = 0
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        for turn in range(1, args.turns + 1):
+            # 各模块的逐轮输出写入/dev/null，只保留资源报告
+            with contextlib.redirect_stdout(devnull):
+                try:
+                    text = run_iat_turn(base_url, args.frames)
+                    if spark is not None:
+                        spark.chat(text)
+                except Exception as e:
+                    failures += 1
+                    print(f"第 {turn} 轮出错: {e}", file=sys.stderr)
+
+            if turn == args.warmup or turn % args.report_every == 0 or turn == args.turns:
+                gc.collect()
+                current = snapshot()
+                if current["rss_mb"] is not None:
+                    peak_rss = max(peak_rss, current["rss_mb"])
+                if turn == args.warmup:
+                    baseline = current
+                    print(f"[预热 {turn} 轮] 基线: {format_snapshot(current)}")
+                elif turn >= args.warmup:
+                    print(f"[{turn:>6} 轮] {format_snapshot(current)}, {(time.perf_counter() - start) / turn * 1000:.0f} 毫秒/轮")
+
+    stop_event.set()
+    server.join(timeout=5)
+
+    if baseline is None:
+        print("轮数少于预热轮数，没有基线")
+        sys.exit(1)
+    problems = []
+    if current["rss_mb"] is not None and current["rss_mb"] - baseline["rss_mb"] > args.rss_tolerance:
+        problems.append(f"常驻内存增长 {current['rss_mb'] - baseline['rss_mb']:.1f} MB")
+    if current["fds"] is not None and current["fds"] - baseline["fds"] > args.fd_tolerance:
+        problems.append(f"文件描述符增加 {current['fds'] - baseline['fds']} 个")
+    if current["threads"] - baseline["threads"] > args.thread_tolerance:
+        problems.append(f"线程增加 {current['threads'] - baseline['threads']} 个")
+    if current["children"] > baseline["children"]:
+        problems.append(f"子进程增加 {current['children'] - baseline['children']} 个")
+    if failures:
+        problems.append(f"{failures} 轮出错")
+
+    print(f"==== {args.turns} 轮完成, 耗时 {time.perf_counter() - start:.1f} 秒, 峰值内存 {peak_rss:.1f} MB ====")
+    if problems:
+        print("未通过: " + "; ".join(problems))
+        sys.exit(1)
+    print("通过: 内存、文件描述符、线程和子进程保持平稳")
+
+
+if __name__ == "__main__":
+    main()
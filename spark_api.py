@@ -6,41 +6,49 @@
 # https://www.xfyun.cn/doc/spark/Web.html
 
 import websocket
-import hashlib
-import base64
-import hmac
-import json
-from urllib.parse import urlencode
 import time
 import ssl
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
-import _thread as thread
-import os
 import uuid
-import dotenv
+import threading
 
+from startup import load_config
+# 导入共享的配置快照（解析一次，热加载时整体替换）
+from settings import get_settings
+# 导入JSON编解码（自动选择最快的实现）
+from json_codec import loads, dumps
+from xf_auth import get_signer
+# 导入共享工作线程池（发送请求、初始化TTS、运行连接不再临时创建线程）
+from worker_pool import submit_or_run, submit_long, wait_done
+# 导入事件日志模块（逐token输出不做同步控制台I/O）
+from event_log import log, DEBUG, INFO
+# 导入配额控制模块（星火接口的并发连接数和每秒请求数）
+from quota import get_quota, QuotaExceeded
+# 导入尾延迟保护模块（首个token迟迟不到时发出对冲请求，连续失败时熔断）
+from hedging import get_hedge_policy, get_breaker
+# 导入星火请求调度模块（多个会话共用时按优先级和会话轮流放行）
+from spark_scheduler import get_spark_scheduler, RequestCancelled, PRIORITY_INTERACTIVE
+# 导入会话录制模块（默认关闭）
+from session_recorder import record, record_mark, KIND_SPARK, MARK_LLM_REQUEST
 # 导入TTS API
 from tts_api import TTSApi
 
-# 加载环境变量
-dotenv.load_dotenv()
-dotenv.load_dotenv(override=True) 
+# 加载环境变量（整个进程只加载一次）
+load_config()
+
 class SparkAPI:
     """
     星火大模型API调用
     """
-    def __init__(self, auto_connect=False):
-        # 从环境变量获取星火API参数
-        self.APPID = os.getenv("APPID")
-        self.API_KEY = os.getenv("API_KEY")
-        self.API_SECRET = os.getenv("API_SECRET")
-        self.SPARK_URL = os.getenv("SPARK_BASE_URL")
-        self.SPARK_API_VERSION = os.getenv("SPARK_API_VERSION", "lite")
-        
-        # 获取系统提示词
-        self.SYSTEM_PROMPT = os.getenv("SPARK_SYSTEM_PROMPT", "")
+    def __init__(self, auto_connect=False, session=None, priority=PRIORITY_INTERACTIVE, scheduler=None, init_tts=True):
+        """
+        :param auto_connect: 是否预先准备连接
+        :param session: 会话标识，多个会话共用部署时调度器按会话轮流放行，默认每个实例一个
+        :param priority: 请求优先级，语音对话为 PRIORITY_INTERACTIVE，后台任务为 PRIORITY_BACKGROUND
+        :param scheduler: 星火请求调度器，默认使用按APPID共享的调度器
+        :param init_tts: 收到首个token时是否初始化语音合成（只需要回复文本时关闭）
+        """
+        # 星火API参数和系统提示词来自共享的配置快照，配置热加载后在下一轮对话时更新
+        self._apply_settings(get_settings())
         
         # WebSocket连接
         self.ws = None
@@ -48,21 +56,49 @@ class SparkAPI:
         self.current_response = ""
         # 完成标志
         self.done = False
-        # 对话历史
+        # 对话历史（最多保留的消息条数 max_history，0表示不限制，长时间运行时避免无限增长）
         self.conversation_history = []
         
         # TTS相关属性
         self.tts_api = None
         self.tts_initialized = False
+        self.init_tts = init_tts
         self.first_token_received = False
         # 连接状态
         self.is_connected = False
         self.connection_ready = False
         self.connection_url = None
         
+        # 对冲请求和熔断：本轮发出的连接 {ws: [开始时间, 运行任务, 配额]}，先收到回复的连接生效
+        self.hedge = get_hedge_policy("spark")
+        self.breaker = get_breaker("spark")
+        self._attempts = {}
+        self._failed = set()
+        self._winner = None
+        self._attempt_lock = threading.Lock()
+        
+        # 请求调度：本实例的会话标识和优先级
+        self.session = session or uuid.uuid4().hex[:12]
+        self.priority = priority
+        self.scheduler = scheduler or get_spark_scheduler(self.APPID)
+        
         # 如果需要自动连接
         if auto_connect:
             self.prepare_connection()
+
+    def _apply_settings(self, settings):
+        """
+        使用一份配置快照（初始化时和配置热加载后的下一轮对话前）
+        :param settings: Settings
+        """
+        self.settings = settings
+        self.APPID = settings.appid
+        self.API_KEY = settings.api_key
+        self.API_SECRET = settings.api_secret
+        self.SPARK_URL = settings.spark_base_url
+        self.SPARK_API_VERSION = settings.spark_api_version
+        self.SYSTEM_PROMPT = settings.spark_system_prompt
+        self.max_history = settings.spark_max_history
     def prepare_connection(self):
         """
         预先准备WebSocket连接但不发送数据
@@ -73,35 +109,9 @@ class SparkAPI:
         return self.connection_url
     def create_url(self):
         """
-        生成WebSocket鉴权URL
+        生成WebSocket鉴权URL（host和path从SPARK_BASE_URL解析，签名器共享并按秒缓存）
         """
-        # 生成RFC1123格式的时间戳
-        now = datetime.now()
-        date = format_date_time(mktime(now.timetuple()))
-
-        # 拼接字符串
-        signature_origin = f"host: spark-api.xf-yun.com\ndate: {date}\nGET /v1.1/chat HTTP/1.1"
-
-        # 进行hmac-sha256加密
-        signature_sha = hmac.new(
-            self.API_SECRET.encode('utf-8'),
-            signature_origin.encode('utf-8'),
-            digestmod=hashlib.sha256
-        ).digest()
-
-        signature_sha_base64 = base64.b64encode(signature_sha).decode()
-
-        authorization_origin = f'api_key="{self.API_KEY}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
-        authorization = base64.b64encode(authorization_origin.encode()).decode()
-
-        # 将鉴权信息添加到URL
-        v = {
-            "authorization": authorization,
-            "date": date,
-            "host": "spark-api.xf-yun.com"
-        }
-        url = self.SPARK_URL + '?' + urlencode(v)
-        return url
+        return get_signer(self.API_KEY, self.API_SECRET, self.SPARK_URL, presign=True).sign()
 
     def _generate_payload(self, query):
         """
@@ -154,12 +164,23 @@ class SparkAPI:
         """
         收到WebSocket消息的处理
         """
-        data = json.loads(message)
+        # 对冲请求中落后的连接，消息直接忽略
+        if self._winner is not None and ws is not self._winner:
+            return
+        record(KIND_SPARK, message)
+        data = loads(message)
         code = data["header"]["code"]
         
         if code != 0:
             print(f"星火大模型返回错误: {data}")
-            self.done = True
+            get_quota("spark", self.APPID).on_error_code(code)
+            if ws is self._winner:
+                self.done = True
+            else:
+                self._attempt_failed(ws)
+            return
+        
+        if not self._claim(ws):
             return
             
         choices = data["payload"]["choices"]
@@ -169,23 +190,120 @@ class SparkAPI:
         # 收到第一个token时初始化TTS API
         if not self.first_token_received and content.strip():
             self.first_token_received = True
-            # 在另一个线程中初始化TTS API，以免阻塞当前处理
-            thread.start_new_thread(self._initialize_tts_api, ())
-            print("检测到首个字符，开始初始化TTS API...")
+            if self.init_tts:
+                # 在工作线程中初始化TTS API，以免阻塞当前处理
+                submit_or_run(self._initialize_tts_api, name="tts-init")
+                print("检测到首个字符，开始初始化TTS API...")
         
         # 累积回复文本
         self.current_response += content
-        print(content, end="", flush=True)
+        log(DEBUG, "spark.token", content, end="")
         
         # 若已结束，打印完整回复
         if status == 2:
             self.done = True
+            # 逐token的输出只写入日志文件时，在日志中保留完整回复
+            log(INFO, "spark.reply", self.current_response, console=False)
             
             # 将助手回复加入对话历史
             self.conversation_history.append({
                 "role": "assistant",
                 "content": self.current_response
             })
+            self._trim_history()
+
+    def _start_attempt(self, admission=None):
+        """
+        建立一个星火连接并发送本轮请求
+        :param admission: 已申请的配额；对冲请求不传，没有空闲配额时不发出
+        :return: 是否已发出
+        """
+        if admission is None:
+            try:
+                admission = get_quota("spark", self.APPID).acquire(timeout=0)
+            except QuotaExceeded:
+                return False
+        ws = websocket.WebSocketApp(
+            self.create_url(),
+            on_message=self.on_message,
+            on_error=self.on_error,
+            on_close=self.on_close,
+            on_open=self.on_open
+        )
+        
+        def run_websocket():
+            try:
+                ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
+            except Exception as e:
+                print(f"WebSocket运行异常: {e}")
+            # 连接结束时还没有收到回复，记为失败
+            if self._winner is None:
+                self._attempt_failed(ws)
+        
+        with self._attempt_lock:
+            self._attempts[ws] = [time.perf_counter(), None, admission]
+        if self.ws is None:
+            self.ws = ws
+        # 在长任务线程中运行WebSocket连接（结束时等待其退出，长时间运行不遗留连接）
+        self._attempts[ws][1] = submit_long(run_websocket, name="spark-ws")
+        return True
+
+    def _claim(self, ws):
+        """
+        第一个收到回复的连接生效，关闭其余连接
+        :return: 该连接是否为生效的连接
+        """
+        with self._attempt_lock:
+            if self._winner is None:
+                self._winner = ws
+                self.ws = ws
+                self.hedge.record(time.perf_counter() - self._attempts[ws][0])
+                if len(self._attempts) > 1:
+                    self.hedge.on_win(ws is not next(iter(self._attempts)))
+                losers = [(other, entry[2]) for other, entry in self._attempts.items() if other is not ws]
+            else:
+                return self._winner is ws
+        self.breaker.on_success()
+        # 关闭连接可能要等待关闭握手，放到工作线程中，不阻塞当前连接接收回复
+        for other, admission in losers:
+            admission.release()
+            submit_or_run(other.close, name="spark-hedge-close")
+        return True
+
+    def _attempt_failed(self, ws):
+        """
+        记录一个尚未收到回复的连接失败（可以重复调用）
+        """
+        with self._attempt_lock:
+            if ws in self._attempts:
+                self._failed.add(ws)
+
+    def _close_attempts(self):
+        """
+        关闭本轮的所有连接，等待运行任务退出并归还配额
+        对冲中落后的连接已经关闭，不再等待（卡住的连接由其自身的超时结束）
+        """
+        attempts, self._attempts = self._attempts, {}
+        for ws in attempts:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        for ws, (_, future, admission) in attempts.items():
+            if self._winner is None or ws is self._winner:
+                wait_done(future, 2)
+            admission.release()
+
+    def _trim_history(self):
+        """
+        按 max_history 丢弃最早的消息，保证历史从用户消息开始
+        """
+        if self.max_history <= 0 or len(self.conversation_history) <= self.max_history:
+            return
+        history = self.conversation_history[-self.max_history:]
+        while history and history[0]["role"] != "user":
+            history.pop(0)
+        self.conversation_history = history
 
     def _initialize_tts_api(self):
         """
@@ -204,13 +322,23 @@ class SparkAPI:
         """
         WebSocket报错处理
         """
+        if self._winner is not None and ws is not self._winner:
+            return
         print(f"星火大模型连接错误: {error}")
-        self.done = True
+        if ws is self._winner:
+            self.done = True
+        else:
+            self._attempt_failed(ws)
 
     def on_close(self, ws, close_status_code, close_reason):
         """
         WebSocket关闭处理
         """
+        if ws is not self._winner:
+            # 尚未收到回复的连接关闭记为失败，对冲中落后的连接是主动关闭的
+            if self._winner is None:
+                self._attempt_failed(ws)
+            return
         print(f"星火大模型连接关闭: {close_status_code}, {close_reason}")
         # 如果连接异常关闭且没有完成对话，标记为已完成并设置一个错误消息
         if not self.done:
@@ -221,19 +349,13 @@ class SparkAPI:
 
     def on_open(self, ws):
         """
-        WebSocket连接建立处理
+        WebSocket连接建立处理：在连接线程中直接发送请求，不依赖工作线程池
         """
-        def run(*args):
-            """
-            WebSocket运行线程
-            """
-            # 发送请求
-            try:
-                ws.send(json.dumps(self.payload))
-            except Exception as e:
-                print(f"发送请求失败: {e}")
-                self.done = True
-        thread.start_new_thread(run, ())
+        try:
+            ws.send(dumps(self.payload))
+        except Exception as e:
+            print(f"发送请求失败: {e}")
+            self.done = True
 
     def reset_conversation(self):
         """
@@ -242,13 +364,26 @@ class SparkAPI:
         self.conversation_history = []
         print("对话历史已重置")
 
-    def chat(self, query, on_tts_complete=None):
+    def end_session(self):
+        """
+        会话结束：取消本会话还在排队的请求
+        :return: 取消的请求数
+        """
+        return self.scheduler.cancel_session(self.session)
+
+    def chat(self, query, on_tts_complete=None, priority=None):
         """
         发送消息并获取回复
         :param query: 用户问题
         :param on_tts_complete: TTS播放完成时的回调函数
+        :param priority: 本次请求的优先级，默认使用实例的优先级
         :return: 大模型的回复文本
         """
+        record_mark(MARK_LLM_REQUEST)
+        # 配置热加载后使用新的提示词、模型版本等设置
+        settings = get_settings()
+        if settings is not self.settings:
+            self._apply_settings(settings)
         # 重置状态
         self.current_response = ""
         self.done = False
@@ -263,47 +398,79 @@ class SparkAPI:
         # 准备请求参数
         self.payload = self._generate_payload(query)
         
-        # 创建WebSocket连接
-        url = self.create_url()
-        self.ws = websocket.WebSocketApp(
-            url,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-            on_open=self.on_open
-        )
+        # 熔断期间不发出请求，直接返回提示
+        if not self.breaker.allow():
+            print("\n星火大模型连续出错，暂停请求，稍后自动重试")
+            self.conversation_history.pop()
+            self.current_response = "抱歉，星火大模型暂时不可用，请稍后再试。"
+            if on_tts_complete:
+                on_tts_complete()
+            return self.current_response
+        
+        # 先在调度器排队拿到名额，再申请星火配额；排队超时时直接返回提示，不发出注定被流控的请求
+        ticket = None
+        try:
+            ticket = self.scheduler.acquire(self.session, self.priority if priority is None else priority)
+            admission = get_quota("spark", self.APPID).acquire()
+        except (QuotaExceeded, RequestCancelled) as e:
+            print(f"\n{e}")
+            if ticket is not None:
+                ticket.release()
+            self.conversation_history.pop()
+            # 会话已结束时没有人在等待回复
+            self.current_response = "" if isinstance(e, RequestCancelled) else "抱歉，当前请求太多，请稍后再试。"
+            if on_tts_complete:
+                on_tts_complete()
+            return self.current_response
         
         print(f"\n用户: {query}")
         print("\n星火: ", end="", flush=True)
         
-        # 定义一个函数来运行WebSocket连接
-        def run_websocket():
-            try:
-                self.ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
-            except Exception as e:
-                print(f"WebSocket运行异常: {e}")
-                self.done = True
-        
-        # 启动WebSocket连接
-        ws_thread = thread.start_new_thread(run_websocket, ())
-        
-        # 等待回复完成
-        timeout_counter = 0
-        max_timeout = 300  # 30秒超时
-        while not self.done:
-            time.sleep(0.1)
-            timeout_counter += 1
-            if timeout_counter >= max_timeout:
-                print("\n等待星火大模型响应超时，可能网络连接有问题")
-                self.done = True
-                break
-        
-        # 如果没有收到任何回复，但标记为完成了（可能是连接错误）
-        if not self.current_response and self.done:
-            self.current_response = "抱歉，星火大模型连接出现问题，无法获取回复。"
-            # 移除刚才添加的对话，因为没有得到回复
-            if self.conversation_history and self.conversation_history[-1]["role"] == "user":
-                self.conversation_history.pop()
+        try:
+            # 创建WebSocket连接
+            self.ws = None
+            self._winner = None
+            self._failed = set()
+            self._start_attempt(admission)
+            started = time.perf_counter()
+            hedge_delay = self.hedge.delay()
+            hedged = not (self.hedge.enabled and self.breaker.closed)
+            
+            # 等待回复完成
+            max_timeout = 30  # 30秒超时
+            while not self.done:
+                time.sleep(0.02)
+                if self._winner is None:
+                    all_failed = len(self._failed) >= len(self._attempts)
+                    # 首个token超过对冲等待时间仍未到达（或连接已失败）时，再发出一个相同的请求
+                    if not hedged and (all_failed or time.perf_counter() - started >= hedge_delay):
+                        hedged = True
+                        if self._start_attempt():
+                            self.hedge.on_hedge()
+                            continue
+                    if all_failed:
+                        self.done = True
+                        break
+                if time.perf_counter() - started >= max_timeout:
+                    print("\n等待星火大模型响应超时，可能网络连接有问题")
+                    self.done = True
+                    break
+            
+            # 没有任何连接收到回复时记为一次失败，连续失败后熔断
+            if self._winner is None:
+                self.breaker.on_failure()
+            
+            # 如果没有收到任何回复，但标记为完成了（可能是连接错误）
+            if not self.current_response and self.done:
+                self.current_response = "抱歉，星火大模型连接出现问题，无法获取回复。"
+                # 移除刚才添加的对话，因为没有得到回复
+                if self.conversation_history and self.conversation_history[-1]["role"] == "user":
+                    self.conversation_history.pop()
+        finally:
+            # 回复已经完整（或出错），关闭连接并归还配额和调度名额，语音合成和播放期间其他会话的请求可以继续
+            self._close_attempts()
+            admission.release()
+            ticket.release()
         
         # 生成语音（如果TTS已初始化）- 保持同步调用
         if self.tts_initialized and self.current_response:
@@ -333,12 +500,6 @@ class SparkAPI:
             # 如果没有TTS或没有响应内容，也调用回调函数
             if on_tts_complete:
                 on_tts_complete()
-        
-        # 确保WebSocket已关闭
-        try:
-            self.ws.close()
-        except:
-            pass
                 
         return self.current_response
 
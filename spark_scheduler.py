@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 星火请求调度：多个会话共用一个部署时，SparkAPI.chat 先在这里排队，拿到名额后才建立连接
+# - 同时进行的请求数不超过星火配额的并发连接数，多出的请求在进程内排队，不去服务端碰流控
+# - 优先级: 交互式语音对话优先于后台任务（摘要、批量问答等），有交互请求排队时后台请求不会被放行
+# - 会话公平: 同一优先级内按会话轮流放行，某个会话一次提交一批长问题时不会让其他会话的短问题一直排在后面
+# - 会话结束时调用 cancel_session 取消该会话还在排队的请求，已放行的请求不受影响
+# - 统计每个优先级的排队等待和服务时间分布（P50/P95/P99）
+# 名额只在星火回复期间占用，语音合成和播放时已归还
+#
+# 环境变量:
+#   SPARK_SCHEDULER: fair（默认，按优先级和会话轮流放行）/ fifo（按到达顺序）/ off（不排队，只受配额控制）
+#   SPARK_MAX_IN_FLIGHT: 同时进行的星火请求数上限，默认等于星火配额的并发连接数（QUOTA_SPARK_CONCURRENCY）
+#   SPARK_QUEUE_MAX_WAIT_MS: 最长排队时间（毫秒），超时返回提示，默认10000
+#   SPARK_QUEUE_MAX: 最多排队的请求数，超过时直接拒绝，默认64
+#
+# 多会话模拟（本地替身，对比按到达顺序和公平调度）: python spark_scheduler.py
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from event_log import log, INFO, WARNING
+from quota import get_quota, QuotaExceeded, RequestCancelled, DEFAULT_LIMITS
+from settings import get_settings
+
+# 优先级（数值越小越先放行）
+PRIORITY_INTERACTIVE = 0  # 用户正在等待的语音对话
+PRIORITY_BACKGROUND = 1  # 后台任务
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "交互", PRIORITY_BACKGROUND: "后台"}
+
+FAIR = "fair"
+FIFO = "fifo"
+OFF = "off"
+
+
+class QueueTimeout(QuotaExceeded):
+    """
+    排队超时或队列已满（按配额超限处理）
+    """
+    pass
+
+
+def _percentiles(values):
+    """
+    排队和服务时间的分位数摘要
+    """
+    if not values:
+        return "无样本"
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+    return f"P50 {pick(50):.0f} / P95 {pick(95):.0f} / P99 {pick(99):.0f} 毫秒"
+
+
+class Ticket:
+    """
+    一次调度名额，星火回复结束时调用 release()（也可以用 with 语句）
+    """
+    def __init__(self, scheduler, session, priority):
+        self._scheduler = scheduler
+        self.session = session
+        self.priority = priority
+        self.submitted = time.monotonic()
+        self.granted = None
+        self.cancelled = False
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            if self.granted is not None:
+                self._scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class SparkScheduler:
+    """
+    星火请求的优先级和会话公平调度
+    """
+    def __init__(self, name, max_in_flight, mode=FAIR, max_wait=10.0, max_queue=64, window=1000):
+        """
+        :param name: 名称，例如 spark
+        :param max_in_flight: 同时进行的请求数上限
+        :param mode: fair / fifo
+        :param max_wait: 默认最长排队时间（秒）
+        :param max_queue: 最多排队的请求数
+        :param window: 每个优先级保留的统计样本数
+        """
+        self.name = name
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.mode = mode
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        # 每个优先级一个 {会话: 排队请求} 的有序字典，队首会话放行一个请求后移到队尾，实现轮流放行
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self.in_flight = 0
+        self.waiting = 0
+
+        # 统计
+        self.granted = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.peak_waiting = 0
+        self.wait_samples = {priority: deque(maxlen=window) for priority in PRIORITY_NAMES}
+        self.service_samples = {priority: deque(maxlen=window) for priority in PRIORITY_NAMES}
+
+    def acquire(self, session, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        申请一个名额，必要时排队
+        :param session: 会话标识，同一优先级内按会话轮流放行
+        :param priority: PRIORITY_INTERACTIVE / PRIORITY_BACKGROUND
+        :param timeout: 最长排队时间（秒），None使用默认值
+        :return: Ticket
+        :raises QueueTimeout: 队列已满或排队超时
+        :raises RequestCancelled: 排队期间会话结束
+        """
+        if priority not in self._queues:
+            priority = PRIORITY_BACKGROUND
+        timeout = self.max_wait if timeout is None else timeout
+        ticket = Ticket(self, session, priority)
+        deadline = ticket.submitted + timeout
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                self._reject(f"排队请求已达上限 {self.max_queue}")
+            # 按到达顺序时所有请求排在同一个队列中
+            key, level = (session, priority) if self.mode == FAIR else (None, PRIORITY_INTERACTIVE)
+            self._queues[level].setdefault(key, deque()).append(ticket)
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            self._dispatch()
+            while ticket.granted is None:
+                if ticket.cancelled:
+                    raise RequestCancelled(f"会话 {session} 已结束，取消排队中的{self.name}请求")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(ticket, level, key)
+                    self._reject(f"排队超过 {timeout:.1f} 秒")
+                self._cond.wait(remaining)
+        return ticket
+
+    def _next(self):
+        # 调用方已持有锁：取最高优先级中队首会话的第一个请求，该会话移到队尾
+        for queues in self._queues.values():
+            if queues:
+                key, tickets = next(iter(queues.items()))
+                ticket = tickets.popleft()
+                del queues[key]
+                if tickets:
+                    queues[key] = tickets
+                return ticket
+        return None
+
+    def _dispatch(self):
+        # 调用方已持有锁：有空闲名额时按顺序放行
+        granted = False
+        while self.in_flight < self.max_in_flight:
+            ticket = self._next()
+            if ticket is None:
+                break
+            ticket.granted = time.monotonic()
+            self.in_flight += 1
+            self.waiting -= 1
+            self.granted += 1
+            self.wait_samples[ticket.priority].append(ticket.granted - ticket.submitted)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _remove(self, ticket, level, key):
+        # 调用方已持有锁：把超时的请求移出队列
+        tickets = self._queues[level].get(key)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[level][key]
+            self.waiting -= 1
+
+    def _reject(self, reason):
+        # 调用方已持有锁
+        self.rejected += 1
+        log(WARNING, "scheduler.reject", f"{self.name} 请求被拒绝: {reason}", console=False)
+        raise QueueTimeout(f"{self.name} 请求过多，{reason}")
+
+    def _release(self, ticket):
+        with self._cond:
+            self.in_flight -= 1
+            self.service_samples[ticket.priority].append(time.monotonic() - ticket.granted)
+            self._dispatch()
+
+    def cancel_session(self, session):
+        """
+        会话结束时取消该会话所有排队中的请求（排队的调用抛出 RequestCancelled）
+        :param session: 会话标识
+        :return: 取消的请求数
+        """
+        count = 0
+        with self._cond:
+            for queues in self._queues.values():
+                for key in list(queues):
+                    tickets = queues[key]
+                    for ticket in [t for t in tickets if t.session == session]:
+                        tickets.remove(ticket)
+                        ticket.cancelled = True
+                        count += 1
+                    if not tickets:
+                        del queues[key]
+            if count:
+                self.waiting -= count
+                self.cancelled += count
+                self._cond.notify_all()
+        if count:
+            log(INFO, "scheduler.cancel", f"会话 {session} 结束，取消 {count} 个排队中的{self.name}请求", console=False)
+        return count
+
+    def stats(self):
+        """
+        获取统计数据
+        """
+        with self._cond:
+            return {
+                "mode": self.mode,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "peak_waiting": self.peak_waiting,
+                "granted": self.granted,
+                "cancelled": self.cancelled,
+                "rejected": self.rejected,
+                "wait": {PRIORITY_NAMES[p]: list(s) for p, s in self.wait_samples.items()},
+                "service": {PRIORITY_NAMES[p]: list(s) for p, s in self.service_samples.items()}
+            }
+
+    def report(self):
+        """
+        生成统计摘要：总体一行，每个优先级一行排队等待和服务时间
+        """
+        s = self.stats()
+        lines = [f"{self.name} 调度({s['mode']}): 进行中 {s['in_flight']}/{s['max_in_flight']}，排队 {s['waiting']}"
+                 f"（峰值 {s['peak_waiting']}），放行 {s['granted']}，取消 {s['cancelled']}，拒绝 {s['rejected']}"]
+        for name in PRIORITY_NAMES.values():
+            if s["wait"][name]:
+                lines.append(f"  [{name}] 排队等待 {_percentiles(s['wait'][name])}；服务时间 {_percentiles(s['service'][name])}")
+        return "\n".join(lines)
+
+
+class _Unscheduled:
+    """
+    未启用调度时使用，所有请求直接放行（仍受配额控制）
+    """
+    mode = OFF
+
+    def acquire(self, session, priority=PRIORITY_INTERACTIVE, timeout=None):
+        return Ticket(self, session, priority)
+
+    def cancel_session(self, session):
+        return 0
+
+    def report(self):
+        return ""
+
+
+_UNSCHEDULED = _Unscheduled()
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_spark_scheduler(appid=None):
+    """
+    获取某个APPID的星火请求调度器（进程内共享，与配额控制一样按APPID区分）
+    :param appid: APPID，默认读取环境变量
+    :return: SparkScheduler
+    """
+    settings = get_settings()
+    mode = settings.spark_scheduler
+    if mode == OFF:
+        return _UNSCHEDULED
+    appid = appid or settings.appid or ""
+    scheduler = _schedulers.get(appid)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(appid)
+            if scheduler is None:
+                # 默认与配额的并发连接数一致，配额控制关闭时按星火的默认限制
+                limit = settings.spark_max_in_flight
+                if limit is None:
+                    limit = getattr(get_quota("spark", appid), "concurrency", DEFAULT_LIMITS["spark"][1])
+                scheduler = SparkScheduler("spark", limit, mode=mode,
+                                           max_wait=settings.spark_queue_max_wait_ms / 1000,
+                                           max_queue=settings.spark_queue_max)
+                _schedulers[appid] = scheduler
+    return scheduler
+
+
+def scheduler_report():
+    """
+    所有已创建的调度器的统计摘要
+    """
+    return "\n".join(scheduler.report() for scheduler in list(_schedulers.values()))
+
+
+# 多会话模拟：几个交互会话逐轮提问短问题，同时两个后台会话各一次提交一批长问题，
+# 比较按到达顺序和公平调度时交互对话每轮的耗时，并在中途结束一个后台会话
+if __name__ == "__main__":
+    import argparse
+    import importlib.util
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="星火请求调度多会话模拟")
+    parser.add_argument("--interactive", type=int, default=4, help="交互会话数")
+    parser.add_argument("--turns", type=int, default=6, help="每个交互会话的轮数")
+    parser.add_argument("--background", type=int, default=2, help="后台会话数")
+    parser.add_argument("--batch", type=int, default=8, help="每个后台会话一次提交的请求数")
+    parser.add_argument("--concurrency", type=int, default=2, help="星火并发连接数（配额）")
+    parser.add_argument("--short", type=float, default=0.15, help="短问题的服务时间（秒）")
+    parser.add_argument("--long", type=float, default=1.0, help="长问题的服务时间（秒）")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("websocket") is None:
+        print("需要安装 websocket-client: pip install websocket-client")
+        sys.exit(1)
+
+    from xf_standin import StandInServer, spark_handler
+
+    lock = threading.Lock()
+    server_state = {"active": 0, "peak": 0}
+
+    def handler(conn, path):
+        # 按问题长度模拟生成耗时，同时记录服务端的峰值并发
+        with lock:
+            server_state["active"] += 1
+            server_state["peak"] = max(server_state["peak"], server_state["active"])
+        try:
+            message = conn.recv()
+            if message is None:
+                return
+            query = json.loads(message)["payload"]["message"]["text"][-1]["content"]
+            time.sleep(args.long if query.startswith("详细") else args.short)
+            conn.recv = lambda: message  # 请求已经读取，spark_handler 再读取时直接返回
+            spark_handler(conn, path)
+        finally:
+            with lock:
+                server_state["active"] -= 1
+
+    server = StandInServer(handler).start()
+    from settings import override_settings
+    override_settings({"APPID": "sched", "API_KEY": "bench", "API_SECRET": "bench", "HEDGE_ENABLED": "0",
+                       "QUOTA_SPARK_QPS": "100", "QUOTA_SPARK_CONCURRENCY": str(args.concurrency),
+                       "SPARK_BASE_URL": server.url("/v1.1/chat")})
+
+    from spark_api import SparkAPI
+
+    def simulate(mode):
+        scheduler = SparkScheduler("spark", args.concurrency, mode=mode, max_wait=60, max_queue=256)
+        server_state.update(active=0, peak=0)
+        turn_times = []
+        results = {"background": 0, "cancelled": 0}
+
+        def interactive(index):
+            client = SparkAPI(session=f"user-{index}", scheduler=scheduler, init_tts=False)
+            time.sleep(0.05 * index)
+            for _ in range(args.turns):
+                start = time.perf_counter()
+                client.chat("今天天气怎么样")
+                with lock:
+                    turn_times.append(time.perf_counter() - start)
+                client.reset_conversation()
+                time.sleep(0.1)
+
+        def background(index, position):
+            client = SparkAPI(session=f"batch-{index}", priority=PRIORITY_BACKGROUND, scheduler=scheduler, init_tts=False)
+            # 会话结束被取消时 chat 返回空回复
+            if client.chat(f"详细总结第 {position} 份文档"):
+                with lock:
+                    results["background"] += 1
+
+        threads = [threading.Thread(target=background, args=(b, n))
+                   for b in range(args.background) for n in range(args.batch)]
+        threads += [threading.Thread(target=interactive, args=(i,)) for i in range(args.interactive)]
+        devnull = open(os.devnull, "w")
+        stdout, sys.stdout = sys.stdout, devnull
+        start = time.perf_counter()
+        try:
+            for t in threads:
+                t.start()
+            # 一段时间后第一个后台会话结束，取消其排队中的请求
+            time.sleep(args.long * 2)
+            results["cancelled"] = scheduler.cancel_session("batch-0")
+            for t in threads:
+                t.join()
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+        elapsed = time.perf_counter() - start
+        label = "公平调度" if mode == FAIR else "到达顺序"
+        print(f"[{label}] 交互对话每轮 {_percentiles(turn_times)}；后台完成 {results['background']}，"
+              f"会话结束取消 {results['cancelled']}；服务端峰值并发 {server_state['peak']}，总耗时 {elapsed:.1f} 秒")
+        print(scheduler.report())
+        assert server_state["peak"] <= args.concurrency
+
+    print(f"{args.interactive} 个交互会话 x {args.turns} 轮短问题（{args.short * 1000:.0f} 毫秒），"
+          f"{args.background} 个后台会话 x {args.batch} 个长问题（{args.long * 1000:.0f} 毫秒），并发上限 {args.concurrency}")
+    for mode in (FIFO, FAIR):
+        simulate(mode)
+    server.stop()
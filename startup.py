@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 启动管理模块：只加载一次配置、在后台线程预热重量级依赖、统计启动各阶段耗时
+#
+# 用法示例:
+#   from startup import load_config, startup_timer, warm_up
+#   load_config()
+#   warm_up(["websocket", "numpy"])
+#   startup_timer.mark("模型加载")
+#   startup_timer.report()
+
+import importlib
+import threading
+import time
+
+# 以本模块首次导入的时刻作为启动起点
+_start_time = time.perf_counter()
+_config_loaded = False
+_config_lock = threading.Lock()
+
+
+def load_config():
+    """
+    加载.env配置，整个进程只加载一次
+    .env中的值覆盖系统环境变量（与原先的 load_dotenv(override=True) 一致）
+    """
+    global _config_loaded
+    with _config_lock:
+        if _config_loaded:
+            return
+        import dotenv
+        dotenv.load_dotenv(override=True)
+        _config_loaded = True
+    startup_timer.mark("加载配置")
+
+
+class StartupTimer:
+    """
+    启动耗时统计：记录顺序阶段和后台预热任务的耗时
+    """
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.last_time = start_time
+        self.stages = []  # [(阶段名称, 耗时秒), ...]
+        self.background = []  # [(任务名称, 耗时秒, 是否成功), ...]
+        self.lock = threading.Lock()
+
+    def mark(self, name):
+        """
+        记录一个顺序阶段的结束，耗时为距上一阶段结束的时间
+        :param name: 阶段名称
+        """
+        now = time.perf_counter()
+        with self.lock:
+            self.stages.append((name, now - self.last_time))
+            self.last_time = now
+
+    def add_background(self, name, elapsed, ok=True):
+        """
+        记录一个后台任务的耗时
+        """
+        with self.lock:
+            self.background.append((name, elapsed, ok))
+
+    def elapsed(self):
+        """
+        距启动起点的总耗时（秒）
+        """
+        return time.perf_counter() - self.start_time
+
+    def report(self, title="启动耗时"):
+        """
+        打印启动耗时明细
+        """
+        with self.lock:
+            stages = list(self.stages)
+            background = list(self.background)
+        print(f"==== {title}: {self.elapsed() * 1000:.0f} 毫秒 ====")
+        for name, elapsed in stages:
+            print(f"  {name}: {elapsed * 1000:.0f} 毫秒")
+        for name, elapsed, ok in background:
+            status = "" if ok else " (失败)"
+            print(f"  [后台] {name}: {elapsed * 1000:.0f} 毫秒{status}")
+
+
+startup_timer = StartupTimer(_start_time)
+
+
+def warm_up(module_names):
+    """
+    在后台线程中并行导入重量级模块，后续真正使用时直接命中模块缓存
+    :param module_names: 模块名列表
+    :return: 预热线程列表
+    """
+    threads = []
+    for name in module_names:
+        def run(name=name):
+            start = time.perf_counter()
+            try:
+                importlib.import_module(name)
+                startup_timer.add_background(f"导入 {name}", time.perf_counter() - start)
+            except Exception as e:
+                startup_timer.add_background(f"导入 {name}", time.perf_counter() - start, ok=False)
+                print(f"预热模块 {name} 失败: {e}")
+        thread = threading.Thread(target=run, name=f"warm-up-{name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def run_in_background(name, target):
+    """
+    在后台线程中执行初始化任务并记录耗时
+    :param name: 任务名称
+    :param target: 无参数的初始化函数
+    :return: 线程对象，可通过join等待完成
+    """
+    def run():
+        start = time.perf_counter()
+        ok = True
+        try:
+            target()
+        except Exception as e:
+            ok = False
+            print(f"{name} 失败: {e}")
+        startup_timer.add_background(name, time.perf_counter() - start, ok)
+
+    thread = threading.Thread(target=run, name=f"init-{name}", daemon=True)
+    thread.start()
+    return thread
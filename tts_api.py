@@ -10,29 +10,99 @@
 # pip install websocket-client python-dotenv
 
 import base64
-import hashlib
-import hmac
-import json
-import os
 import time
-import urllib.parse
 import threading
 import queue
 import subprocess
 import io
 import sys
-from datetime import datetime
-from time import mktime
-from wsgiref.handlers import format_date_time
 
 import websocket
-import dotenv
-dotenv.load_dotenv()
-dotenv.load_dotenv(override=True) 
+
+from startup import load_config
+# 导入共享的配置快照（解析一次，热加载时整体替换）
+from settings import get_settings
+# 导入JSON编解码（自动选择最快的实现，合成音频帧只解析音频以外的字段）
+from json_codec import dumps, parse_tts_frame, JSONDecodeError
+from xf_auth import get_signer
+# 导入共享工作线程池
+from worker_pool import submit_or_run, submit_long, wait_done
+# 导入合成文本预处理（去Markdown、改写读法、分段）
+from tts_text import prepare_tts_text
+# 导入分段并行度的自适应控制
+from tts_parallel import AdaptiveParallelism
+# 导入配额控制模块（合成接口的并发连接数和每秒请求数）
+from quota import get_quota, QuotaExceeded
+# 导入尾延迟保护模块（首个音频迟迟不到时发出对冲请求，连续失败时熔断）
+from hedging import get_hedge_policy, get_breaker
+# 导入本地离线合成后端和路由策略（短文本、云端变慢或失败时使用本地合成）
+from tts_backends import get_local_backend, TTSRouter
+# 导入流式重采样（PCM音频在进程内转换为输出设备采样率，不经过ffmpeg）
+from resample import StreamingResampler, output_rate
+# 导入下行编码协商和流式解码（慢速链路上改用压缩编码，在进程内解码为PCM）
+from tts_codec import get_downlink_negotiator, DownlinkStream, decoder_available, RAW, LAME, SPEEX_WB
+# 导入事件日志模块
+from event_log import log, INFO
+# 导入会话录制模块（默认关闭）
+from session_recorder import record, record_mark, KIND_TTS, MARK_TTS_REQUEST, MARK_PLAYBACK_DONE
+
+# 加载环境变量（整个进程只加载一次）
+load_config()
+
 # ====== TTS 模式设置 (在这里修改) ======
 # True = 使用超拟人TTS，False = 使用普通TTS
 USE_SUPER_TTS = False
 
+_CHUNK_END = object()  # 一段文本合成完成的标记
+
+
+class _ChunkFailed:
+    """
+    一段文本合成失败的标记
+    """
+    def __init__(self, reason, code=None, rate_limited=False):
+        self.reason = reason
+        self.code = code
+        self.rate_limited = rate_limited  # 本地配额排队超时，按流控处理
+
+
+class _SynthesisJob:
+    """
+    一段文本的合成任务，每次尝试的音频块放入独立的队列
+    一次尝试可以有多个连接（对冲请求），队列中的元素为 (连接编号, 音频字节/_CHUNK_END/_ChunkFailed)
+    """
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+        self.attempts = 0
+        self.rate_limited = 0
+        self.output = None  # 本次尝试的队列
+        self.sockets = {}  # 本次尝试的连接 {连接编号: ws}
+        self.futures = {}  # 所有连接的运行任务 {连接编号: future}
+        self.abandoned = set()  # 对冲中落后、已关闭的连接编号
+        self.next_id = 0
+        self.primary = None  # 本次尝试的第一个连接编号
+        self.running = 0  # 本次尝试中尚未结束的连接数
+        self.hedged = False
+        self.started = 0.0
+        self.local = False  # 是否使用本地合成
+        self.forwarded = 0  # 已送入播放队列的字节数（所有尝试累计）
+        self.forward_format = None  # 已送入播放队列的音频格式
+        self.skip = 0  # 本次尝试开头需要丢弃的字节数（重试时跳过已经播放的部分）
+
+    def close(self, keep=None):
+        """
+        关闭本段的连接
+        :param keep: 保留的连接编号（对冲时关闭落后的连接）
+        """
+        for sid, ws in list(self.sockets.items()):
+            if sid == keep:
+                continue
+            try:
+                ws.close()
+            except Exception:
+                pass
+
 
 class TTSApi:
     """
@@ -49,45 +119,11 @@ class TTSApi:
         """
         初始化语音合成API参数
         """
-        # 从环境变量获取讯飞API参数
-        dotenv.load_dotenv()
-        self.APPID = os.getenv("APPID")
-        self.API_KEY = os.getenv("API_KEY")
-        self.API_SECRET = os.getenv("API_SECRET")
-        self.TTS_BASE_URL = os.getenv("TTS_BASE_URL")
-        
-        # 语音合成参数
-        self.voice = os.getenv("TTS_VOICE", "xiaoyan")  # 发音人，默认为小燕
-        
-        # 安全地解析数值参数
-        try:
-            self.speed = int(os.getenv("TTS_SPEED", "50").strip())  # 语速，默认为50
-        except ValueError:
-            print(f"警告: TTS_SPEED 参数格式不正确，使用默认值 50")
-            self.speed = 50
-            
-        try:
-            self.volume = int(os.getenv("TTS_VOLUME", "70").strip())  # 音量，默认为70
-        except ValueError:
-            print(f"警告: TTS_VOLUME 参数格式不正确，使用默认值 70")
-            self.volume = 70
-            
-        try:
-            self.pitch = int(os.getenv("TTS_PITCH", "50").strip())  # 音高，默认为50
-        except ValueError:
-            print(f"警告: TTS_PITCH 参数格式不正确，使用默认值 50")
-            self.pitch = 50
-        
         # 使用全局配置
         self.use_super_tts = USE_SUPER_TTS
         
-        if self.use_super_tts:
-            # 超拟人TTS参数
-            self.TTS_BASE_URL = os.getenv("SUPER_TTS_BASE_URL")
-            self.voice_id = os.getenv("SUPER_TTS_VOICE_ID", "x4_lingxiaoli_oral")  # 默认使用灵小丽
-            if isinstance(self.speed, float) and self.speed <= 2.0:
-                # 如果速度是浮点数且在2.0以下，说明是旧的配置，转换为新格式（0-100）
-                self.speed = int(self.speed * 50)  # 转换到大约等效的范围
+        # 讯飞API参数和语音合成参数来自共享的配置快照，配置热加载后在下一次合成时更新
+        self._apply_settings(get_settings())
         
         # 播放器相关参数
         self.is_playing = False
@@ -98,51 +134,55 @@ class TTSApi:
         
         # 用于控制播放线程和ffmpeg进程
         self.ffmpeg_process = None
+        self.play_process = None
         self.playback_thread = None
         self.should_stop = threading.Event()
         self.connection_ready = False
         self.prepared_url = None
         
+        # 长回复分段合成：同时合成段数的控制（预处理开关、每段失败后的重试次数和等待音频的超时来自配置快照）
+        self.parallelism = AdaptiveParallelism()
+        # 首个音频超过近期延迟的分位数仍未到达时发出对冲请求；连续失败时熔断
+        self.hedge = get_hedge_policy("tts")
+        self.breaker = get_breaker("tts")
+        # 本地离线合成：播放流的输入格式，None为云端返回的MP3，本地合成为 (编码, 采样率, 声道数)
+        self.local_backend = get_local_backend()
+        self.router = TTSRouter(self.local_backend)
+        self.playback_format = None
+        # 云端合成的音频编码：每次合成前按各编码实际的下行速度选择
+        self.downlink = get_downlink_negotiator()
+        self.encoding = RAW
+        self.downlink_stream = None
+        self.jobs = []
+        
         # 如果需要预准备
         if prepare:
             self.prepare_connection()
+
+    def _apply_settings(self, settings):
+        """
+        使用一份配置快照（初始化时和配置热加载后的下一次合成前）
+        :param settings: Settings
+        """
+        self.settings = settings
+        self.APPID = settings.appid
+        self.API_KEY = settings.api_key
+        self.API_SECRET = settings.api_secret
+        self.TTS_BASE_URL = settings.super_tts_base_url if self.use_super_tts else settings.tts_base_url
+        self.voice = settings.tts_voice  # 发音人
+        self.voice_id = settings.super_tts_voice_id  # 超拟人发音人
+        self.speed = settings.tts_speed  # 语速
+        self.volume = settings.tts_volume  # 音量
+        self.pitch = settings.tts_pitch  # 音高
+        self.prepare_text = settings.tts_prepare_text
+        self.chunk_retries = settings.tts_chunk_retries
+        self.chunk_timeout = settings.tts_chunk_timeout
+
     def _create_url(self):
         """
-        生成WebSocket鉴权URL
+        生成WebSocket鉴权URL（签名器共享并按秒缓存）
         """
-        now = datetime.now()
-        date = format_date_time(mktime(now.timetuple()))
-        
-        # 构建签名字符串
-        host = urllib.parse.urlparse(self.TTS_BASE_URL).netloc
-        path = urllib.parse.urlparse(self.TTS_BASE_URL).path
-        
-        # 生成RFC1123格式的时间戳
-        signature_origin = f"host: {host}\n"
-        signature_origin += f"date: {date}\n"
-        signature_origin += f"GET {path} HTTP/1.1"
-        
-        # 进行hmac-sha256加密
-        signature_sha = hmac.new(
-            self.API_SECRET.encode('utf-8'),
-            signature_origin.encode('utf-8'),
-            digestmod=hashlib.sha256
-        ).digest()
-        
-        signature_sha_base64 = base64.b64encode(signature_sha).decode()
-        authorization_origin = f'api_key="{self.API_KEY}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
-        authorization = base64.b64encode(authorization_origin.encode()).decode()
-        
-        # 拼接鉴权参数
-        v = {
-            "authorization": authorization,
-            "date": date,
-            "host": host
-        }
-        
-        # 拼接URL
-        url = self.TTS_BASE_URL + '?' + urllib.parse.urlencode(v)
-        return url
+        return get_signer(self.API_KEY, self.API_SECRET, self.TTS_BASE_URL, presign=True).sign()
 
     def _create_request_parameters(self, text):
         """
@@ -154,8 +194,7 @@ class TTSApi:
             # 普通语音合成
             # 业务参数
             business_params = {
-                "aue": "lame",  # 音频编码格式，lame表示mp3格式
-                "sfl": 1,  # 是否开启流式返回
+                "aue": "speex-wb;7" if self.encoding == SPEEX_WB else self.encoding,  # 音频编码格式：raw、lame(mp3)或speex-wb
                 "auf": "audio/L16;rate=16000",  # 音频采样率
                 "vcn": self.voice,  # 发音人
                 "speed": self.speed,  # 语速
@@ -165,6 +204,9 @@ class TTSApi:
                 "tte": "UTF8"  # 文本编码格式
             }
             
+            if self.encoding == LAME:
+                business_params["sfl"] = 1  # mp3需要开启流式返回
+            
             # 构建参数
             data = {
                 "common": {
@@ -180,6 +222,7 @@ class TTSApi:
             return data
         else:
             # 超拟人TTS
+            settings = self.settings
             # 构建参数 (使用正确的超拟人结构)
             data = {
                 "header": {
@@ -188,16 +231,17 @@ class TTSApi:
                 },
                 "parameter": {
                     "oral": {  # 添加 oral 参数块
-                        "oral_level": os.getenv("SUPER_TTS_ORAL_LEVEL", "mid") 
+                        "oral_level": settings.super_tts_oral_level
                     },
                     "tts": {
-                        "vcn": os.getenv("SUPER_TTS_VOICE_ID", self.voice_id),  # 从env获取，或使用 self.voice_id
-                        "speed": float(os.getenv("SUPER_TTS_SPEED", self.speed)),  # 语速
-                        "volume": int(os.getenv("SUPER_TTS_VOLUME", self.volume)),  # 音量
-                        "pitch": int(os.getenv("SUPER_TTS_PITCH", self.pitch)),  # 音高
+                        "vcn": self.voice_id,  # 超拟人发音人
+                        # 语速、音量、音高没有单独配置时使用普通合成的设置
+                        "speed": settings.super_tts_speed if settings.super_tts_speed is not None else float(self.speed),
+                        "volume": settings.super_tts_volume if settings.super_tts_volume is not None else self.volume,
+                        "pitch": settings.super_tts_pitch if settings.super_tts_pitch is not None else self.pitch,
                         "audio": {  # 添加 audio 参数块
-                            "encoding": os.getenv("SUPER_TTS_ENCODING", "lame"),
-                            "sample_rate": int(os.getenv("SUPER_TTS_SAMPLE_RATE", 24000)),
+                            "encoding": self.encoding,
+                            "sample_rate": self._cloud_sample_rate(),
                             "channels": 1,
                             "bit_depth": 16
                         }
@@ -215,56 +259,43 @@ class TTSApi:
             
             return data
 
+    def _parse_message(self, message):
+        """
+        解析一条合成响应 (适配普通TTS和超拟人TTS)
+        :param message: 接收到的消息文本
+        :return: (错误码, 错误信息, 是否最后一帧, 音频字节)，没有错误时错误码为0、错误信息为None
+        """
+        # 音频字符串直接从消息中切出，不经过JSON解析（普通合成和超拟人合成的字段位置不同，由 parse_tts_frame 处理）
+        code, error, status, audio_data = parse_tts_frame(message)
+        if code != 0:
+            kind = "超拟人语音合成" if self.use_super_tts else "普通语音合成"
+            return code, f"{kind}错误 (Code: {code}): {error or '未知错误'}", False, None
+
+        # 解码base64音频数据，判断是否为最后一帧 (status == 2)
+        return 0, None, status == 2, base64.b64decode(audio_data) if audio_data else None
+
     def _on_message(self, ws, message):
         """
         接收WebSocket消息的回调函数 (适配普通TTS和超拟人TTS)
         :param ws: WebSocket对象
         :param message: 接收到的消息
         """
+        record(KIND_TTS, message)
         try:
-            message = json.loads(message)
-            
-            code = -1  # 初始化错误码
-            status = 1  # 初始化状态 (默认为中间帧)
-            audio_data = ""  # 初始化音频数据
-
-            if self.use_super_tts:
-                # --- 解析超拟人TTS响应 ---
-                header = message.get("header", {})
-                code = header.get("code", 0)  # 从 header 获取 code
-                status = header.get("status", 1)  # 从 header 获取 status
-                
-                if code != 0:
-                    error_message = header.get("message", "未知错误")
-                    print(f"超拟人语音合成错误 (Code: {code}): {error_message}")
-                    ws.close()  # 出错时主动关闭连接
-                    return
-                
-                # 从 payload 获取音频数据
-                payload = message.get("payload", {})
-                audio_payload = payload.get("audio", {})
-                if audio_payload:  # 确保 audio 字段存在
-                    audio_data = audio_payload.get("audio", "")
-            
-            else:
-                # --- 解析普通在线TTS v2 响应 ---
-                code = message.get("code", 0)  # 从顶级获取 code
-                
-                if code != 0:
-                    error_message = message.get("message", "未知错误")
-                    print(f"普通语音合成错误 (Code: {code}): {error_message}")
-                    ws.close()  # 出错时主动关闭连接
-                    return
-
-                data_field = message.get("data", {})
-                if data_field:  # 确保 data 字段存在
-                    status = data_field.get("status", 1)  # 从 data 获取 status
-                    audio_data = data_field.get("audio", "")  # 从 data 获取 audio
+            code, error, last, audio_bytes = self._parse_message(message)
+            if error:
+                print(error)
+                get_quota("tts", self.APPID).on_error_code(code)
+                ws.close()  # 出错时主动关闭连接
+                return
 
             # --- 通用处理 ---
-            if audio_data:
-                # 解码base64音频数据
-                audio_bytes = base64.b64decode(audio_data)
+            # 压缩编码在进程内解码为PCM（未凑满一帧时为空）
+            if audio_bytes:
+                audio_bytes = self.downlink_stream.feed(audio_bytes)
+            if last:
+                audio_bytes = (audio_bytes or b"") + self.downlink_stream.finish()
+            if audio_bytes:
                 # 将音频数据添加到队列
                 self.audio_queue.put(audio_bytes)
                 
@@ -273,13 +304,12 @@ class TTSApi:
                     print("收到第一个音频数据块，启动播放...")
                     self._start_playback()
             
-            # 判断是否为最后一帧 (status == 2)
-            if status == 2:
+            if last:
                 print("语音合成完成，已收到所有数据")
                 self.audio_done = True
                 self.audio_queue.put(None)  # 放入结束标记
         
-        except json.JSONDecodeError:
+        except JSONDecodeError:
             print(f"无法解析收到的消息")
         except Exception as e:
             print(f"处理TTS消息时发生错误: {e}")
@@ -306,18 +336,12 @@ class TTSApi:
         """
         print("语音合成连接已建立")
         
-        def send_data():
-            """
-            发送合成请求
-            """
-            try:
-                ws.send(json.dumps(self.request_data))
-            except Exception as e:
-                print(f"发送语音合成请求失败: {str(e)}")
-                ws.close()
-        
-        # 启动发送线程
-        threading.Thread(target=send_data).start()
+        # 在连接线程中直接发送合成请求，不依赖工作线程池
+        try:
+            ws.send(dumps(self.request_data))
+        except Exception as e:
+            print(f"发送语音合成请求失败: {str(e)}")
+            ws.close()
 
     def _start_playback(self):
         """
@@ -336,6 +360,11 @@ class TTSApi:
         使用ffmpeg实现流式播放的线程函数
         """
         try:
+            # PCM音频不需要解码：在进程内转换为输出设备的采样率后直接交给aplay
+            if self.playback_format is not None and sys.platform != "win32":
+                self._stream_pcm_playback()
+                return
+            
             print("启动ffmpeg播放线程")
             
             # 检查ffmpeg是否可用
@@ -355,7 +384,7 @@ class TTSApi:
             ffmpeg_cmd = [
                 "ffmpeg",
                 "-y",  # 覆盖输出文件
-                "-f", "mp3",  # 指定输入格式为MP3
+                *self._playback_input_args(),  # 输入格式：云端合成为MP3，本地合成为PCM
                 "-i", "pipe:0",  # 从标准输入读取
                 "-low_delay", "1",  # 启用低延迟模式
                 "-fflags", "nobuffer",  # 禁用输入缓冲
@@ -374,6 +403,7 @@ class TTSApi:
                     "-nodisp",  # 不显示视频窗口
                     "-autoexit",  # 播放完成后自动退出
                     "-loglevel", "quiet",  # 减少日志输出
+                    *self._playback_input_args(),
                     "-i", "pipe:0"  # 从标准输入读取
                 ]
                 
@@ -387,7 +417,7 @@ class TTSApi:
                 )
                 
                 # Windows上不需要额外的播放器进程
-                play_process = None
+                self.play_process = None
 
             else:  # Linux和其他
                 play_cmd = ["aplay", "-q"]
@@ -402,7 +432,7 @@ class TTSApi:
                 )
                 
                 # 创建播放器进程
-                play_process = subprocess.Popen(
+                self.play_process = subprocess.Popen(
                     play_cmd,
                     stdin=self.ffmpeg_process.stdout,
                     stdout=subprocess.PIPE,
@@ -414,7 +444,7 @@ class TTSApi:
                 self.ffmpeg_process.stdout.close()
             
             # 为非Windows平台创建进程
-            if play_process is not None:
+            if self.play_process is not None:
                 # 让ffmpeg将输出直接传给播放器
                 self.ffmpeg_process.stdout.close()
             
@@ -472,9 +502,9 @@ class TTSApi:
                 except Exception as e:
                     print(f"等待ffmpeg进程时出错: {e}")
 
-            if 'play_process' in locals() and play_process:
+            if self.play_process:
                 try:
-                    exit_code = play_process.wait(timeout=1)
+                    exit_code = self.play_process.wait(timeout=1)
                     print(f"播放器进程已退出，退出代码: {exit_code}")
                 except subprocess.TimeoutExpired:
                     print("等待播放器进程退出超时，将在清理资源时强制终止")
@@ -491,6 +521,47 @@ class TTSApi:
             self._cleanup_resources()
             self.is_playing = False
     
+    def _stream_pcm_playback(self):
+        """
+        PCM音频（本地合成、超拟人raw编码）的播放：按需转换采样率后直接写入aplay
+        """
+        codec, rate, channels = self.playback_format
+        out_rate = output_rate(rate)
+        resampler = StreamingResampler(rate, out_rate, channels)
+        print(f"启动PCM播放线程（{rate}Hz -> {out_rate}Hz）")
+        self.play_process = subprocess.Popen(
+            ["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-r", str(out_rate), "-c", str(channels)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0  # 设置为无缓冲
+        )
+        try:
+            while not self.should_stop.is_set():
+                try:
+                    audio_chunk = self.audio_queue.get(timeout=0.5)
+                except queue.Empty:
+                    # 队列为空但合成尚未完成，继续等待
+                    if not self.audio_done:
+                        continue
+                    break
+                if audio_chunk is None:
+                    print("收到结束标记，停止音频流")
+                    break
+                self.play_process.stdin.write(resampler.process(audio_chunk))
+            else:
+                return  # 播放被打断，剩余音频由清理流程丢弃
+            self.play_process.stdin.write(resampler.flush())
+            # 关闭输入后等待播放器播完缓冲区中的音频
+            self.play_process.stdin.close()
+            self.play_process.wait(timeout=3)
+        except BrokenPipeError:
+            print("错误: 播放管道已中断")
+        except subprocess.TimeoutExpired:
+            print("等待播放器进程退出超时，将在清理资源时强制终止")
+        except Exception as e:
+            print(f"播放过程中发生错误: {e}")
+    
     def _cleanup_resources(self):
         """
         清理所有资源
@@ -537,8 +608,38 @@ class TTSApi:
                 except Exception:
                     pass
             
+            self._close_pipes(self.ffmpeg_process)
             self.ffmpeg_process = None
             print("ffmpeg资源已清理完毕")
+
+        # 终止播放器进程（aplay），回收进程并关闭管道，长时间运行不遗留僵尸进程和文件描述符
+        if self.play_process:
+            try:
+                if self.play_process.poll() is None:
+                    self.play_process.terminate()
+                self.play_process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                try:
+                    self.play_process.kill()
+                    self.play_process.wait(timeout=0.5)
+                except Exception as e:
+                    print(f"无法终止播放器进程: {e}")
+            except Exception as e:
+                print(f"清理播放器进程时出错: {e}")
+            self._close_pipes(self.play_process)
+            self.play_process = None
+
+    @staticmethod
+    def _close_pipes(process):
+        """
+        关闭子进程的管道
+        """
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            try:
+                if pipe:
+                    pipe.close()
+            except Exception:
+                pass
     def prepare_connection(self):
         """
         预先准备TTS连接
@@ -559,6 +660,27 @@ class TTSApi:
             print("没有文本内容需要合成")
             return
         
+        # 配置热加载后使用新的发音人、语速等设置
+        settings = get_settings()
+        if settings is not self.settings:
+            self._apply_settings(settings)
+        
+        # 去掉Markdown、改写数字和符号的读法，长回复切分成多段
+        chunks = prepare_tts_text(text) if self.prepare_text else [text]
+        if not chunks:
+            print("没有可朗读的内容")
+            return
+        # 短文本或云端变慢时直接使用本地合成；云端熔断时改用本地合成，没有本地合成器时不发出请求
+        local_reason = self.router.route("".join(chunks), self.hedge.latency(50))
+        if local_reason is None and not self.breaker.allow():
+            if not self.router.can_fallback:
+                print("语音合成服务连续出错，暂停合成，稍后自动重试")
+                return
+            local_reason = "云端熔断"
+        if local_reason:
+            log(INFO, "tts.route", f"使用本地合成: {local_reason}", console=False)
+        record_mark(MARK_TTS_REQUEST)
+        
         # 停止任何正在进行的播放
         self._stop_current_playback()
         
@@ -567,15 +689,30 @@ class TTSApi:
         self.audio_done = False
         self.audio_queue = queue.Queue()
         self.should_stop.clear()
+        self.encoding = self.downlink.choose()
+        self.playback_format = self._cloud_audio_format()
+        
+        # 多段时并行合成、按顺序播放；启用对冲请求或使用本地合成时单段也走分段流程
+        if len(chunks) > 1 or self.hedge.enabled or local_reason:
+            self._speak_chunks(chunks, local=bool(local_reason))
+            return
+        
+        # 申请合成配额，排队超时时改用本地合成或放弃本次合成
+        try:
+            admission = get_quota("tts", self.APPID).acquire()
+        except QuotaExceeded as e:
+            print(f"语音合成请求被限流: {e}")
+            if self.router.can_fallback:
+                self._speak_chunks(chunks, local=True)
+            return
         
         # 创建请求参数
-        self.request_data = self._create_request_parameters(text)
+        self.request_data = self._create_request_parameters(chunks[0])
+        self.downlink_stream = DownlinkStream(self.downlink, self.encoding, self._cloud_sample_rate())
         
         # 创建WebSocket URL
-        if use_prepared and self.prepared_url:
-            ws_url = self.prepared_url
-        else:
-            ws_url = self._create_url()
+        # 签名按秒缓存且由后台预签名，直接取当前URL，避免预准备的URL因时间戳过期而鉴权失败
+        ws_url = self._create_url()
         
         # 创建WebSocket连接
         ws = websocket.WebSocketApp(
@@ -586,12 +723,11 @@ class TTSApi:
             on_open=self._on_open
         )
         
-        # 在新线程中运行WebSocket连接
-        ws_thread = threading.Thread(target=ws.run_forever)
-        ws_thread.daemon = True
-        ws_thread.start()
+        # 在长任务线程中运行WebSocket连接
+        ws_future = submit_long(ws.run_forever, name="tts-ws")
         
         # 等待播放完成
+        fallback = False  # 云端没有返回音频时改用本地合成
         try:
             # 等待音频合成和播放完成
             max_wait_time = 60  # 最大等待时间，秒
@@ -605,12 +741,17 @@ class TTSApi:
             # 如果超时
             if not self.audio_done and wait_count * wait_step >= max_wait_time:
                 print("等待语音合成完成超时")
+                self.breaker.on_failure()
+                fallback = not self.is_playing and self.router.can_fallback
+            else:
+                self.breaker.on_success()
             
             # 如果播放线程还在运行，等待其结束
             if self.playback_thread and self.playback_thread.is_alive():
                 self.playback_thread.join(timeout=2)
             
             print("语音合成和播放完成")
+            record_mark(MARK_PLAYBACK_DONE)
             
         except KeyboardInterrupt:
             print("用户中断了播放")
@@ -618,11 +759,349 @@ class TTSApi:
         except Exception as e:
             print(f"等待播放完成时出错: {e}")
             self._stop_current_playback()
+        finally:
+            # 关闭连接并等待连接任务退出
+            try:
+                ws.close()
+            except Exception:
+                pass
+            wait_done(ws_future, 2)
+            admission.release()
+        if fallback:
+            print("云端合成失败，改用本地合成")
+            self.audio_done = False
+            self.audio_queue = queue.Queue()
+            self._speak_chunks(chunks, local=True)
+
+    def _speak_chunks(self, chunks, local=False):
+        """
+        分段合成：每段使用独立的连接和缓冲区，最多K段同时合成，按顺序送入同一个播放流
+        K由 self.parallelism 根据播放等待、首包延迟和流控错误自适应调整
+        某一段失败时只重试这一段，其余段不受影响；正在播放的段重试时跳过已经播放的部分，无法对齐时从下一段继续
+        :param chunks: 文本段列表
+        :param local: 是否全部使用本地合成（某一段云端合成失败时也会单独改用本地合成）
+        """
+        if len(chunks) > 1:
+            print(f"长回复分为 {len(chunks)} 段合成，同时合成 {self.parallelism.limit} 段")
+        self.jobs = [_SynthesisJob(i, chunk) for i, chunk in enumerate(chunks)]
+        for job in self.jobs:
+            job.local = local
+        self.speak_start = time.perf_counter()
+        self.first_audio_latency = None
+        try:
+            for job in self.jobs:
+                if self.should_stop.is_set():
+                    break
+                # 当前段和之后的 K-1 段保持在合成中
+                for pending in self.jobs[job.index:job.index + self.parallelism.limit]:
+                    if pending.output is None:
+                        self._start_job(pending)
+                self._forward_job(job)
+            
+            self.audio_done = True
+            self.audio_queue.put(None)  # 放入结束标记
+            
+            # 等待播放完成
+            while self.is_playing and not self.should_stop.is_set():
+                time.sleep(0.1)
+            if self.playback_thread and self.playback_thread.is_alive():
+                self.playback_thread.join(timeout=2)
+            
+            print("语音合成和播放完成")
+            record_mark(MARK_PLAYBACK_DONE)
+            first = f"{self.first_audio_latency * 1000:.0f} 毫秒" if self.first_audio_latency is not None else "无"
+            log(INFO, "tts.chunks", f"分段合成 {len(self.jobs)} 段，首个音频 {first}；{self.parallelism.report()}")
+        
+        except KeyboardInterrupt:
+            print("用户中断了播放")
+            self._stop_current_playback()
+        finally:
+            self.audio_done = True
+            # 关闭所有段的连接并等待合成任务退出
+            for job in self.jobs:
+                job.close()
+            for job in self.jobs:
+                # 对冲中落后的连接已经关闭，不再等待（卡住的连接由其自身的超时结束）
+                for sid, future in job.futures.items():
+                    if sid not in job.abandoned:
+                        wait_done(future, 2)
+            self.jobs = []
+
+    def _start_job(self, job):
+        """
+        在共享工作线程中开始（或重新开始）合成一段
+        """
+        job.close()
+        job.attempts += 1
+        job.output = queue.Queue()
+        job.sockets = {}
+        job.running = 0
+        job.hedged = False
+        job.skip = job.forwarded
+        job.started = time.perf_counter()
+        job.primary = self._launch(job, self.chunk_timeout)
+
+    def _hedge_job(self, job):
+        """
+        首个音频迟迟未到时，为这一段再发出一个相同的请求，写入同一个队列，先收到音频的连接生效
+        对冲请求不排队等待配额，没有空闲配额时放弃
+        """
+        job.hedged = True
+        self.hedge.on_hedge()
+        self._launch(job, 0)
+
+    def _launch(self, job, quota_timeout):
+        """
+        为本次尝试新建一个连接
+        :return: 连接编号
+        """
+        sid = job.next_id
+        job.next_id += 1
+        job.running += 1
+        run = self._run_local_job if job.local else self._run_job
+        job.futures[sid] = submit_long(run, job, job.output, sid, quota_timeout, name=f"tts-chunk-{job.index}")
+        return sid
+
+    def _run_job(self, job, output, sid=0, quota_timeout=None):
+        """
+        合成一段文本，音频块、完成标记或失败原因依次放入本次尝试的队列
+        :param job: 合成任务
+        :param output: 本次尝试的队列
+        :param sid: 连接编号
+        :param quota_timeout: 等待合成配额的最长时间（秒）
+        """
+        finished = []
+        first_audio = []
+        started = time.perf_counter()
+        stream = DownlinkStream(self.downlink, self.encoding, self._cloud_sample_rate())
+
+        def finish(item):
+            # 每次尝试只放入一个结束标记
+            if not finished:
+                finished.append(item)
+                output.put((sid, item))
+
+        def on_message(ws, message):
+            record(KIND_TTS, message)
+            try:
+                code, error, last, audio_bytes = self._parse_message(message)
+            except Exception as e:
+                code, error, last, audio_bytes = None, f"处理TTS消息时发生错误: {e}", False, None
+            if error:
+                get_quota("tts", self.APPID).on_error_code(code)
+                finish(_ChunkFailed(error, code))
+                ws.close()
+                return
+            if audio_bytes and not finished:
+                if not first_audio:
+                    first_audio.append(True)
+                    self.parallelism.on_first_audio(time.perf_counter() - started)
+                    self.hedge.record(time.perf_counter() - started)
+                # 压缩编码在进程内解码为PCM（未凑满一帧时为空）
+                audio_bytes = stream.feed(audio_bytes)
+                if audio_bytes:
+                    output.put((sid, audio_bytes))
+            if last:
+                tail = stream.finish()
+                if tail and not finished:
+                    output.put((sid, tail))
+                finish(_CHUNK_END)
+                ws.close()
+
+        def on_open(ws):
+            try:
+                ws.send(dumps(self._create_request_parameters(job.text)))
+            except Exception as e:
+                finish(_ChunkFailed(f"发送语音合成请求失败: {e}"))
+                ws.close()
+
+        try:
+            admission = get_quota("tts", self.APPID).acquire(timeout=quota_timeout)
+        except QuotaExceeded as e:
+            finish(_ChunkFailed(str(e), rate_limited=True))
+            return
+        try:
+            ws = websocket.WebSocketApp(
+                self._create_url(),
+                on_message=on_message,
+                on_error=lambda ws, error: finish(_ChunkFailed(f"语音合成连接错误: {error}")),
+                on_close=lambda ws, code, msg: finish(_ChunkFailed("连接在合成完成前关闭")),
+                on_open=on_open
+            )
+            job.sockets[sid] = ws
+            # 等待配额期间已被对冲中的另一个连接取代
+            if sid not in job.abandoned:
+                ws.run_forever()
+        finally:
+            admission.release()
+        finish(_ChunkFailed("连接已结束"))
+
+    def _run_local_job(self, job, output, sid=0, quota_timeout=None):
+        """
+        用本地离线引擎合成一段文本，PCM音频块、完成标记或失败原因依次放入本次尝试的队列
+        参数与 _run_job 相同（本地合成不占用云端配额）
+        """
+        try:
+            self.local_backend.synthesize(job.text, lambda data: output.put((sid, data)), self.should_stop)
+            output.put((sid, _CHUNK_END))
+        except Exception as e:
+            output.put((sid, _ChunkFailed(f"本地语音合成失败: {e}")))
+
+    def _switch_playback_format(self, playback_format):
+        """
+        播放流的输入格式与本段不同时（云端MP3与本地PCM），等当前的播放结束后按新格式重新启动播放
+        :param playback_format: None为MP3，或 (编码, 采样率, 声道数)
+        """
+        if playback_format == self.playback_format:
+            return
+        if self.is_playing:
+            self.audio_queue.put(None)
+            if self.playback_thread and self.playback_thread.is_alive():
+                self.playback_thread.join()
+            self.audio_queue = queue.Queue()
+            self.is_playing = False
+        self.playback_format = playback_format
+
+    def _cloud_sample_rate(self):
+        """
+        云端合成音频的采样率：普通合成固定为16000，超拟人合成按配置（speex-wb只支持16000）
+        """
+        if not self.use_super_tts or self.encoding == SPEEX_WB:
+            return 16000
+        return self.settings.super_tts_sample_rate
+
+    def _cloud_audio_format(self):
+        """
+        云端合成音频的格式：raw编码和可以在进程内解码的压缩编码为PCM，否则为MP3（交给ffmpeg解码）
+        :return: None为MP3，或 (编码, 采样率, 声道数)
+        """
+        if self.encoding == RAW or decoder_available(self.encoding):
+            return ("s16le", self._cloud_sample_rate(), 1)
+        return None
+
+    def _playback_input_args(self):
+        """
+        播放器的输入格式参数
+        """
+        if self.playback_format is None:
+            return ["-f", "mp3"]
+        codec, rate, channels = self.playback_format
+        return ["-f", codec, "-ar", str(rate), "-ac", str(channels)]
+
+    def _forward_job(self, job):
+        """
+        把一段的音频按到达顺序送入播放队列，失败时重试这一段
+        首个音频超过对冲等待时间仍未到达时发出对冲请求，先收到音频的连接生效
+        重试的音频与已经播放的部分按字节对齐，丢弃已播放的字节后继续；改用本地合成等无法对齐时不重播，从下一段继续
+        :return: 这一段是否合成成功
+        """
+        starved = 0.0  # 播放等待本段音频的累计时长
+        winner = None  # 本次尝试中生效的连接编号
+        while not self.should_stop.is_set():
+            wait_start = time.perf_counter()
+            timeout = self.chunk_timeout
+            hedge_due = (winner is None and not job.local and not job.hedged
+                         and self.hedge.enabled and self.breaker.closed)
+            if hedge_due:
+                timeout = min(timeout, max(0.0, job.started + self.hedge.delay() - wait_start))
+            try:
+                sid, item = job.output.get(timeout=timeout)
+            except queue.Empty:
+                if hedge_due:
+                    self._hedge_job(job)
+                    continue
+                sid, item = None, _ChunkFailed(f"{self.chunk_timeout:.0f}秒内没有收到音频")
+            
+            # 对冲中落后的连接
+            if winner is not None and sid != winner:
+                continue
+            if item is _CHUNK_END:
+                self.parallelism.on_starved(starved)
+                job.close()
+                return True
+            if isinstance(item, _ChunkFailed):
+                if sid is not None:
+                    job.running -= 1
+                    # 同一次尝试的另一个连接还在合成，等待它的结果
+                    if winner is None and job.running > 0:
+                        continue
+                rate_limited = item.rate_limited or self.parallelism.is_rate_limit(item.code)
+                # 已经收到音频的连接中途失败时，这次请求已记为成功，不再计入熔断
+                if not rate_limited and not job.local and winner is None:
+                    self.breaker.on_failure()
+                winner = None
+                if rate_limited and job.rate_limited < 3:
+                    # 流控（服务端错误码或本地配额排队超时）：减少并行段数，稍等后重试，不计入失败重试次数
+                    job.rate_limited += 1
+                    job.attempts -= 1
+                    self.parallelism.on_rate_limited(item.code if item.code is not None else "本地配额")
+                    print(f"第 {job.index + 1} 段语音合成被流控，稍后重试")
+                    time.sleep(0.2 * job.rate_limited)
+                    self._start_job(job)
+                    continue
+                if job.attempts > self.chunk_retries or (not job.local and not self.breaker.closed):
+                    if job.forwarded:
+                        # 本段已经播放了一部分，本地合成的音频无法与之对齐（格式也可能不同），不重播，从下一段继续
+                        print(f"第 {job.index + 1} 段语音合成中断，从下一段继续: {item.reason}")
+                        job.close()
+                        return False
+                    if not job.local and self.router.can_fallback:
+                        print(f"第 {job.index + 1} 段云端合成失败，改用本地合成: {item.reason}")
+                        job.local = True
+                        job.attempts = 0
+                        self._start_job(job)
+                        continue
+                    print(f"第 {job.index + 1} 段语音合成失败，跳过: {item.reason}")
+                    job.close()
+                    return False
+                print(f"第 {job.index + 1} 段语音合成失败，重试: {item.reason}")
+                self._start_job(job)
+                continue
+            
+            if winner is None:
+                # 第一个收到音频的连接生效，关闭其余连接
+                winner = sid
+                if not job.local:
+                    self.breaker.on_success()
+                playback_format = self.local_backend.audio_format() if job.local else self._cloud_audio_format()
+                if job.forwarded and playback_format != job.forward_format:
+                    # 重试的音频格式与已经播放的部分不同，无法按字节对齐，从下一段继续
+                    print(f"第 {job.index + 1} 段重试的音频格式已变化，从下一段继续")
+                    job.close()
+                    return False
+                self._switch_playback_format(playback_format)
+                job.forward_format = playback_format
+                if job.hedged:
+                    self.hedge.on_win(sid != job.primary)
+                    job.abandoned.update(other for other in job.futures if other != sid)
+                    # 关闭连接可能要等待关闭握手，放到工作线程中
+                    submit_or_run(job.close, sid, name="tts-hedge-close")
+            # 播放队列已空、播放在等待合成（段与段之间或合成慢于播放）
+            if self.is_playing and self.audio_queue.empty():
+                starved += time.perf_counter() - wait_start
+            # 重试时丢弃已经送入播放队列的部分，从中断处继续
+            if job.skip:
+                dropped = min(job.skip, len(item))
+                job.skip -= dropped
+                item = item[dropped:]
+                if not item:
+                    continue
+            if self.first_audio_latency is None:
+                self.first_audio_latency = time.perf_counter() - self.speak_start
+            job.forwarded += len(item)
+            self.audio_queue.put(item)
+            # 如果尚未开始播放，启动播放线程
+            if not self.is_playing:
+                print("收到第一个音频数据块，启动播放...")
+                self._start_playback()
+        return False
 
     def _stop_current_playback(self):
         """
         停止当前正在进行的播放
         """
+        for job in self.jobs:
+            job.close()
         if self.is_playing:
             print("停止当前播放...")
             self.should_stop.set()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 可插拔的语音合成后端：讯飞云端合成（TTSApi内置） + 本地离线合成
+#
+# 本地合成使用命令行合成器（默认自动查找 espeak-ng / espeak，也可以配置 piper 等），文本从标准输入写入，
+# 音频从标准输出读取（WAV，或配置 TTS_LOCAL_RAW_RATE 后为16位PCM）。
+# 始终预先启动一个等待输入的合成进程，需要合成时直接写入文本，省去进程启动和模型加载的时间，用完后再预启动下一个。
+#
+# 路由策略（TTSRouter）:
+#   - auto模式下短文本（唤醒应答、本地命令的确认等，不超过 TTS_LOCAL_MAX_CHARS 字）使用本地合成，不走网络往返
+#   - auto模式下云端近期首包延迟的中位数超过 TTS_LOCAL_SLOW_MS 时，不超过 TTS_LOCAL_SLOW_MAX_CHARS 字的文本也使用本地合成
+#   - 云端熔断或某一段云端合成失败时改用本地合成，不再静默
+#
+# 环境变量:
+#   TTS_LOCAL_MODE: off=不使用本地合成, fallback=只在云端失败时使用（默认）, auto=按上述策略, always=总是本地合成
+#   TTS_LOCAL_COMMAND: 本地合成命令，留空时自动查找
+#   TTS_LOCAL_RAW_RATE: 合成命令输出16位单声道PCM时的采样率，留空表示输出WAV
+#   TTS_LOCAL_MAX_CHARS: 使用本地合成的短文本字数上限，默认12
+#   TTS_LOCAL_SLOW_MS / TTS_LOCAL_SLOW_MAX_CHARS: 云端变慢的阈值和此时本地合成的字数上限，默认1500 / 60
+#
+# 首个音频的耗时对比: python tts_backends.py
+
+import abc
+import atexit
+import os
+import shlex
+import shutil
+import struct
+import subprocess
+import threading
+
+from settings import get_settings
+
+# 本地合成的默认命令，按顺序查找
+DEFAULT_COMMANDS = [
+    ["espeak-ng", "-v", "cmn", "--stdout"],
+    ["espeak", "-v", "zh", "--stdout"]
+]
+
+
+def parse_wav_header(data):
+    """
+    解析WAV文件头
+    :param data: 文件开头的字节
+    :return: (采样率, 声道数, 音频数据的起始位置)，数据不足时返回None
+    :raises ValueError: 不是16位PCM的WAV
+    """
+    if len(data) < 12:
+        return None
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("不是WAV格式")
+    pos = 12
+    rate = channels = None
+    while pos + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, pos)
+        if chunk_id == b"fmt ":
+            if pos + 24 > len(data):
+                return None
+            fmt, channels, rate = struct.unpack_from("<HHI", data, pos + 8)
+            bits = struct.unpack_from("<H", data, pos + 22)[0]
+            if fmt != 1 or bits != 16:
+                raise ValueError(f"只支持16位PCM（格式 {fmt}，位深 {bits}）")
+        elif chunk_id == b"data":
+            if rate is None:
+                raise ValueError("缺少fmt块")
+            return rate, channels, pos + 8
+        pos += 8 + size + (size & 1)
+    return None
+
+
+class TTSBackend(abc.ABC):
+    """
+    合成后端接口：synthesize 把音频块依次交给 emit 回调
+    """
+    name = "base"
+
+    @abc.abstractmethod
+    def audio_format(self):
+        """
+        输出音频的格式，用于设置播放器的输入参数
+        :return: (编码, 采样率, 声道数)
+        """
+
+    @abc.abstractmethod
+    def synthesize(self, text, emit, should_stop=None):
+        """
+        合成一段文本
+        :param text: 文本
+        :param emit: 回调，参数为音频字节
+        :param should_stop: threading.Event，设置后尽快停止
+        :raises RuntimeError: 合成失败
+        """
+
+    def close(self):
+        pass
+
+
+class LocalTTSBackend(TTSBackend):
+    """
+    本地离线合成：常驻一个预先启动、等待输入的命令行合成进程
+    """
+    name = "local"
+
+    def __init__(self, command, raw_rate=None, read_size=4096, keep_spare=True):
+        """
+        :param command: 合成命令（列表），从标准输入读取文本
+        :param raw_rate: 命令输出16位单声道PCM时的采样率，None表示输出WAV
+        :param read_size: 每次读取的字节数
+        :param keep_spare: 是否始终预启动一个合成进程
+        """
+        self.command = command
+        self.raw_rate = raw_rate
+        self.keep_spare = keep_spare
+        self.read_size = read_size
+        self.sample_rate = raw_rate or 22050  # WAV输出时以文件头为准
+        self.channels = 1
+        self._spare = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.spare_hits = 0
+        self.cold_starts = 0
+
+    def _spawn(self):
+        return subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, bufsize=0)
+
+    def start(self):
+        """
+        预启动一个合成进程
+        """
+        self._refill()
+        return self
+
+    def _refill(self):
+        with self._lock:
+            if self._closed or not self.keep_spare or (self._spare is not None and self._spare.poll() is None):
+                return
+            try:
+                self._spare = self._spawn()
+            except OSError as e:
+                print(f"启动本地合成进程失败: {e}")
+                self._spare = None
+
+    def _take(self):
+        with self._lock:
+            proc, self._spare = self._spare, None
+        if proc is not None and proc.poll() is None:
+            self.spare_hits += 1
+            return proc
+        self.cold_starts += 1
+        return self._spawn()
+
+    def audio_format(self):
+        return "s16le", self.sample_rate, self.channels
+
+    def synthesize(self, text, emit, should_stop=None):
+        try:
+            proc = self._take()
+        except OSError as e:
+            raise RuntimeError(f"无法启动本地合成进程: {e}")
+        emitted = 0
+        try:
+            proc.stdin.write(text.encode("utf-8") + b"\n")
+            proc.stdin.close()
+            # 当前进程开始合成后再预启动下一个，不拖慢本次合成
+            threading.Thread(target=self._refill, name="tts-local-spare", daemon=True).start()
+
+            header = b"" if self.raw_rate is None else None
+            while should_stop is None or not should_stop.is_set():
+                data = proc.stdout.read(self.read_size)
+                if not data:
+                    break
+                if header is not None:
+                    # 先解析WAV文件头，只输出PCM数据
+                    header += data
+                    parsed = parse_wav_header(header)
+                    if parsed is None:
+                        if len(header) > 65536:
+                            raise RuntimeError("无法解析本地合成输出的WAV文件头")
+                        continue
+                    self.sample_rate, self.channels, offset = parsed
+                    data, header = header[offset:], None
+                if data:
+                    emitted += len(data)
+                    emit(data)
+            if should_stop is not None and should_stop.is_set():
+                return
+            code = proc.wait(timeout=5)
+            if code != 0 and not emitted:
+                raise RuntimeError(f"本地合成进程退出，退出代码: {code}")
+        except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+            raise RuntimeError(str(e))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+    def close(self):
+        """
+        结束预启动的合成进程
+        """
+        with self._lock:
+            self._closed = True
+            proc, self._spare = self._spare, None
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+            proc.stdin.close()
+            proc.stdout.close()
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        return f"本地合成: {os.path.basename(self.command[0])}，预启动进程命中 {self.spare_hits} 次，冷启动 {self.cold_starts} 次"
+
+
+def local_mode():
+    """
+    本地合成模式
+    """
+    return get_settings().tts_local_mode
+
+
+def detect_local_command():
+    """
+    查找本地合成命令
+    :return: 命令列表，没有可用的合成器时返回None
+    """
+    command = get_settings().tts_local_command
+    if command:
+        return shlex.split(command)
+    for candidate in DEFAULT_COMMANDS:
+        if shutil.which(candidate[0]):
+            return candidate
+    return None
+
+
+_local_backend = None
+_local_lock = threading.Lock()
+
+
+def get_local_backend():
+    """
+    获取进程内共享的本地合成后端（首次调用时预启动合成进程）
+    :return: LocalTTSBackend，未启用或没有可用的合成器时返回None
+    """
+    global _local_backend
+    if local_mode() == "off":
+        return None
+    with _local_lock:
+        if _local_backend is None:
+            command = detect_local_command()
+            if command is None:
+                return None
+            _local_backend = LocalTTSBackend(command, get_settings().tts_local_raw_rate).start()
+            atexit.register(_local_backend.close)
+        return _local_backend
+
+
+class TTSRouter:
+    """
+    按文本长度和云端延迟选择合成后端
+    """
+    def __init__(self, backend, mode=None, max_chars=None, slow_latency=None, slow_max_chars=None):
+        """
+        :param backend: 本地合成后端，None表示不可用
+        :param mode: off / fallback / auto / always
+        :param max_chars: 使用本地合成的短文本字数上限
+        :param slow_latency: 云端首包延迟中位数超过该秒数时视为变慢
+        :param slow_max_chars: 云端变慢时使用本地合成的字数上限
+        """
+        settings = get_settings()
+        self.backend = backend
+        self.mode = mode or settings.tts_local_mode
+        self.max_chars = max_chars or settings.tts_local_max_chars
+        self.slow_latency = slow_latency or settings.tts_local_slow_ms / 1000
+        self.slow_max_chars = slow_max_chars or settings.tts_local_slow_max_chars
+
+    @property
+    def can_fallback(self):
+        """
+        云端失败时能否改用本地合成
+        """
+        return self.backend is not None and self.mode != "off"
+
+    def route(self, text, cloud_latency=None):
+        """
+        判断是否直接使用本地合成
+        :param text: 要合成的文本
+        :param cloud_latency: 云端近期首包延迟的中位数（秒），没有样本时为None
+        :return: 使用本地合成的原因，使用云端时返回None
+        """
+        if self.backend is None or self.mode in ("off", "fallback"):
+            return None
+        if self.mode == "always":
+            return "总是使用本地合成"
+        if len(text) <= self.max_chars:
+            return f"短文本（{len(text)}字）"
+        if cloud_latency is not None and cloud_latency > self.slow_latency and len(text) <= self.slow_max_chars:
+            return f"云端首包延迟 {cloud_latency * 1000:.0f} 毫秒"
+        return None
+
+
+# 基准测试：比较本地合成（冷启动/预启动进程）与云端合成的首个音频耗时
+if __name__ == "__main__":
+    import argparse
+    import importlib.util
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="本地/云端合成首个音频耗时对比")
+    parser.add_argument("--text", default="好的，音量已调大", help="合成的文本")
+    parser.add_argument("--runs", type=int, default=20, help="每种方式的次数")
+    parser.add_argument("--engine-startup", type=float, default=0.15,
+                        help="没有安装本地合成器时，替身合成命令模拟的启动和模型加载耗时（秒）")
+    parser.add_argument("--rtt", type=float, default=0.08, help="替身云端合成服务的网络往返时间（秒）")
+    parser.add_argument("--cloud-latency", type=float, default=0.25, help="替身云端合成服务的首包耗时（秒）")
+    args = parser.parse_args()
+
+    # 替身合成命令：启动后加载“模型”，读取文本后按每字0.2秒音频、5倍实时速度输出WAV
+    STANDIN_SYNTH = (
+        "import sys, time, struct\n"
+        f"time.sleep({args.engine_startup})\n"
+        "text = sys.stdin.buffer.readline().decode().strip()\n"
+        "out = sys.stdout.buffer\n"
+        "rate = 16000\n"
+        "out.write(b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVEfmt ' + struct.pack('<IHHIIHH', 16, 1, 1, rate, rate * 2, 2, 16)"
+        " + b'data' + struct.pack('<I', 0xFFFFFFFF))\n"
+        "for _ in range(len(text) * 2):\n"
+        "    time.sleep(0.1 / 5)\n"
+        "    out.write(b'\\x00' * 3200)\n"
+        "    out.flush()\n"
+    )
+    command = detect_local_command()
+    if command is None:
+        print(f"没有找到本地合成器，使用替身合成命令（启动耗时 {args.engine_startup * 1000:.0f} 毫秒）")
+        command = [sys.executable, "-c", STANDIN_SYNTH]
+    else:
+        print(f"本地合成命令: {' '.join(command)}")
+
+    def percentiles(values):
+        ordered = sorted(values)
+        pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+        return f"P50 {pick(50):.0f} / P95 {pick(95):.0f} / 最大 {ordered[-1] * 1000:.0f} 毫秒"
+
+    def local_first_sample(backend):
+        first = []
+        start = time.perf_counter()
+
+        def emit(data):
+            if not first:
+                first.append(time.perf_counter() - start)
+        backend.synthesize(args.text, emit)
+        return first[0]
+
+    # 冷启动：每次新启动合成进程
+    cold = LocalTTSBackend(command, keep_spare=False)
+    cold_times = [local_first_sample(cold) for _ in range(args.runs)]
+    cold.close()
+    print(f"[本地 冷启动]   首个音频 {percentiles(cold_times)}")
+
+    # 预启动：合成时使用已经启动好的进程（两次合成之间留出预启动的时间，与对话中的间隔相当）
+    warm = LocalTTSBackend(command).start()
+    warm_times = []
+    for _ in range(args.runs):
+        time.sleep(args.engine_startup + 0.2)
+        warm_times.append(local_first_sample(warm))
+    print(f"[本地 预启动]   首个音频 {percentiles(warm_times)}；{warm.report()}")
+    warm.close()
+
+    # 云端：替身服务模拟网络往返和首包耗时，经过完整的TTSApi流程
+    if importlib.util.find_spec("websocket") is None:
+        print("未安装 websocket-client，跳过云端合成的对比")
+        sys.exit(0)
+
+    from xf_standin import StandInServer, tts_handler
+
+    def slow_tts_handler(conn, path):
+        time.sleep(args.rtt + args.cloud_latency)
+        tts_handler(conn, path, chunks=3)
+
+    server = StandInServer(slow_tts_handler).start()
+    from settings import override_settings
+    override_settings({"APPID": "bench", "API_KEY": "bench", "API_SECRET": "bench", "TTS_BASE_URL": server.url("/v2/tts"),
+                       "QUOTA_ENABLED": "0", "HEDGE_ENABLED": "0"})
+    from tts_api import TTSApi
+
+    def first_audio_playback(self):
+        # 不启动ffmpeg，记录第一个音频块进入播放队列的时刻
+        self.first_audio_at = time.perf_counter()
+        self.is_playing = True
+
+        def drain():
+            while self.audio_queue.get() is not None:
+                pass
+            self.is_playing = False
+        self.playback_thread = threading.Thread(target=drain, name="bench-playback", daemon=True)
+        self.playback_thread.start()
+    TTSApi._start_playback = first_audio_playback
+
+    results = {}
+    for label, mode in (("云端", "off"), ("本地", "always")):
+        tts = TTSApi()
+        tts.router = TTSRouter(LocalTTSBackend(command).start() if mode == "always" else None, mode=mode)
+        tts.local_backend = tts.router.backend
+        timings = []
+        devnull = open(os.devnull, "w")
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(args.runs):
+                time.sleep(args.engine_startup + 0.2)
+                start = time.perf_counter()
+                tts.speak(args.text)
+                timings.append(tts.first_audio_at - start)
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+        if tts.local_backend is not None:
+            tts.local_backend.close()
+        print(f"[TTSApi {label}] 首个音频 {percentiles(timings)}")
+    server.stop()
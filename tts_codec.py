@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 语音合成下行编码协商与流式解码
+# 合成接口可以返回未压缩PCM(raw)、MP3(lame)或宽带speex(speex-wb)：
+# - 局域网等快速链路上使用raw，不需要解码，首个音频到达即可播放
+# - 慢速链路上raw跟不上播放速度，改用压缩编码，在进程内流式解码为PCM后放入播放缓冲
+# 协商按每种编码实际的下行速度（每秒墙钟时间收到多少秒音频）决定：raw能达到实时的 TTS_RAW_MIN_REALTIME 倍就用raw，
+# 否则用可以在进程内解码的压缩编码，并每隔 TTS_CODEC_PROBE_EVERY 次合成重新试一次raw；没有可在进程内解码的压缩编码时保持raw
+# 注意：原来固定使用MP3(lame)，现在默认先用raw，首次合成的下行流量约为MP3的4倍，按流量计费的链路可以设置 TTS_DOWNLINK_CODEC=lame
+#
+# 解码器:
+#   speex-wb - 讯飞定制格式（每帧前1字节长度），通过ctypes调用 libspeex
+#   lame     - 需要安装 PyAV（pip install av）；没有安装时auto模式不会选择MP3，固定为lame时交给ffmpeg播放
+#
+# 环境变量:
+#   TTS_DOWNLINK_CODEC: auto（默认）/ raw / lame / speex-wb
+#   TTS_RAW_MIN_REALTIME: raw下行速度至少达到实时的多少倍，默认1.5
+#   TTS_CODEC_PROBE_EVERY: 使用压缩编码时每隔多少次合成重新试一次raw，默认20
+#
+# 各编码的带宽和首个音频耗时（本地替身服务，局域网和慢速链路）: python tts_codec.py
+
+import ctypes
+import threading
+import time
+
+from uplink_codec import load_codec_library, SpeexBits, RAW, LAME, SPEEX_WB
+from event_log import log, INFO
+from settings import get_settings
+
+AUTO = "auto"
+
+
+class RawDecoder:
+    """
+    未压缩PCM，原样输出
+    """
+    encoding = RAW
+
+    def __init__(self, rate):
+        """
+        :param rate: 采样率
+        """
+        self.rate = rate
+        self.errors = 0
+
+    def decode(self, data):
+        """
+        解码一段下行音频
+        :param data: 编码后的字节
+        :return: 16位单声道PCM字节（可能为空）
+        """
+        return data
+
+    def flush(self):
+        """
+        输出解码器中剩余的音频
+        """
+        return b""
+
+    def close(self):
+        pass
+
+
+class SpeexWbDecoder(RawDecoder):
+    """
+    宽带speex解码器，输入为讯飞定制格式：每个压缩帧前1字节长度
+    """
+    encoding = SPEEX_WB
+
+    _MODEID_WB = 1
+    _SET_ENH = 0
+    _GET_FRAME_SIZE = 3
+
+    def __init__(self, library, rate=16000):
+        """
+        :param library: libspeex
+        :param rate: 采样率（宽带为16000）
+        """
+        super().__init__(rate)
+        self.lib = library
+        library.speex_lib_get_mode.restype = ctypes.c_void_p
+        library.speex_decoder_init.restype = ctypes.c_void_p
+        library.speex_decoder_init.argtypes = [ctypes.c_void_p]
+        library.speex_decoder_ctl.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+        library.speex_bits_read_from.argtypes = [ctypes.POINTER(SpeexBits), ctypes.c_char_p, ctypes.c_int]
+        library.speex_decode_int.argtypes = [ctypes.c_void_p, ctypes.POINTER(SpeexBits), ctypes.POINTER(ctypes.c_int16)]
+        library.speex_decoder_destroy.argtypes = [ctypes.c_void_p]
+
+        self._state = library.speex_decoder_init(library.speex_lib_get_mode(self._MODEID_WB))
+        value = ctypes.c_int(1)
+        library.speex_decoder_ctl(self._state, self._SET_ENH, ctypes.byref(value))  # 开启感知增强
+        library.speex_decoder_ctl(self._state, self._GET_FRAME_SIZE, ctypes.byref(value))
+        self.frame_size = value.value
+        self._bits = SpeexBits()
+        library.speex_bits_init(ctypes.byref(self._bits))
+        self._pcm = (ctypes.c_int16 * self.frame_size)()
+        self._pending = b""
+
+    def decode(self, data):
+        data = self._pending + data
+        parts = []
+        offset = 0
+        # 一条消息可能在帧中间结束，剩余字节留到下一条
+        while offset < len(data) and offset + 1 + data[offset] <= len(data):
+            size = data[offset]
+            frame = data[offset + 1:offset + 1 + size]
+            offset += 1 + size
+            self.lib.speex_bits_read_from(ctypes.byref(self._bits), frame, size)
+            if self.lib.speex_decode_int(self._state, ctypes.byref(self._bits), self._pcm) != 0:
+                self.errors += 1
+                continue
+            parts.append(ctypes.string_at(self._pcm, self.frame_size * 2))
+        self._pending = data[offset:]
+        return b"".join(parts)
+
+    def close(self):
+        if self._state:
+            self.lib.speex_bits_destroy(ctypes.byref(self._bits))
+            self.lib.speex_decoder_destroy(self._state)
+            self._state = None
+
+
+class Mp3Decoder(RawDecoder):
+    """
+    MP3流式解码器（PyAV），输出重采样为16位单声道
+    """
+    encoding = LAME
+
+    def __init__(self, av, rate):
+        """
+        :param av: PyAV模块
+        :param rate: 输出采样率
+        """
+        super().__init__(rate)
+        self._context = av.CodecContext.create("mp3", "r")
+        self._resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+
+    def _convert(self, frames):
+        return b"".join(out.to_ndarray().tobytes() for frame in frames for out in self._resampler.resample(frame))
+
+    def decode(self, data):
+        try:
+            return b"".join(self._convert(self._context.decode(packet)) for packet in self._context.parse(data))
+        except Exception:
+            # 损坏的帧跳过，后面的帧仍可解码
+            self.errors += 1
+            return b""
+
+    def flush(self):
+        try:
+            pcm = b"".join(self._convert(self._context.decode(packet)) for packet in self._context.parse(None))
+            pcm += self._convert(self._context.decode(None))
+            return pcm + b"".join(out.to_ndarray().tobytes() for out in self._resampler.resample(None))
+        except Exception:
+            self.errors += 1
+            return b""
+
+
+def _import_av():
+    try:
+        import av
+        return av
+    except ImportError:
+        return None
+
+
+def decoder_available(encoding):
+    """
+    是否可以在进程内解码某种编码
+    """
+    if encoding == RAW:
+        return True
+    if encoding == SPEEX_WB:
+        return load_codec_library("speex", "SPEEX_LIBRARY") is not None
+    if encoding == LAME:
+        return _import_av() is not None
+    return False
+
+
+def create_decoder(encoding, rate):
+    """
+    为一个合成连接创建解码器
+    :param encoding: raw / lame / speex-wb
+    :param rate: 采样率
+    :return: 解码器，无法在进程内解码时返回None（MP3交给ffmpeg）
+    """
+    if encoding == RAW:
+        return RawDecoder(rate)
+    if encoding == SPEEX_WB:
+        library = load_codec_library("speex", "SPEEX_LIBRARY")
+        return SpeexWbDecoder(library, rate) if library is not None else None
+    if encoding == LAME:
+        av = _import_av()
+        return Mp3Decoder(av, rate) if av is not None else None
+    return None
+
+
+class _EncodingStats:
+    """
+    一种编码的下行统计
+    """
+    def __init__(self):
+        self.streams = 0
+        self.wire_bytes = 0
+        self.audio_seconds = 0.0
+        self.realtime = None  # 下行速度（实时的倍数），指数平均
+        self.first_sample = None  # 首个音频耗时（秒），指数平均
+
+
+class DownlinkNegotiator:
+    """
+    根据各编码实际的下行速度选择合成接口返回的音频编码
+    """
+    def __init__(self, mode=None, min_realtime=None, probe_every=None):
+        """
+        :param mode: auto / raw / lame / speex-wb
+        :param min_realtime: raw下行速度至少达到实时的多少倍
+        :param probe_every: 使用压缩编码时每隔多少次合成重新试一次raw
+        """
+        settings = get_settings()
+        self.mode = (mode or settings.tts_downlink_codec).strip().lower()
+        self.min_realtime = min_realtime or settings.tts_raw_min_realtime
+        self.probe_every = probe_every or settings.tts_codec_probe_every
+        self.stats = {RAW: _EncodingStats(), LAME: _EncodingStats(), SPEEX_WB: _EncodingStats()}
+        self.sessions = 0
+        self._last_probe = 0
+        self._current = None
+        self._lock = threading.Lock()
+
+    def compressed(self):
+        """
+        可用的压缩编码：优先speex-wb，其次MP3，只选择可以在进程内解码的编码
+        :return: 编码，没有可用的压缩编码时返回None
+        """
+        for encoding in (SPEEX_WB, LAME):
+            if decoder_available(encoding):
+                return encoding
+        return None
+
+    def choose(self):
+        """
+        为一次合成选择编码
+        :return: raw / lame / speex-wb
+        """
+        if self.mode != AUTO:
+            if self.mode == SPEEX_WB and not decoder_available(SPEEX_WB):
+                return LAME
+            return self.mode if self.mode in self.stats else LAME
+        with self._lock:
+            self.sessions += 1
+            raw = self.stats[RAW].realtime
+            choice = RAW
+            compressed = self.compressed() if raw is not None and raw < self.min_realtime else None
+            if compressed is not None:
+                choice = compressed
+                if self.sessions - self._last_probe >= self.probe_every:
+                    # 链路可能已经变快，重新试一次raw
+                    self._last_probe = self.sessions
+                    choice = RAW
+            if choice != self._current:
+                log(INFO, "tts.codec", f"合成下行编码: {choice}（raw下行速度 "
+                    f"{'未知' if raw is None else f'{raw:.1f}倍实时'}）", console=False)
+                self._current = choice
+            return choice
+
+    def record(self, encoding, wire_bytes, audio_seconds, first_sample, elapsed):
+        """
+        记录一个合成连接的下行统计
+        :param encoding: 编码
+        :param wire_bytes: 收到的音频字节数（base64解码后）
+        :param audio_seconds: 解码后的音频时长，无法解码时为None
+        :param first_sample: 从发出请求到首个可播放音频的耗时（秒）
+        :param elapsed: 首个音频到最后一个音频的间隔（秒）
+        """
+        with self._lock:
+            stats = self.stats[encoding]
+            stats.streams += 1
+            stats.wire_bytes += wire_bytes
+            if first_sample is not None:
+                stats.first_sample = first_sample if stats.first_sample is None else 0.7 * stats.first_sample + 0.3 * first_sample
+            if audio_seconds:
+                stats.audio_seconds += audio_seconds
+                # 只有一两个音频块时间隔主要是网络抖动，不用于判断下行速度
+                if audio_seconds >= 0.5:
+                    realtime = audio_seconds / max(elapsed, 0.01)
+                    stats.realtime = realtime if stats.realtime is None else 0.5 * stats.realtime + 0.5 * realtime
+
+    def report(self):
+        """
+        每种用过的编码一行：带宽、下行速度和首个音频耗时
+        """
+        lines = []
+        for encoding, stats in self.stats.items():
+            if not stats.streams:
+                continue
+            kbps = stats.wire_bytes * 8 / stats.audio_seconds / 1000 if stats.audio_seconds else 0.0
+            realtime = f"{stats.realtime:.1f}倍实时" if stats.realtime is not None else "未知"
+            first = f"{stats.first_sample * 1000:.0f} 毫秒" if stats.first_sample is not None else "无"
+            lines.append(f"合成下行 {encoding}: {stats.streams} 次，{kbps:.0f}kbit/s（每秒音频），下行速度 {realtime}，首个音频 {first}")
+        return "\n".join(lines)
+
+
+class DownlinkStream:
+    """
+    一个合成连接的下行音频：解码并统计
+    """
+    def __init__(self, negotiator, encoding, rate):
+        """
+        :param negotiator: DownlinkNegotiator
+        :param encoding: 本次请求的编码
+        :param rate: 解码后的采样率
+        """
+        self.negotiator = negotiator
+        self.encoding = encoding
+        self.rate = rate
+        self.decoder = create_decoder(encoding, rate)
+        self.started = time.perf_counter()
+        self.first_at = None
+        self.last_at = None
+        self.wire_bytes = 0
+        self.pcm_bytes = 0
+        self._finished = False
+
+    @property
+    def decoded(self):
+        """
+        输出是否为PCM（否则为原始MP3，需要ffmpeg解码）
+        """
+        return self.decoder is not None
+
+    def feed(self, data):
+        """
+        :param data: 一条消息中的音频字节
+        :return: 可以放入播放缓冲的音频（可能为空）
+        """
+        self.wire_bytes += len(data)
+        out = self.decoder.decode(data) if self.decoder else data
+        if out:
+            now = time.perf_counter()
+            self.first_at = self.first_at or now
+            self.last_at = now
+            self.pcm_bytes += len(out)
+        return out
+
+    def finish(self):
+        """
+        合成完成：输出解码器中剩余的音频并记录统计
+        """
+        if self._finished:
+            return b""
+        self._finished = True
+        out = b""
+        if self.decoder:
+            out = self.decoder.flush()
+            self.pcm_bytes += len(out)
+            self.decoder.close()
+        first_sample = self.first_at - self.started if self.first_at else None
+        elapsed = self.last_at - self.first_at if self.first_at else 0.0
+        audio_seconds = self.pcm_bytes / 2 / self.rate if self.decoder else None
+        self.negotiator.record(self.encoding, self.wire_bytes, audio_seconds, first_sample, elapsed)
+        return out
+
+
+_negotiator = None
+_negotiator_lock = threading.Lock()
+
+
+def get_downlink_negotiator():
+    """
+    获取进程内共享的下行编码协商器（各次合成的统计在一起累积）
+    """
+    global _negotiator
+    with _negotiator_lock:
+        if _negotiator is None:
+            _negotiator = DownlinkNegotiator()
+        return _negotiator
+
+
+if __name__ == "__main__":
+    # 各编码在局域网和慢速链路上的下行字节、首个音频耗时和下行速度（本地替身服务）
+    import argparse
+    import base64
+    import json
+    import numpy as np
+    from uplink_codec import create_uplink_codec
+    from xf_standin import StandInServer, StandInClient
+
+    parser = argparse.ArgumentParser(description="合成下行编码对比")
+    parser.add_argument("--seconds", type=float, default=4.0, help="每次合成的音频时长")
+    parser.add_argument("--slow", type=int, default=128000, help="慢速链路带宽（bit/s）")
+    args = parser.parse_args()
+
+    # 带谐波和包络的类语音音频
+    t = np.arange(int(16000 * args.seconds)) / 16000
+    f0 = 180 + 40 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / 16000
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6)) * (0.5 + 0.5 * np.sin(2 * np.pi * 2 * t))
+    pcm = (3000 * voice).astype("<i2").tobytes()
+
+    # 自动协商只会选择能在进程内解码的编码；替身服务只能返回本机能编码的编码，两者都满足的才能参与对比
+    decodable = [name for name in (RAW, LAME, SPEEX_WB) if decoder_available(name)]
+    encoded = {}
+    for name in decodable:
+        codec = create_uplink_codec(name)
+        if codec.encoding == name:
+            encoded[name] = codec.encode(pcm) + codec.flush()
+        codec.close()
+    messages = int(args.seconds * 10)  # 服务端每条消息约100毫秒音频
+
+    def make_handler(bandwidth):
+        def handler(conn, path):
+            request = json.loads(conn.recv())
+            data = encoded[request["business"]["aue"].split(";")[0]]
+            start = time.perf_counter()
+            sent = 0
+            for seq in range(messages):
+                part = data[len(data) * seq // messages:len(data) * (seq + 1) // messages]
+                status = 2 if seq == messages - 1 else 1
+                reply = json.dumps({"code": 0, "message": "success", "sid": "standin",
+                                    "data": {"audio": base64.b64encode(part).decode(), "status": status}})
+                sent += len(reply)
+                if bandwidth:
+                    # 按链路带宽发送
+                    time.sleep(max(0.0, sent * 8 / bandwidth - (time.perf_counter() - start)))
+                conn.send(reply)
+            conn.close()
+        return handler
+
+    def synthesize(server, negotiator, encoding):
+        client = StandInClient(server.url())
+        stream = DownlinkStream(negotiator, encoding, 16000)
+        client.send(json.dumps({"business": {"aue": "speex-wb;7" if encoding == SPEEX_WB else encoding}}))
+        while True:
+            message = client.recv()
+            if message is None:
+                break
+            data = json.loads(message)["data"]
+            stream.feed(base64.b64decode(data["audio"]))
+            if data["status"] == 2:
+                break
+        stream.finish()
+        client.close()
+        return stream
+
+    print(f"每次合成 {args.seconds:.0f} 秒音频")
+    print(f"可在进程内解码的编码（自动协商的候选）: {', '.join(decodable)}")
+    print(f"替身服务可以生成的编码（本机有编码器）: {', '.join(encoded)}")
+    missing = [name for name in decodable if name not in encoded]
+    if missing:
+        print(f"注意: {', '.join(missing)} 可以解码但本机没有编码器，无法参与对比；自动协商选中它时测试会提前停止")
+    for label, bandwidth in (("局域网", None), (f"慢速链路 {args.slow // 1000}kbit/s", args.slow)):
+        server = StandInServer(make_handler(bandwidth))
+        server.start()
+        negotiator = DownlinkNegotiator(mode=RAW)
+        for encoding in encoded:
+            synthesize(server, negotiator, encoding)
+        print(f"\n{label}:")
+        print(negotiator.report())
+        # 自动协商：第一次用raw测得下行速度后决定之后的编码
+        auto = DownlinkNegotiator(mode=AUTO)
+        choices = []
+        for _ in range(3):
+            choice = auto.choose()
+            choices.append(choice)
+            if choice not in encoded:
+                # 能解码但本机没有对应的编码器，替身服务无法生成这种音频
+                choices.append("（无法生成测试音频，停止）")
+                break
+            synthesize(server, auto, choice)
+        print(f"自动协商连续3次合成的编码: {' -> '.join(choices)}")
+        server.stop()
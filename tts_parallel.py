@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 分段语音合成的并行度自适应控制
+#
+# TTSApi 把长回复分成多段，每段使用独立的连接和缓冲区，按顺序拼接到同一个播放流。
+# 同时合成的段数K由 AdaptiveParallelism 根据实测情况调整（加性增、乘性减）:
+#   - 某段合成期间播放队列被取空、播放在等待音频（合成跟不上播放）时 K+1
+#   - 收到流控错误码（秒级/并发流控超限）时 K减半，并在冷却时间内不再增加
+#   - 某段的首包延迟明显高于历史最低水平（服务端在并发下变慢）时 K-1
+#
+# 环境变量:
+#   TTS_PARALLEL: 初始并行段数，默认2
+#   TTS_PARALLEL_MAX: 并行段数上限，默认4
+#   TTS_PARALLEL_ADAPTIVE: 是否自适应调整，默认开启
+#   TTS_RATE_LIMIT_CODES: 视为流控的错误码，默认 11202,11203
+#
+# 基准测试（需要websocket-client）: python tts_parallel.py
+
+import os
+import threading
+import time
+
+from event_log import log, INFO
+from settings import get_settings
+
+
+class AdaptiveParallelism:
+    """
+    同时合成段数的自适应控制
+    """
+    def __init__(self, initial=None, maximum=None, adaptive=None, rate_limit_codes=None,
+                 starve_threshold=0.05, slow_factor=2.0, cooldown=10.0):
+        """
+        :param initial: 初始并行段数
+        :param maximum: 并行段数上限
+        :param adaptive: 是否自适应调整，False时固定为初始值
+        :param rate_limit_codes: 流控错误码集合
+        :param starve_threshold: 一段合成期间播放累计等待超过该秒数视为合成跟不上
+        :param slow_factor: 首包延迟超过历史最低值的倍数时减少并行
+        :param cooldown: 流控后禁止增加并行的秒数
+        """
+        settings = get_settings()
+        self.maximum = maximum or settings.tts_parallel_max
+        self.limit = max(1, min(self.maximum, initial or settings.tts_parallel))
+        self.adaptive = settings.tts_parallel_adaptive if adaptive is None else adaptive
+        if rate_limit_codes is None:
+            rate_limit_codes = settings.tts_rate_limit_codes
+        self.rate_limit_codes = set(rate_limit_codes)
+        self.starve_threshold = starve_threshold
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+
+        self.best_latency = None  # 历史最低首包延迟（秒）
+        self.latency_avg = None  # 首包延迟的滑动平均
+        self.blocked_until = 0.0
+        self.rate_limited = 0
+        self.starved = 0
+        self.history = []  # [(时刻, 新的并行段数, 原因), ...]，只保留最近的记录
+        self._lock = threading.Lock()
+
+    def _set(self, limit, reason):
+        limit = max(1, min(self.maximum, limit))
+        if limit != self.limit:
+            log(INFO, "tts.parallel", f"语音合成并行段数 {self.limit} -> {limit}（{reason}）", console=False)
+            self.limit = limit
+            self.history.append((time.time(), limit, reason))
+            del self.history[:-20]
+
+    def is_rate_limit(self, code):
+        """
+        判断错误码是否为流控
+        """
+        return code in self.rate_limit_codes
+
+    def on_first_audio(self, latency):
+        """
+        记录一段从开始连接到收到首个音频块的延迟
+        :param latency: 延迟（秒）
+        """
+        with self._lock:
+            self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+            self.latency_avg = latency if self.latency_avg is None else self.latency_avg * 0.7 + latency * 0.3
+            if (self.adaptive and self.limit > 1 and self.latency_avg > self.best_latency * self.slow_factor
+                    and latency > self.best_latency * self.slow_factor):
+                self._set(self.limit - 1, f"首包延迟 {latency * 1000:.0f} 毫秒，高于最低 {self.best_latency * 1000:.0f} 毫秒")
+                # 降低后重新计算平均值
+                self.latency_avg = None
+
+    def on_starved(self, waited):
+        """
+        记录一段合成期间播放等待音频的累计时长
+        :param waited: 等待时长（秒）
+        """
+        if waited < self.starve_threshold:
+            return
+        with self._lock:
+            self.starved += 1
+            if self.adaptive and time.monotonic() >= self.blocked_until:
+                self._set(self.limit + 1, f"播放等待合成 {waited * 1000:.0f} 毫秒")
+
+    def on_rate_limited(self, code):
+        """
+        收到流控错误
+        :param code: 错误码
+        """
+        with self._lock:
+            self.rate_limited += 1
+            self.blocked_until = time.monotonic() + self.cooldown
+            if self.adaptive:
+                self._set(self.limit // 2, f"流控错误码 {code}")
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        best = f"{self.best_latency * 1000:.0f} 毫秒" if self.best_latency is not None else "无"
+        return (f"并行段数 {self.limit}/{self.maximum}{'（自适应）' if self.adaptive else ''}，"
+                f"最低首包延迟 {best}，播放等待 {self.starved} 次，流控 {self.rate_limited} 次")
+
+
+# 基准测试：替身合成服务按连接限速、限制并发，比较不同并行段数的首包时间和总耗时
+if __name__ == "__main__":
+    import argparse
+    import base64
+    import importlib.util
+    import json
+    import sys
+
+    from xf_standin import StandInServer
+
+    parser = argparse.ArgumentParser(description="分段并行语音合成基准测试")
+    parser.add_argument("--paragraphs", type=int, default=4, help="回复的段落数")
+    parser.add_argument("--synth-speed", type=float, default=0.8, help="单个连接的合成速度（相对实时播放的倍数）")
+    parser.add_argument("--latency", type=float, default=0.3, help="合成服务的首包延迟（秒）")
+    parser.add_argument("--concurrency", type=int, default=3, help="服务端允许的并发连接数，超过时返回流控错误")
+    parser.add_argument("--scale", type=float, default=20, help="时间压缩倍数（音频按该倍速播放）")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("websocket") is None:
+        print("需要安装 websocket-client: pip install websocket-client")
+        sys.exit(1)
+
+    BYTES_PER_CHAR = 4000  # 每个字约0.25秒16KB/s的音频
+    PLAYBACK_RATE = 16000 * args.scale  # 压缩后的播放速度（字节/秒）
+    SYNTH_RATE = PLAYBACK_RATE * args.synth_speed
+    FRAME = 8000
+    active = [0]
+    active_lock = threading.Lock()
+
+    def synth_handler(conn, path):
+        request = json.loads(conn.recv())
+        text = base64.b64decode(request["data"]["text"]).decode("utf-8")
+        with active_lock:
+            if active[0] >= args.concurrency:
+                conn.send(json.dumps({"code": 11203, "message": "concurrency limit"}))
+                conn.close()
+                return
+            active[0] += 1
+        try:
+            time.sleep(args.latency / args.scale)
+            total = len(text) * BYTES_PER_CHAR
+            sent = 0
+            while sent < total:
+                size = min(FRAME, total - sent)
+                time.sleep(size / SYNTH_RATE)
+                sent += size
+                status = 2 if sent >= total else 1
+                conn.send(json.dumps({"code": 0, "data": {"audio": base64.b64encode(b"\0" * size).decode(), "status": status}}))
+        finally:
+            with active_lock:
+                active[0] -= 1
+            conn.close()
+
+    server = StandInServer(synth_handler).start()
+
+    from tts_api import TTSApi
+    from settings import override_settings
+    override_settings({"APPID": "bench", "API_KEY": "bench", "API_SECRET": "bench", "TTS_BASE_URL": server.url("/v2/tts"),
+                       "TTS_CHUNK_CHARS": "60"})
+
+    def realtime_playback(self):
+        # 按压缩后的实时速度消费音频，统计首个音频时刻和播放中断时长
+        self.is_playing = True
+        stats = self.bench_stats
+
+        def play():
+            while True:
+                wait_start = time.perf_counter()
+                chunk = self.audio_queue.get()
+                if chunk is None:
+                    break
+                now = time.perf_counter()
+                if stats["first_audio"] is None:
+                    stats["first_audio"] = now
+                elif now - wait_start > 0.001:
+                    stats["stall"] += now - wait_start
+                time.sleep(len(chunk) / PLAYBACK_RATE)
+            self.is_playing = False
+        self.playback_thread = threading.Thread(target=play, name="bench-playback", daemon=True)
+        self.playback_thread.start()
+    TTSApi._start_playback = realtime_playback
+
+    paragraph = "今天的天气晴朗，最高气温二十六度，最低气温十八度。适合户外活动，但是中午紫外线比较强，出门记得涂防晒。晚上有微风，体感比较舒适。"
+    answer = "\n".join(paragraph for _ in range(args.paragraphs))
+    audio_seconds = len(answer) * BYTES_PER_CHAR / 16000
+    print(f"回复 {len(answer)} 字，约 {audio_seconds:.0f} 秒音频，时间压缩 {args.scale:.0f} 倍，"
+          f"单连接合成速度 {args.synth_speed} 倍实时，服务端并发上限 {args.concurrency}")
+
+    for label, initial, adaptive in (("K=1", 1, False), ("K=2", 2, False), ("K=4", 4, False), ("自适应", 2, True)):
+        tts = TTSApi()
+        tts.parallelism = AdaptiveParallelism(initial=initial, maximum=4, adaptive=adaptive,
+                                              starve_threshold=0.05 / args.scale, cooldown=10 / args.scale)
+        # 自适应模式先预热一轮，让并行段数收敛
+        for round_index in range(2 if adaptive else 1):
+            tts.bench_stats = {"first_audio": None, "stall": 0.0}
+            devnull = open(os.devnull, "w")
+            stdout, sys.stdout = sys.stdout, devnull
+            start = time.perf_counter()
+            try:
+                tts.speak(answer)
+            finally:
+                sys.stdout = stdout
+                devnull.close()
+            total = time.perf_counter() - start
+        stats = tts.bench_stats
+        first = (stats["first_audio"] - start) * args.scale if stats["first_audio"] else float("nan")
+        print(f"[{label:>4}] 首个音频 {first * 1000:.0f} 毫秒, 总耗时 {total * args.scale:.1f} 秒"
+              f"（音频 {audio_seconds:.0f} 秒）, 播放中断 {stats['stall'] * args.scale:.1f} 秒; {tts.parallelism.report()}")
+    server.stop()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 语音合成文本预处理：把大模型回复整理成适合朗读的文本，并切分成若干段
+#
+# - 去掉星火回复中常见的Markdown标记（标题、加粗、列表符号、代码块、链接、表格等）
+# - 把日期、时间、百分比、温度、单位和常见符号改写为中文读法
+# - 按句子切分，超长句子再按逗号等停顿切分，每段不超过上限；第一段较短，尽快开始播放
+#
+# 环境变量:
+#   TTS_CHUNK_CHARS: 每段最多字符数，默认150（讯飞接口单次文本上限约8000字节，远大于此值）
+#   TTS_FIRST_CHUNK_CHARS: 第一段最多字符数，默认40
+#
+# 测试: python tts_text.py
+
+import re
+
+from settings import get_settings
+
+# 单位读法，按长度从长到短匹配
+UNITS = {
+    "km/h": "公里每小时", "m/s": "米每秒", "km²": "平方公里", "m²": "平方米", "m³": "立方米",
+    "kcal": "千卡", "km": "公里", "cm": "厘米", "mm": "毫米", "kg": "千克", "mg": "毫克", "ml": "毫升", "mL": "毫升",
+    "GB": "G", "MB": "兆", "KB": "K", "kW": "千瓦", "kWh": "千瓦时", "Hz": "赫兹", "MHz": "兆赫", "GHz": "吉赫",
+    "m": "米", "g": "克", "L": "升", "h": "小时", "s": "秒", "W": "瓦", "V": "伏"
+}
+
+# 符号读法（只替换数字或汉字之间的符号，避免误伤）
+SYMBOLS = {"&": "和", "≈": "约等于", "≥": "大于等于", "≤": "小于等于", "×": "乘", "÷": "除以", "→": "到", "℃": "摄氏度", "℉": "华氏度"}
+
+SENTENCE_END = "。！？!?；;"
+PAUSES = "，、,：:"
+
+_CODE_BLOCK = re.compile(r"```[^\n]*\n?(.*?)```", re.S)
+_LINK = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+_URL = re.compile(r"https?://\S+")
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s*", re.M)
+_LIST_BULLET = re.compile(r"^\s*[-*+•]\s+", re.M)
+_LIST_NUMBER = re.compile(r"^\s*(\d+)[.)、]\s+", re.M)
+_QUOTE = re.compile(r"^\s*>\s?", re.M)
+_TABLE_RULE = re.compile(r"^\s*\|?\s*:?-{3,}.*$", re.M)
+_EMPHASIS = re.compile(r"(\*\*|__|\*|~~|`)")
+_EMOJI = re.compile("[\U0001F300-\U0001FAFF☀-➿️]")
+
+_DATE = re.compile(r"(\d{4})[-/年](\d{1,2})[-/月](\d{1,2})日?")
+_TIME = re.compile(r"(?<![\d:])(\d{1,2}):(\d{2})(?![\d:])")
+_PERCENT = re.compile(r"(\d+(?:\.\d+)?)\s*[%％]")
+_DEGREE = re.compile(r"(\d+(?:\.\d+)?)\s*°\s*C")
+_RANGE = re.compile(r"(\d+(?:\.\d+)?)\s*[-~～]\s*(\d+(?:\.\d+)?)")
+_NEGATIVE = re.compile(r"(?<![\d\w])-(\d)")
+_UNIT = re.compile(r"(\d+(?:\.\d+)?)\s*(" + "|".join(re.escape(u) for u in sorted(UNITS, key=len, reverse=True)) + r")(?![A-Za-z])")
+
+
+def strip_markdown(text):
+    """
+    去掉Markdown标记，保留可朗读的内容
+    :param text: 原始文本
+    :return: 纯文本
+    """
+    text = _CODE_BLOCK.sub(lambda m: m.group(1), text)
+    text = _LINK.sub(lambda m: m.group(1), text)
+    text = _URL.sub("", text)
+    text = _TABLE_RULE.sub("", text)
+    text = _HEADING.sub("", text)
+    text = _QUOTE.sub("", text)
+    text = _LIST_BULLET.sub("", text)
+    # 有序列表改成“第N，”的读法
+    text = _LIST_NUMBER.sub(lambda m: f"第{m.group(1)}，", text)
+    text = _EMPHASIS.sub("", text)
+    # 表格的竖线当作停顿
+    text = re.sub(r"[ \t]*\|[ \t]*", "，", text)
+    text = _EMOJI.sub("", text)
+    return text
+
+
+def normalize_for_speech(text):
+    """
+    把日期、时间、百分比、单位和符号改写成中文读法
+    :param text: 纯文本
+    :return: 适合朗读的文本
+    """
+    text = _DATE.sub(lambda m: f"{m.group(1)}年{int(m.group(2))}月{int(m.group(3))}日", text)
+    text = _TIME.sub(lambda m: f"{int(m.group(1))}点" + (f"{int(m.group(2))}分" if int(m.group(2)) else ""), text)
+    text = _PERCENT.sub(r"百分之\1", text)
+    text = _DEGREE.sub(r"\1摄氏度", text)
+    text = _RANGE.sub(r"\1到\2", text)
+    text = _NEGATIVE.sub(r"负\1", text)
+    text = _UNIT.sub(lambda m: m.group(1) + UNITS[m.group(2)], text)
+    for symbol, reading in SYMBOLS.items():
+        text = text.replace(symbol, reading)
+    # 合并多余的空白和重复的停顿
+    text = re.sub(r"[ \t　]+", " ", text)
+    text = re.sub(r"\n\s*\n+", "\n", text)
+    text = re.sub(r"[，,]{2,}", "，", text)
+    text = re.sub(r"^[，,\s]+|[，,\s]+$", "", text, flags=re.M)
+    # 没有标点结尾的行（标题、列表项）补上句号，朗读时有停顿
+    text = re.sub(r"(?<![。！？!?；;，,：:])\n", "。", text.strip())
+    return text.replace("\n", "")
+
+
+def _split_long(sentence, limit):
+    """
+    把超长句子按停顿切分，仍然过长时按字数硬切
+    """
+    pieces = []
+    current = ""
+    for part in re.split(f"(?<=[{PAUSES}])", sentence):
+        if len(current) + len(part) <= limit:
+            current += part
+            continue
+        if current:
+            pieces.append(current)
+        while len(part) > limit:
+            pieces.append(part[:limit])
+            part = part[limit:]
+        current = part
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_for_tts(text, max_chars=150, first_chars=40):
+    """
+    按句子切分文本，相邻的短句合并，每段不超过上限
+    :param text: 适合朗读的文本
+    :param max_chars: 每段最多字符数
+    :param first_chars: 第一段最多字符数（越短首包越快）
+    :return: 文本段列表
+    """
+    sentences = [s.strip() for s in re.split(f"(?<=[{SENTENCE_END}])", text) if s.strip()]
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        limit = first_chars if not chunks else max_chars
+        if current and len(current) + len(sentence) > limit:
+            chunks.append(current)
+            current = ""
+            limit = max_chars
+        if len(sentence) > limit:
+            pieces = _split_long(sentence, limit)
+            chunks.extend(pieces[:-1])
+            sentence = pieces[-1]
+        current += sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def prepare_tts_text(text, max_chars=None, first_chars=None):
+    """
+    完整的预处理流程：去Markdown、改写读法、切分
+    :param text: 大模型回复
+    :return: 文本段列表，没有可朗读的内容时为空列表
+    """
+    settings = get_settings()
+    max_chars = max_chars or settings.tts_chunk_chars
+    first_chars = first_chars or settings.tts_first_chunk_chars
+    return split_for_tts(normalize_for_speech(strip_markdown(text)), max_chars, first_chars)
+
+
+# 测试代码
+if __name__ == "__main__":
+    sample = """## 明天的天气
+**北京**：2024-05-01 气温 18-26°C，降水概率 30%，风速 3.5m/s。
+- 早上 7:30 出门记得带伞 ☔
+- 详情见 [天气网](https://weather.example.com)
+
+1. 室外温度 -3℃ 时注意保暖
+2. 步行 5km 约消耗 300kcal & 1.2L 水
+
+| 时间 | 天气 |
+|---|---|
+| 上午 | 晴 |
+"""
+    cleaned = normalize_for_speech(strip_markdown(sample))
+    print(cleaned)
+    print("----")
+    for i, chunk in enumerate(prepare_tts_text(sample * 3)):
+        print(f"[{i}] ({len(chunk)}字) {chunk}")
+
+    assert "**" not in cleaned and "#" not in cleaned and "http" not in cleaned
+    assert "2024年5月1日" in cleaned and "18到26摄氏度" in cleaned and "百分之30" in cleaned
+    assert "7点30分" in cleaned and "负3摄氏度" in cleaned and "5公里" in cleaned
+    chunks = prepare_tts_text(sample * 3, max_chars=60, first_chars=20)
+    assert len(chunks[0]) <= 20 and all(len(c) <= 60 for c in chunks)
+    assert "".join(chunks).replace(" ", "") == normalize_for_speech(strip_markdown(sample * 3)).replace(" ", "")
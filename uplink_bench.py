@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 上行多帧聚合基准测试：对本地替身服务器比较不同聚合模式的
+# 消息数/秒、上行字节数、客户端CPU和发送延迟
+#
+# 替身服务器运行在独立进程中，客户端CPU统计不包含服务器端开销
+#
+# 用法: python uplink_bench.py --seconds 10 --speed 4 --bandwidth 150000
+# 上行编码对比: python uplink_bench.py --codecs --codec-bandwidth 32000
+#   在限速链路上比较 raw / speex-wb / lame 的上行字节、编码CPU和识别延迟（说完到收到识别结果）
+
+import argparse
+import math
+import multiprocessing
+import struct
+import time
+
+from audio_uplink import AudioSender, STATUS_FIRST_FRAME, STATUS_CONTINUE_FRAME
+from uplink_codec import create_uplink_codec, RAW, SPEEX_WB, LAME
+from xf_standin import StandInServer, StandInClient, iat_handler
+
+CHUNK = b"\x01\x00" * 640  # 1280字节 = 40毫秒16k单声道音频
+
+
+def _server_process(bandwidth, ready_queue, stats_queue):
+    """
+    替身服务器进程：只服务一个连接，结束后回传服务器侧统计
+    """
+    done = []
+
+    def handler(conn, path):
+        iat_handler(conn, path)
+        done.append(conn)
+
+    server = StandInServer(handler, bandwidth=bandwidth, recv_buffer=8192 if bandwidth else None).start()
+    ready_queue.put(server.port)
+    while not done:
+        time.sleep(0.01)
+    conn = done[0]
+    stats = dict(conn.stats)
+    stats["wire_bytes"] = conn.received_bytes
+    stats_queue.put(stats)
+    server.stop()
+
+
+def run_once(aggregation, seconds, speed, bandwidth):
+    """
+    运行一轮测试
+    :param aggregation: 聚合模式
+    :param seconds: 模拟的音频时长（秒）
+    :param speed: 加速倍数
+    :param bandwidth: 服务器接收带宽（字节/秒），None表示不限
+    :return: 统计字典
+    """
+    ctx = multiprocessing.get_context("spawn")
+    ready_queue, stats_queue = ctx.Queue(), ctx.Queue()
+    server = ctx.Process(target=_server_process, args=(bandwidth, ready_queue, stats_queue), daemon=True)
+    server.start()
+    port = ready_queue.get(timeout=10)
+
+    ws = StandInClient(f"ws://127.0.0.1:{port}/v2/iat", send_buffer=8192 if bandwidth else None)
+    frames = int(seconds * 25)
+    interval = 0.04 / speed
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    sender = AudioSender(ws, {"app_id": "bench"}, {"domain": "iat"}, max_frames=frames, aggregation=aggregation)
+    next_time = time.perf_counter()
+    for i in range(frames):
+        sender.send_audio(STATUS_FIRST_FRAME if i == 0 else STATUS_CONTINUE_FRAME, CHUNK)
+        next_time += interval
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    sender.finish(timeout=60)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    ws.recv()
+    sender.close()
+    ws.close()
+    server_stats = stats_queue.get(timeout=10)
+    server.join(timeout=5)
+
+    stats = sender.stats()
+    assert server_stats["first_frame"] and server_stats["last_frame"]
+    # 聚合不能丢音频
+    assert server_stats["audio_bytes"] == (frames - stats["dropped"]) * len(CHUNK)
+    return {
+        "messages": server_stats["messages"],
+        "messages_per_second": server_stats["messages"] / wall,
+        "wire_bytes": server_stats["wire_bytes"],
+        "cpu_ms": cpu * 1000,
+        "latency_avg_ms": stats["send_latency_avg_ms"],
+        "latency_max_ms": stats["send_latency_max_ms"],
+        "batched": stats["batched"],
+        "wall": wall
+    }
+
+
+def _voice_chunks(frames):
+    """
+    生成带谐波和包络的类语音PCM块（压缩率比常数样本更接近真实录音）
+    """
+    chunks = []
+    for i in range(frames):
+        samples = []
+        for n in range(640):
+            t = (i * 640 + n) / 16000
+            envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 2 * t)
+            f0 = 180 + 40 * math.sin(2 * math.pi * 0.5 * t)
+            value = sum(math.sin(2 * math.pi * k * f0 * t) / k for k in range(1, 6))
+            samples.append(int(3000 * envelope * value))
+        chunks.append(struct.pack(f"<{len(samples)}h", *samples))
+    return chunks
+
+
+def run_codec(codec_name, seconds, speed, bandwidth, chunks):
+    """
+    在限速链路上运行一次听写会话
+    :param codec_name: 上行编码
+    :return: 统计字典，编码不可用时返回None
+    """
+    codec = create_uplink_codec(codec_name)
+    if codec.encoding != codec_name:
+        return None
+    ctx = multiprocessing.get_context("spawn")
+    ready_queue, stats_queue = ctx.Queue(), ctx.Queue()
+    server = ctx.Process(target=_server_process, args=(bandwidth, ready_queue, stats_queue), daemon=True)
+    server.start()
+    port = ready_queue.get(timeout=10)
+
+    ws = StandInClient(f"ws://127.0.0.1:{port}/v2/iat", send_buffer=8192)
+    frames = int(seconds * 25)
+    interval = 0.04 / speed
+
+    # 队列足够大，不丢帧，积压全部体现为识别延迟
+    sender = AudioSender(ws, {"app_id": "bench"}, {"domain": "iat"}, max_frames=frames, codec=codec)
+    next_time = time.perf_counter()
+    for i in range(frames):
+        sender.send_audio(STATUS_FIRST_FRAME if i == 0 else STATUS_CONTINUE_FRAME, chunks[i % len(chunks)])
+        next_time += interval
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    speech_end = time.perf_counter()
+    sender.finish(timeout=120)
+    ws.recv()
+    latency = time.perf_counter() - speech_end
+
+    stats = sender.stats()
+    sender.close()
+    ws.close()
+    server_stats = stats_queue.get(timeout=10)
+    server.join(timeout=5)
+    return {
+        "wire_bytes": server_stats["wire_bytes"],
+        "audio_bytes": server_stats["audio_bytes"],
+        "encode_cpu_ms": stats["encode_cpu_ms"],
+        "latency_ms": latency * 1000 * speed,  # 换算为实际时间
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="上行多帧聚合基准测试")
+    parser.add_argument("--seconds", type=float, default=10, help="模拟的音频时长（秒）")
+    parser.add_argument("--speed", type=float, default=4, help="加速倍数")
+    parser.add_argument("--bandwidth", type=int, default=150000, help="拥塞场景的服务器接收带宽（字节/秒）")
+    parser.add_argument("--codecs", action="store_true", help="比较上行编码")
+    parser.add_argument("--codec-bandwidth", type=int, default=32000,
+                        help="编码对比时的链路带宽（字节/秒，按加速后的时间计算，默认约等于64kbit/s的实际链路）")
+    args = parser.parse_args()
+
+    if args.codecs:
+        chunks = _voice_chunks(25)
+        real_kbps = args.codec_bandwidth * 8 / args.speed / 1000
+        print(f"==== 限速链路 {real_kbps:.0f}kbit/s，音频 {args.seconds:.0f} 秒 ====")
+        for codec_name in (RAW, SPEEX_WB, LAME):
+            r = run_codec(codec_name, args.seconds, args.speed, args.codec_bandwidth, chunks)
+            if r is None:
+                print(f"[{codec_name:>8}] 编码库不可用，跳过")
+                continue
+            print(f"[{codec_name:>8}] 上行 {r['wire_bytes']} 字节（音频 {r['audio_bytes']} 字节，"
+                  f"{r['wire_bytes'] * 8 / args.seconds / 1000:.0f}kbit/s），编码CPU {r['encode_cpu_ms']:.1f} 毫秒"
+                  f"（每秒音频 {r['encode_cpu_ms'] / args.seconds:.2f} 毫秒），说完到识别结果 {r['latency_ms']:.0f} 毫秒")
+        raise SystemExit(0)
+
+    for link_name, bandwidth in (("正常链路", None), ("拥塞链路", args.bandwidth)):
+        print(f"==== {link_name} ====")
+        for aggregation in ("off", "adaptive", "always"):
+            r = run_once(aggregation, args.seconds, args.speed, bandwidth)
+            print(f"[{aggregation:>8}] 消息 {r['messages']} 条 ({r['messages_per_second']:.0f} 条/秒), "
+                  f"上行 {r['wire_bytes']} 字节, 客户端CPU {r['cpu_ms']:.0f} 毫秒, "
+                  f"聚合 {r['batched']} 帧, 发送延迟 平均 {r['latency_avg_ms']:.1f} / 最大 {r['latency_max_ms']:.1f} 毫秒, "
+                  f"耗时 {r['wall']:.2f} 秒")
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 听写上行音频压缩：在进程内把16kHz PCM流式编码后再发送，降低移动网络下的上行带宽
+# 原始PCM为256kbit/s，base64后还要再多三分之一；speex-wb约24kbit/s，MP3(lame)按设置的码率
+#
+# 支持的编码（与讯飞听写接口的 encoding 参数对应）:
+#   raw      - 不压缩（默认）
+#   speex-wb - 宽带speex，讯飞定制格式（每个压缩帧前加1字节长度），需要 libspeex
+#   lame     - MP3，关闭比特池使每帧可独立解码，需要 libmp3lame（只支持中文普通话和英文）
+# 编码器通过ctypes加载系统中的动态库，找不到时自动回退为raw
+# 每次听写会话创建一个编码器，未凑满一帧的采样留到下一次，会话结束时补零输出
+#
+# 环境变量:
+#   ASR_UPLINK_CODEC: raw / speex-wb / lame，默认raw
+#   ASR_SPEEX_QUALITY: speex质量等级0-10，默认8
+#   ASR_MP3_BITRATE: MP3码率（kbit/s），默认32
+#   SPEEX_LIBRARY / LAME_LIBRARY: 动态库路径，留空时按系统默认位置查找
+#
+# 慢速链路对比（上行字节、编码CPU、识别延迟）: python uplink_bench.py --codecs
+
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+
+from settings import get_settings
+
+RAW = "raw"
+SPEEX_WB = "speex-wb"
+LAME = "lame"
+
+AUDIO_FORMAT = "audio/L16;rate=16000"  # 编码前的音频格式，压缩时也按原始采样率填写
+
+_libraries = {}
+_library_lock = threading.Lock()
+
+
+def load_codec_library(name, env_name):
+    """
+    加载编码器动态库（进程内只加载一次）
+    :param name: 库名，例如 speex
+    :param env_name: 指定库路径的环境变量
+    :return: ctypes.CDLL，找不到时返回None
+    """
+    with _library_lock:
+        if name not in _libraries:
+            path = os.getenv(env_name, "").strip() or ctypes.util.find_library(name)
+            library = None
+            if path:
+                try:
+                    library = ctypes.CDLL(path)
+                except OSError as e:
+                    print(f"加载 {path} 失败: {e}")
+            _libraries[name] = library
+        return _libraries[name]
+
+
+class RawCodec:
+    """
+    不压缩，原样发送PCM
+    """
+    encoding = RAW
+
+    def __init__(self):
+        self.cpu_time = 0.0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def encode(self, pcm):
+        """
+        编码一段PCM
+        :param pcm: 16位单声道PCM字节
+        :return: 编码后的字节（可能为空，剩余采样留到下一次）
+        """
+        self.input_bytes += len(pcm)
+        self.output_bytes += len(pcm)
+        return pcm
+
+    def flush(self):
+        """
+        会话结束时输出剩余数据
+        """
+        return b""
+
+    def close(self):
+        pass
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        ratio = self.input_bytes / self.output_bytes if self.output_bytes else 1.0
+        return f"上行编码 {self.encoding}: {self.input_bytes} -> {self.output_bytes} 字节（{ratio:.1f}倍），编码CPU {self.cpu_time * 1000:.1f} 毫秒"
+
+
+class SpeexBits(ctypes.Structure):
+    """
+    speex_bits.h 中的 SpeexBits
+    """
+    _fields_ = [
+        ("chars", ctypes.c_char_p),
+        ("nbBits", ctypes.c_int),
+        ("charPtr", ctypes.c_int),
+        ("bitPtr", ctypes.c_int),
+        ("owner", ctypes.c_int),
+        ("overflow", ctypes.c_int),
+        ("buf_size", ctypes.c_int),
+        ("reserved1", ctypes.c_int),
+        ("reserved2", ctypes.c_void_p),
+    ]
+
+
+class SpeexWbCodec(RawCodec):
+    """
+    宽带speex编码器，输出讯飞定制格式：每个20毫秒压缩帧前加1字节长度
+    """
+    encoding = SPEEX_WB
+
+    _MODEID_WB = 1
+    _SET_QUALITY = 4
+    _GET_FRAME_SIZE = 3
+
+    def __init__(self, library, quality=None):
+        """
+        :param library: libspeex
+        :param quality: 质量等级0-10
+        """
+        super().__init__()
+        self.lib = library
+        library.speex_lib_get_mode.restype = ctypes.c_void_p
+        library.speex_encoder_init.restype = ctypes.c_void_p
+        library.speex_encoder_init.argtypes = [ctypes.c_void_p]
+        library.speex_encoder_ctl.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+        library.speex_encode_int.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int16), ctypes.POINTER(SpeexBits)]
+        library.speex_bits_write.argtypes = [ctypes.POINTER(SpeexBits), ctypes.c_char_p, ctypes.c_int]
+        library.speex_encoder_destroy.argtypes = [ctypes.c_void_p]
+
+        self.quality = quality if quality is not None else get_settings().asr_speex_quality
+        self._state = library.speex_encoder_init(library.speex_lib_get_mode(self._MODEID_WB))
+        value = ctypes.c_int(self.quality)
+        library.speex_encoder_ctl(self._state, self._SET_QUALITY, ctypes.byref(value))
+        library.speex_encoder_ctl(self._state, self._GET_FRAME_SIZE, ctypes.byref(value))
+        self.frame_size = value.value  # 每帧采样数（宽带为320）
+        self._bits = SpeexBits()
+        library.speex_bits_init(ctypes.byref(self._bits))
+        self._frame = (ctypes.c_int16 * self.frame_size)()
+        self._out = ctypes.create_string_buffer(255)
+        self._pending = b""
+
+    def encode(self, pcm):
+        start = time.thread_time()
+        self.input_bytes += len(pcm)
+        data = self._pending + pcm
+        frame_bytes = self.frame_size * 2
+        usable = len(data) - len(data) % frame_bytes
+        self._pending = data[usable:]
+        parts = []
+        for offset in range(0, usable, frame_bytes):
+            ctypes.memmove(self._frame, data[offset:offset + frame_bytes], frame_bytes)
+            self.lib.speex_bits_reset(ctypes.byref(self._bits))
+            self.lib.speex_encode_int(self._state, self._frame, ctypes.byref(self._bits))
+            size = self.lib.speex_bits_write(ctypes.byref(self._bits), self._out, len(self._out))
+            parts.append(bytes((size,)) + self._out.raw[:size])
+        out = b"".join(parts)
+        self.output_bytes += len(out)
+        self.cpu_time += time.thread_time() - start
+        return out
+
+    def flush(self):
+        if not self._pending:
+            return b""
+        # 不足一帧的尾部补零
+        self._pending += b"\x00" * (self.frame_size * 2 - len(self._pending))
+        self.input_bytes -= len(self._pending)
+        pending, self._pending = self._pending, b""
+        return self.encode(pending)
+
+    def close(self):
+        if self._state:
+            self.lib.speex_bits_destroy(ctypes.byref(self._bits))
+            self.lib.speex_encoder_destroy(self._state)
+            self._state = None
+
+
+class LameCodec(RawCodec):
+    """
+    MP3编码器（libmp3lame），单声道CBR，关闭比特池使丢弃中间帧时其余帧仍可解码
+    """
+    encoding = LAME
+
+    _MONO = 3
+
+    def __init__(self, library, bitrate=None, rate=16000):
+        """
+        :param library: libmp3lame
+        :param bitrate: 码率（kbit/s）
+        :param rate: 采样率
+        """
+        super().__init__()
+        self.lib = library
+        library.lame_init.restype = ctypes.c_void_p
+        for name in ("lame_set_in_samplerate", "lame_set_out_samplerate", "lame_set_num_channels", "lame_set_mode",
+                     "lame_set_brate", "lame_set_quality", "lame_set_disable_reservoir"):
+            getattr(library, name).argtypes = [ctypes.c_void_p, ctypes.c_int]
+        library.lame_init_params.argtypes = [ctypes.c_void_p]
+        library.lame_encode_buffer.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int,
+                                               ctypes.c_char_p, ctypes.c_int]
+        library.lame_encode_flush.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+        library.lame_close.argtypes = [ctypes.c_void_p]
+
+        self.bitrate = bitrate or get_settings().asr_mp3_bitrate
+        self._gfp = library.lame_init()
+        library.lame_set_in_samplerate(self._gfp, rate)
+        library.lame_set_out_samplerate(self._gfp, rate)
+        library.lame_set_num_channels(self._gfp, 1)
+        library.lame_set_mode(self._gfp, self._MONO)
+        library.lame_set_brate(self._gfp, self.bitrate)
+        library.lame_set_quality(self._gfp, 7)  # 7为快速编码
+        library.lame_set_disable_reservoir(self._gfp, 1)
+        if library.lame_init_params(self._gfp) < 0:
+            library.lame_close(self._gfp)
+            raise ValueError(f"lame不支持 {rate}Hz / {self.bitrate}kbit/s")
+        self._out = ctypes.create_string_buffer(16384)
+
+    def _ensure_buffer(self, samples):
+        # lame要求输出缓冲区至少为 1.25 * 采样数 + 7200 字节
+        need = int(1.25 * samples) + 7200
+        if len(self._out) < need:
+            self._out = ctypes.create_string_buffer(need)
+
+    def encode(self, pcm):
+        start = time.thread_time()
+        self.input_bytes += len(pcm)
+        samples = len(pcm) // 2
+        self._ensure_buffer(samples)
+        size = self.lib.lame_encode_buffer(self._gfp, pcm, pcm, samples, self._out, len(self._out))
+        out = self._out.raw[:size] if size > 0 else b""
+        self.output_bytes += len(out)
+        self.cpu_time += time.thread_time() - start
+        return out
+
+    def flush(self):
+        start = time.thread_time()
+        size = self.lib.lame_encode_flush(self._gfp, self._out, len(self._out))
+        out = self._out.raw[:size] if size > 0 else b""
+        self.output_bytes += len(out)
+        self.cpu_time += time.thread_time() - start
+        return out
+
+    def close(self):
+        if self._gfp:
+            self.lib.lame_close(self._gfp)
+            self._gfp = None
+
+
+_warned = set()
+
+
+def create_uplink_codec(name=None):
+    """
+    为一次听写会话创建上行编码器，编码库不可用时回退为raw
+    :param name: raw / speex-wb / lame，None时读取 ASR_UPLINK_CODEC
+    :return: 编码器对象（encoding 属性为讯飞接口的编码参数）
+    """
+    name = (name or get_settings().asr_uplink_codec).strip().lower()
+    if name == RAW:
+        return RawCodec()
+    try:
+        if name == SPEEX_WB:
+            library = load_codec_library("speex", "SPEEX_LIBRARY")
+            if library is not None:
+                return SpeexWbCodec(library)
+        elif name == LAME:
+            library = load_codec_library("mp3lame", "LAME_LIBRARY")
+            if library is not None:
+                return LameCodec(library)
+        else:
+            raise ValueError(f"不支持的上行编码 {name}")
+        reason = "找不到编码库"
+    except (AttributeError, ValueError) as e:
+        reason = str(e)
+    if name not in _warned:
+        _warned.add(name)
+        print(f"上行编码 {name} 不可用（{reason}），改为发送原始PCM")
+    return RawCodec()
+
+
+def uplink_encoding():
+    """
+    当前配置实际使用的编码参数（手动构建听写消息时使用）
+    """
+    codec = create_uplink_codec()
+    codec.close()
+    return codec.encoding
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 唤醒词回放基准测试：用录制好的音频比较完整识别(full)和关键词检测(kws)两种模式
+# 统计每帧CPU耗时、检测延迟、漏检和误唤醒
+#
+# 录音目录结构:
+#   <录音目录>/positive/*.wav  包含唤醒词的录音
+#   <录音目录>/negative/*.wav  不包含唤醒词的录音，用于统计误唤醒
+# 可选: positive/xxx.txt 中写入唤醒词结束的时间（秒），用于计算检测延迟
+# 音频要求: 16kHz、单声道、16位PCM WAV
+#
+# 用法:
+#   python wake_replay.py ./wake_corpus
+#   python wake_replay.py ./wake_corpus --modes kws
+
+import argparse
+import glob
+import os
+import time
+import wave
+
+from WakeUp import VoskWakeup, is_silent
+
+# 与 VoskWakeup._listen_for_wakeword 保持一致的音频参数
+CHUNK = 1280
+RATE = 16000
+SILENCE_THRESHOLD = 500
+
+
+def load_wav(path):
+    """
+    读取WAV文件
+    :param path: 文件路径
+    :return: PCM字节数据
+    """
+    with wave.open(path, "rb") as wav:
+        if wav.getframerate() != RATE or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise ValueError(f"{path} 不是16kHz单声道16位PCM音频")
+        return wav.readframes(wav.getnframes())
+
+
+def load_label(path):
+    """
+    读取唤醒词结束时间标注
+    :return: 秒数，没有标注时返回None
+    """
+    label_path = os.path.splitext(path)[0] + ".txt"
+    if not os.path.exists(label_path):
+        return None
+    with open(label_path, "r", encoding="utf-8") as f:
+        return float(f.read().strip())
+
+
+def replay_file(detector, pcm):
+    """
+    按实时帧大小回放一段录音
+    :param detector: VoskWakeup对象
+    :param pcm: PCM字节数据
+    :return: (检测到的唤醒词, 检测时刻秒数, 处理帧数, CPU总耗时秒)
+    """
+    recognizer = detector._create_recognizer(RATE)
+    frame_bytes = CHUNK * 2
+    frames = 0
+    cpu_time = 0.0
+
+    for offset in range(0, len(pcm) - frame_bytes + 1, frame_bytes):
+        data = pcm[offset:offset + frame_bytes]
+        start = time.process_time()
+        wake_word = None
+        if not is_silent(data, SILENCE_THRESHOLD):
+            wake_word = detector.process_audio(recognizer, data)
+        cpu_time += time.process_time() - start
+        frames += 1
+        if wake_word:
+            return wake_word, (offset + frame_bytes) / 2 / RATE, frames, cpu_time
+
+    return None, None, frames, cpu_time
+
+
+def run_mode(detector, mode, positives, negatives):
+    """
+    用指定模式回放全部录音并输出统计
+    """
+    detector.mode = mode
+    total_frames = 0
+    total_cpu = 0.0
+    misses = 0
+    false_accepts = 0
+    latencies = []
+
+    for path, pcm in positives:
+        wake_word, detect_time, frames, cpu_time = replay_file(detector, pcm)
+        total_frames += frames
+        total_cpu += cpu_time
+        if wake_word is None:
+            misses += 1
+            print(f"[{mode}] 漏检: {os.path.basename(path)}")
+            continue
+        label = load_label(path)
+        if label is not None:
+            latencies.append(detect_time - label)
+
+    for path, pcm in negatives:
+        wake_word, detect_time, frames, cpu_time = replay_file(detector, pcm)
+        total_frames += frames
+        total_cpu += cpu_time
+        if wake_word is not None:
+            false_accepts += 1
+            print(f"[{mode}] 误唤醒: {os.path.basename(path)} ({wake_word} @ {detect_time:.2f}s)")
+
+    audio_seconds = total_frames * CHUNK / RATE
+    print(f"\n==== 模式: {mode} ====")
+    print(f"回放音频: {audio_seconds:.1f} 秒, {total_frames} 帧")
+    if total_frames:
+        print(f"每帧CPU耗时: {total_cpu / total_frames * 1e3:.3f} 毫秒")
+        print(f"CPU占用: {total_cpu / audio_seconds * 100:.2f}% (单核)")
+    print(f"漏检: {misses}/{len(positives)}")
+    print(f"误唤醒: {false_accepts}/{len(negatives)}")
+    if latencies:
+        latencies.sort()
+        print(f"检测延迟: 平均 {sum(latencies) / len(latencies) * 1e3:.0f} 毫秒, "
+              f"最大 {latencies[-1] * 1e3:.0f} 毫秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="唤醒词回放基准测试")
+    parser.add_argument("corpus", help="录音目录，包含 positive/ 和 negative/ 子目录")
+    parser.add_argument("--modes", default="full,kws", help="要比较的模式，逗号分隔")
+    args = parser.parse_args()
+
+    positives = [(path, load_wav(path)) for path in sorted(glob.glob(os.path.join(args.corpus, "positive", "*.wav")))]
+    negatives = [(path, load_wav(path)) for path in sorted(glob.glob(os.path.join(args.corpus, "negative", "*.wav")))]
+    if not positives and not negatives:
+        print(f"在 {args.corpus} 中没有找到录音")
+        return
+
+    model_path = os.getenv("VOSK_MODEL_PATH", "./vosk-model-small-cn")
+    wake_words_str = os.getenv("WAKE_WORDS", "一二三,你好小知,小智小智,小知小知")
+    wake_words = [word.strip() for word in wake_words_str.split(",")]
+    detector = VoskWakeup(model_path, wake_words)
+
+    for mode in args.modes.split(","):
+        run_mode(detector, mode.strip(), positives, negatives)
+
+
+if __name__ == "__main__":
+    main()
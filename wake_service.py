@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 多通道唤醒词检测服务：一台机器同时监听多个麦克风（如多房间部署）
+# - 识别器运行在进程池中，绕开GIL限制
+# - 音频通过共享内存环形缓冲区传给工作进程，不经过管道拷贝
+# - 工作进程用 forkserver（不支持时用 spawn）启动，不继承父进程中日志、配置监视、线程池等后台线程的状态
+# - forkserver 启动时预先加载Vosk模型，从它fork出的各工作进程以写时复制的方式共享同一份模型内存；
+#   spawn 方式（或forkserver已经在别处启动过）时每个工作进程各自加载一份
+# - 检测结果带通道ID和时间戳
+#
+# 用法示例:
+#   service = MultiChannelWakeService(model_path, wake_words, channel_ids=["客厅", "卧室"])
+#   service.start()
+#   service.feed("客厅", pcm_bytes)            # 或 service.attach_microphone("客厅", device_index)
+#   detection = service.get_detection(timeout=1)
+#
+# 负载测试（吞吐量和每个工作进程的RSS/PSS）: python wake_service.py --channels 8 --seconds 10
+
+import multiprocessing
+import os
+import queue
+import struct
+import time
+from multiprocessing import shared_memory
+
+from asr_backends import PRELOAD_MODEL_ENV
+
+# 音频参数，与 VoskWakeup 保持一致
+CHUNK = 1280  # 每帧采样数
+RATE = 16000  # 采样率
+FRAME_BYTES = CHUNK * 2  # 每帧字节数（16位单声道）
+SILENCE_THRESHOLD = 500  # 静音检测阈值
+
+# 环形缓冲区头部：写入位置、读取位置、丢弃字节数（均为单调递增的uint64）
+_HEADER = struct.Struct("<QQQ")
+
+
+class ShmRingBuffer:
+    """
+    基于共享内存的单生产者单消费者环形缓冲区
+    写入方只修改写入位置，读取方只修改读取位置；读写都在进程间锁内完成，
+    锁的获取和释放同时是内存屏障，在ARM等弱内存序的平台上读取方也不会先看到新的写入位置、后看到数据
+    """
+    def __init__(self, capacity=None, name=None, lock=None):
+        """
+        创建或连接环形缓冲区
+        :param capacity: 数据区容量（字节），创建时必须提供
+        :param name: 共享内存名称，提供时连接已有的缓冲区
+        :param lock: 进程间锁，连接已有的缓冲区时传入创建方的 lock
+        """
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_HEADER.size + capacity)
+            _HEADER.pack_into(self.shm.buf, 0, 0, 0, 0)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.capacity = self.shm.size - _HEADER.size
+        self._data = self.shm.buf[_HEADER.size:_HEADER.size + self.capacity]
+
+    def _positions(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)
+
+    def write(self, data):
+        """
+        写入数据，空间不足时整块丢弃
+        :param data: 字节数据
+        :return: 是否写入成功
+        """
+        with self.lock:
+            return self._write(data)
+
+    def _write(self, data):
+        write_pos, read_pos, dropped = self._positions()
+        size = len(data)
+        if size > self.capacity - (write_pos - read_pos):
+            struct.pack_into("<Q", self.shm.buf, 16, dropped + size)
+            return False
+
+        start = write_pos % self.capacity
+        first = min(size, self.capacity - start)
+        self._data[start:start + first] = data[:first]
+        if first < size:
+            self._data[0:size - first] = data[first:]
+
+        # 数据写完后再更新写入位置
+        struct.pack_into("<Q", self.shm.buf, 0, write_pos + size)
+        return True
+
+    def read(self, max_bytes, align=1):
+        """
+        读取数据
+        :param max_bytes: 最多读取的字节数
+        :param align: 读取长度按此字节数对齐（例如整帧）
+        :return: 字节数据，没有足够数据时返回空字节串
+        """
+        with self.lock:
+            return self._read(max_bytes, align)
+
+    def _read(self, max_bytes, align):
+        write_pos, read_pos, _ = self._positions()
+        size = min(write_pos - read_pos, max_bytes)
+        size -= size % align
+        if size <= 0:
+            return b""
+
+        start = read_pos % self.capacity
+        first = min(size, self.capacity - start)
+        data = bytes(self._data[start:start + first])
+        if first < size:
+            data += bytes(self._data[0:size - first])
+
+        struct.pack_into("<Q", self.shm.buf, 8, read_pos + size)
+        return data
+
+    def stats(self):
+        """
+        获取统计信息
+        :return: {"written": 累计写入字节, "consumed": 累计读取字节, "dropped": 累计丢弃字节}
+        """
+        with self.lock:
+            write_pos, read_pos, dropped = self._positions()
+        return {"written": write_pos, "consumed": read_pos, "dropped": dropped}
+
+    def close(self):
+        """
+        关闭缓冲区，创建者负责释放共享内存
+        """
+        self._data.release()
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _wake_worker(channels, model_path, wake_words, mode, result_queue, stop_event):
+    """
+    工作进程：轮询分配给本进程的各通道环形缓冲区并进行唤醒词检测
+    :param channels: [(通道ID, 共享内存名称, 环形缓冲区的锁), ...]
+    :param model_path: Vosk模型路径
+    :param wake_words: 唤醒词列表
+    :param mode: 识别模式
+    :param result_queue: 检测结果队列
+    :param stop_event: 停止事件
+    """
+    from WakeUp import VoskWakeup, is_silent
+
+    states = []
+    for channel_id, shm_name, lock in channels:
+        # 模型在本进程内只加载一次，分配到的各通道共用
+        detector = VoskWakeup(model_path, wake_words, mode=mode)
+        recognizer = detector._create_recognizer(RATE)
+        states.append([channel_id, ShmRingBuffer(name=shm_name, lock=lock), detector, recognizer, 0])
+
+    try:
+        while not stop_event.is_set():
+            idle = True
+            for state in states:
+                channel_id, ring, detector, recognizer, consumed = state
+                data = ring.read(FRAME_BYTES * 4, align=FRAME_BYTES)
+                if not data:
+                    continue
+                idle = False
+
+                for offset in range(0, len(data), FRAME_BYTES):
+                    frame = data[offset:offset + FRAME_BYTES]
+                    consumed += FRAME_BYTES
+                    if is_silent(frame, SILENCE_THRESHOLD):
+                        continue
+                    wake_word = detector.process_audio(recognizer, frame)
+                    if wake_word:
+                        result_queue.put({
+                            "channel": channel_id,
+                            "wake_word": wake_word,
+                            "audio_time": consumed / 2 / RATE,  # 通道音频流中的时刻（秒）
+                            "timestamp": time.time()  # 检测到的系统时间
+                        })
+                        recognizer.Reset()
+                        detector._last_partial = ""
+                state[4] = consumed
+
+            if idle:
+                time.sleep(0.005)
+    finally:
+        for state in states:
+            state[1].close()
+
+
+class MultiChannelWakeService:
+    """
+    多通道唤醒词检测服务
+    """
+    def __init__(self, model_path, wake_words, channel_ids, workers=None, mode=None, buffer_seconds=2):
+        """
+        :param model_path: Vosk模型路径
+        :param wake_words: 唤醒词列表
+        :param channel_ids: 通道ID列表
+        :param workers: 工作进程数，默认为CPU核数与通道数中较小者
+        :param mode: 识别模式，同 VoskWakeup
+        :param buffer_seconds: 每个通道环形缓冲区可容纳的音频时长（秒）
+        """
+        self.model_path = model_path
+        self.wake_words = wake_words
+        self.channel_ids = list(channel_ids)
+        self.workers = workers or min(os.cpu_count() or 1, len(self.channel_ids))
+        self.mode = mode
+        self.buffer_bytes = int(buffer_seconds * RATE) * 2
+        self.buffer_bytes -= self.buffer_bytes % FRAME_BYTES
+
+        self.rings = {}
+        self.processes = []
+        self.streams = []
+        self.pyaudio = None
+
+        # 不使用fork：父进程中已有日志、配置监视、线程池等线程，fork出的子进程可能继承被持有的锁
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.result_queue = self.context.Queue()
+        self.stop_event = self.context.Event()
+
+    def start(self):
+        """
+        创建环形缓冲区并启动工作进程
+        """
+        for channel_id in self.channel_ids:
+            self.rings[channel_id] = ShmRingBuffer(capacity=self.buffer_bytes, lock=self.context.Lock())
+
+        # 通道按轮询方式分配给工作进程
+        assignments = [[] for _ in range(self.workers)]
+        for index, channel_id in enumerate(self.channel_ids):
+            ring = self.rings[channel_id]
+            assignments[index % self.workers].append((channel_id, ring.name, ring.lock))
+
+        # forkserver在第一个工作进程启动时创建，创建时预导入 asr_backends 并加载模型，工作进程共享这份模型
+        forkserver = self.context.get_start_method() == "forkserver"
+        if forkserver:
+            self.context.set_forkserver_preload(["asr_backends"])
+            os.environ[PRELOAD_MODEL_ENV] = self.model_path
+        try:
+            for index, channels in enumerate(assignments):
+                if not channels:
+                    continue
+                process = self.context.Process(
+                    target=_wake_worker,
+                    args=(channels, self.model_path, self.wake_words, self.mode, self.result_queue, self.stop_event),
+                    name=f"wake-worker-{index}",
+                    daemon=True
+                )
+                process.start()
+                self.processes.append(process)
+        finally:
+            if forkserver:
+                os.environ.pop(PRELOAD_MODEL_ENV, None)
+
+        print(f"多通道唤醒服务已启动: {len(self.channel_ids)} 个通道, {len(self.processes)} 个工作进程")
+
+    def feed(self, channel_id, pcm):
+        """
+        写入一个通道的音频数据（16kHz单声道16位PCM）
+        :return: 是否写入成功，缓冲区已满时丢弃并返回False
+        """
+        return self.rings[channel_id].write(pcm)
+
+    def attach_microphone(self, channel_id, device_index=None):
+        """
+        将麦克风采集直接写入通道的环形缓冲区
+        :param channel_id: 通道ID
+        :param device_index: PyAudio输入设备索引
+        """
+        import pyaudio
+        from resample import capture_rate, StreamingResampler
+        from audio_frontend import AudioFrontEnd
+
+        if self.pyaudio is None:
+            self.pyaudio = pyaudio.PyAudio()
+        ring = self.rings[channel_id]
+        # 设备不支持16kHz时按原生采样率采集，在回调中转换后写入环形缓冲区
+        native, device_index = capture_rate(self.pyaudio, RATE, device_index)
+        resampler = StreamingResampler(native, RATE)
+        # 每个麦克风单独估计噪声和增益
+        frontend = AudioFrontEnd(RATE)
+
+        def callback(in_data, frame_count, time_info, status):
+            ring.write(frontend.process(resampler.process(in_data)))
+            return None, pyaudio.paContinue
+
+        stream = self.pyaudio.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=native,
+            input=True,
+            input_device_index=device_index,
+            frames_per_buffer=CHUNK * native // RATE,
+            stream_callback=callback
+        )
+        stream.start_stream()
+        self.streams.append(stream)
+
+    def get_detection(self, timeout=None):
+        """
+        获取一条检测结果
+        :return: {"channel", "wake_word", "audio_time", "timestamp"}，超时返回None
+        """
+        try:
+            return self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stats(self):
+        """
+        获取各通道环形缓冲区统计
+        """
+        return {channel_id: ring.stats() for channel_id, ring in self.rings.items()}
+
+    def worker_memory(self):
+        """
+        获取各工作进程的内存占用
+        :return: [(进程名, RSS字节, PSS字节), ...]，无法获取的项为None
+        """
+        from resource_monitor import process_memory
+        return [(process.name, *process_memory(process.pid)) for process in self.processes if process.is_alive()]
+
+    def stop(self):
+        """
+        停止工作进程并释放共享内存
+        """
+        for stream in self.streams:
+            try:
+                stream.stop_stream()
+                stream.close()
+            except Exception as e:
+                print(f"关闭音频流时出错: {e}")
+        self.streams = []
+        if self.pyaudio is not None:
+            self.pyaudio.terminate()
+            self.pyaudio = None
+
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+        print("多通道唤醒服务已停止")
+
+
+def _load_test(channels, workers, seconds, model_path, wake_words, pcm):
+    """
+    负载测试：以最快速度向N个通道写入音频，统计处理吞吐量和工作进程的内存占用
+    :return: (每秒处理的音频秒数, 各工作进程的内存占用)
+    """
+    service = MultiChannelWakeService(model_path, wake_words, [f"ch{i}" for i in range(channels)], workers=workers)
+    service.start()
+    total = int(seconds * RATE) * 2
+    total -= total % FRAME_BYTES
+    written = {channel_id: 0 for channel_id in service.channel_ids}
+
+    start = time.perf_counter()
+    while True:
+        pending = False
+        for channel_id in service.channel_ids:
+            position = written[channel_id]
+            if position >= total:
+                continue
+            pending = True
+            offset = position % len(pcm)
+            block = pcm[offset:offset + FRAME_BYTES * 4]
+            if service.rings[channel_id].write(block):
+                written[channel_id] += len(block)
+        consumed = sum(stat["consumed"] for stat in service.stats().values())
+        if not pending and consumed >= total * channels:
+            break
+        if not pending:
+            time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    memory = service.worker_memory()
+    service.stop()
+    return channels * seconds / elapsed, memory
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import array
+    import wave
+
+    parser = argparse.ArgumentParser(description="多通道唤醒词检测负载测试")
+    parser.add_argument("--channels", type=int, default=8, help="合成通道数")
+    parser.add_argument("--seconds", type=float, default=10, help="每个通道的音频时长（秒）")
+    parser.add_argument("--wav", help="用于回放的16kHz单声道WAV，默认使用合成噪声")
+    args = parser.parse_args()
+
+    model_path = os.getenv("VOSK_MODEL_PATH", "./vosk-model-small-cn")
+    wake_words = [word.strip() for word in os.getenv("WAKE_WORDS", "一二三").split(",")]
+
+    if args.wav:
+        with wave.open(args.wav, "rb") as wav:
+            pcm = wav.readframes(wav.getnframes())
+    else:
+        # 超过静音阈值的合成噪声，保证每帧都会送入识别器
+        random.seed(0)
+        pcm = array.array("h", (random.randint(-4000, 4000) for _ in range(RATE * 2))).tobytes()
+    pcm = pcm[:len(pcm) - len(pcm) % FRAME_BYTES]
+
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cores, min(cores, args.channels)})
+    baseline = None
+    for workers in worker_counts:
+        if workers > args.channels:
+            continue
+        throughput, memory = _load_test(args.channels, workers, args.seconds, model_path, wake_words, pcm)
+        baseline = baseline or throughput
+        print(f"工作进程 {workers}: {throughput:.1f} 音频秒/秒 "
+              f"(加速比 {throughput / baseline:.2f}, 可实时处理约 {int(throughput)} 个通道)")
+        # RSS按全额计算共享的模型页面，PSS按共享进程数平摊；模型共享时PSS合计明显小于RSS合计
+        mb = lambda value: f"{value / 1024 / 1024:.0f}" if value is not None else "?"
+        print("  每个工作进程 RSS/PSS: " + ", ".join(f"{name} {mb(rss)}/{mb(pss)} MB" for name, rss, pss in memory))
+        if memory and all(rss is not None and pss is not None for _, rss, pss in memory):
+            print(f"  合计 RSS {mb(sum(m[1] for m in memory))} MB, PSS {mb(sum(m[2] for m in memory))} MB")
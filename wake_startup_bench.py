@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 唤醒引擎启动/恢复基准测试
+# 对比两种方式从"开始监听"到"读取到第一帧音频"的耗时:
+#   1. 旧方式：每次新建识别器、PyAudio对象并重新打开音频设备
+#   2. 常驻引擎：VoskWakeup暂停后直接恢复（识别器Reset，音频流重新start）
+# 需要可用的麦克风和Vosk模型
+#
+# 用法: python wake_startup_bench.py [--rounds 10]
+
+import argparse
+import os
+import time
+
+start_time = time.perf_counter()
+import pyaudio
+from vosk import KaldiRecognizer
+import_time = time.perf_counter() - start_time
+
+from WakeUp import VoskWakeup, get_shared_model
+
+CHUNK = 1280
+RATE = 16000
+
+
+def summarize(name, samples):
+    """
+    输出耗时统计
+    """
+    samples = sorted(samples)
+    print(f"{name}: 平均 {sum(samples) / len(samples) * 1000:.2f} 毫秒, "
+          f"最小 {samples[0] * 1000:.2f} 毫秒, 最大 {samples[-1] * 1000:.2f} 毫秒")
+
+
+def cold_listen(model):
+    """
+    旧方式：新建识别器和音频设备，读取第一帧
+    :return: 耗时（秒）
+    """
+    start = time.perf_counter()
+    p = pyaudio.PyAudio()
+    recognizer = KaldiRecognizer(model, RATE)
+    recognizer.SetWords(True)
+    stream = p.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK)
+    stream.read(CHUNK, exception_on_overflow=False)
+    elapsed = time.perf_counter() - start
+    stream.stop_stream()
+    stream.close()
+    p.terminate()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="唤醒引擎启动/恢复基准测试")
+    parser.add_argument("--rounds", type=int, default=10, help="测试轮数")
+    args = parser.parse_args()
+
+    model_path = os.getenv("VOSK_MODEL_PATH", "./vosk-model-small-cn")
+    wake_words = [word.strip() for word in os.getenv("WAKE_WORDS", "一二三").split(",")]
+
+    print(f"导入 vosk/pyaudio: {import_time * 1000:.0f} 毫秒")
+
+    start = time.perf_counter()
+    model = get_shared_model(model_path)
+    print(f"首次加载模型: {(time.perf_counter() - start) * 1000:.0f} 毫秒")
+    start = time.perf_counter()
+    get_shared_model(model_path)
+    print(f"再次获取模型(共享缓存): {(time.perf_counter() - start) * 1e6:.1f} 微秒")
+
+    # 旧方式
+    summarize("旧方式 新建识别器+打开设备到首帧", [cold_listen(model) for _ in range(args.rounds)])
+
+    # 常驻引擎
+    detector = VoskWakeup(model_path, wake_words)
+    detector.start()
+    detector.listening.wait(timeout=10)
+    print(f"常驻引擎 冷启动到首帧: {detector.resume_latency * 1000:.2f} 毫秒")
+
+    call_costs = []
+    resume_latencies = []
+    for _ in range(args.rounds):
+        detector.stop()  # 返回时监听线程已停止音频流
+        start = time.perf_counter()
+        detector.start()
+        call_costs.append(time.perf_counter() - start)
+        detector.listening.wait(timeout=10)
+        resume_latencies.append(detector.resume_latency)
+
+    summarize("常驻引擎 start() 调用耗时", call_costs)
+    summarize("常驻引擎 恢复到首帧", resume_latencies)
+    detector.close()
+
+
+if __name__ == "__main__":
+    main()
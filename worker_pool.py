@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 共享工作线程池：代替各模块在回调中临时创建线程
+#
+# 任务分两类，分别在两组线程中运行，长任务不会占满短任务的工作线程：
+# - 短任务（submit / submit_or_run）：初始化TTS、ASR预连接、关闭对冲中落后的连接等，在有上限的共享线程池中运行
+# - 长任务（submit_long）：WebSocket连接循环、录音等会持续整轮对话、并且可能等待其他任务的工作，
+#   没有空闲线程时总是新建线程，不会排在其他长任务后面；线程用完后同样复用
+#
+# - 工作线程按需创建，空闲超过一定时间后退出
+# - 短任务队列有界，队列满时 submit 抛出 RuntimeError，不会无限堆积；submit_or_run 此时在调用线程中直接执行
+# - 统计提交/完成/失败数、排队等待时间和队列峰值，report() 输出一行摘要
+# - 进程退出时自动关闭，也可以调用 shutdown() 主动关闭
+#
+# 环境变量:
+#   WORKER_POOL_SIZE: 短任务工作线程上限，默认8
+#   WORKER_POOL_QUEUE: 短任务队列上限，默认64
+#
+# 性能测试: python worker_pool.py --turns 2000
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait as wait_futures
+
+from event_log import log, WARNING
+from settings import get_settings
+
+_STOP = object()  # 通知工作线程退出的标记
+
+
+class WorkerPool:
+    """
+    有界工作线程池
+    """
+    def __init__(self, max_workers=8, max_queue=64, name="worker", idle_timeout=60.0):
+        """
+        :param max_workers: 工作线程上限，None表示不限（没有空闲线程时总是新建）
+        :param max_queue: 任务队列上限，0表示不限
+        :param name: 工作线程名称前缀
+        :param idle_timeout: 空闲线程退出前等待的秒数
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self._tasks = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._idle = 0
+        self._shutdown = False
+        self._next_id = 0
+
+        # 统计
+        self.threads_created = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queue = 0
+        self.peak_workers = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, fn, *args, name=None, **kwargs):
+        """
+        提交任务
+        :param fn: 任务函数
+        :param name: 任务名称，执行期间作为工作线程名称的后缀，便于排查
+        :return: concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("工作线程池已关闭")
+            try:
+                self._tasks.put_nowait((future, fn, args, kwargs, name, time.perf_counter()))
+            except queue.Full:
+                raise RuntimeError(f"工作线程池任务队列已满（{self._tasks.maxsize}）")
+            self.submitted += 1
+            self.peak_queue = max(self.peak_queue, self._tasks.qsize())
+            # 没有空闲线程时再创建新线程
+            if self._idle < self._tasks.qsize() and (self.max_workers is None or len(self._workers) < self.max_workers):
+                self._spawn()
+        return future
+
+    def _spawn(self):
+        self._next_id += 1
+        worker = threading.Thread(target=self._run, name=f"{self.name}-{self._next_id}", daemon=True)
+        worker.base_name = worker.name
+        self._workers.add(worker)
+        self.threads_created += 1
+        self.peak_workers = max(self.peak_workers, len(self._workers))
+        worker.start()
+
+    def _run(self):
+        worker = threading.current_thread()
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                task = self._tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                task = None
+            with self._lock:
+                self._idle -= 1
+                if task is None and not self._shutdown and self._tasks.qsize():
+                    # 超时的同时有新任务入队（提交时把本线程算作空闲），继续处理
+                    continue
+                if task is None or task is _STOP:
+                    self._workers.discard(worker)
+                    return
+
+            future, fn, args, kwargs, name, queued_at = task
+            waited = time.perf_counter() - queued_at
+            if not future.set_running_or_notify_cancel():
+                continue
+            if name:
+                worker.name = f"{worker.base_name}:{name}"
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self.failed += 1
+                log(WARNING, "pool.error", f"工作线程任务 {name or fn.__name__} 出错: {e}")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                worker.name = worker.base_name
+                with self._lock:
+                    self.completed += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+
+    @property
+    def workers(self):
+        """
+        当前工作线程数
+        """
+        return len(self._workers)
+
+    def stats(self):
+        """
+        获取统计数据
+        """
+        with self._lock:
+            done = self.completed or 1
+            return {
+                "workers": len(self._workers),
+                "idle": self._idle,
+                "queued": self._tasks.qsize(),
+                "threads_created": self.threads_created,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "peak_queue": self.peak_queue,
+                "peak_workers": self.peak_workers,
+                "wait_avg_ms": self.wait_total / done * 1000,
+                "wait_max_ms": self.wait_max * 1000
+            }
+
+    def report(self):
+        """
+        生成一行统计摘要
+        """
+        s = self.stats()
+        limit = self.max_workers if self.max_workers is not None else "不限"
+        return (f"{self.name} 工作线程 {s['workers']}/{limit}（空闲 {s['idle']}，累计创建 {s['threads_created']}），"
+                f"任务 {s['completed']}/{s['submitted']}（失败 {s['failed']}），排队 {s['queued']}（峰值 {s['peak_queue']}），"
+                f"等待 平均 {s['wait_avg_ms']:.2f} / 最大 {s['wait_max_ms']:.2f} 毫秒")
+
+    def shutdown(self, wait=True, timeout=5.0):
+        """
+        关闭线程池：不再接受新任务，已排队的任务执行完后工作线程退出
+        :param wait: 是否等待工作线程退出
+        :param timeout: 等待的总时长（秒）
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            workers = list(self._workers)
+        for _ in workers:
+            self._tasks.put(_STOP)
+        if wait:
+            deadline = time.monotonic() + timeout
+            for worker in workers:
+                if worker is not threading.current_thread():
+                    worker.join(max(0.0, deadline - time.monotonic()))
+
+
+def wait_done(future, timeout):
+    """
+    等待任务结束，超时不抛异常
+    :param future: submit 返回的Future，None时直接返回True
+    :param timeout: 超时时间（秒）
+    :return: 是否已结束
+    """
+    if future is None:
+        return True
+    done, _ = wait_futures([future], timeout)
+    return bool(done)
+
+
+_pool = None
+_long_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    获取进程内共享的短任务线程池（按配置快照创建）
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                settings = get_settings()
+                pool = WorkerPool(max_workers=settings.worker_pool_size,
+                                  max_queue=settings.worker_pool_queue,
+                                  name="bansr-worker")
+                import atexit
+                atexit.register(pool.shutdown, True, 2.0)
+                _pool = pool
+    return _pool
+
+
+def get_long_pool():
+    """
+    获取进程内共享的长任务线程池：线程数不设上限，长任务从不排队
+    """
+    global _long_pool
+    if _long_pool is None:
+        with _pool_lock:
+            if _long_pool is None:
+                pool = WorkerPool(max_workers=None, max_queue=0, name="bansr-long")
+                import atexit
+                atexit.register(pool.shutdown, True, 2.0)
+                _long_pool = pool
+    return _long_pool
+
+
+def submit(fn, *args, name=None, **kwargs):
+    """
+    向共享线程池提交短任务（参数见 WorkerPool.submit）
+    :raises RuntimeError: 队列已满或线程池已关闭
+    """
+    return get_pool().submit(fn, *args, name=name, **kwargs)
+
+
+def submit_or_run(fn, *args, name=None, **kwargs):
+    """
+    提交短任务，队列已满或线程池已关闭时在调用线程中直接执行
+    :return: concurrent.futures.Future（直接执行时已完成）
+    """
+    try:
+        return get_pool().submit(fn, *args, name=name, **kwargs)
+    except RuntimeError as e:
+        log(WARNING, "pool.full", f"{e}，在当前线程中执行 {name or fn.__name__}")
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        log(WARNING, "pool.error", f"任务 {name or fn.__name__} 出错: {e}")
+        future.set_exception(e)
+    return future
+
+
+def submit_long(fn, *args, name=None, **kwargs):
+    """
+    提交长时间运行的任务（连接循环、录音等），在长任务线程中运行，不占用短任务的工作线程
+    :raises RuntimeError: 线程池已关闭（进程退出时）
+    """
+    return get_long_pool().submit(fn, *args, name=name, **kwargs)
+
+
+def pool_report():
+    """
+    短任务和长任务线程池的统计摘要
+    """
+    return "\n".join(pool.report() for pool in (_pool, _long_pool) if pool is not None)
+
+
+# 性能测试：模拟每轮对话的线程使用方式，比较临时创建线程和共享线程池的开销
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="每轮对话线程开销基准测试")
+    parser.add_argument("--turns", type=int, default=2000, help="模拟的对话轮数")
+    args = parser.parse_args()
+
+    # 每轮的任务：ASR预连接、星火连接、星火发送、TTS初始化、TTS连接、TTS发送
+    # 连接类任务在本轮内一直运行，用事件模拟；发送和初始化为短任务
+    def short_task():
+        pass
+
+    def connection_task(closed):
+        closed.wait()
+
+    def run_turn_threads():
+        closed = threading.Event()
+        threads = [threading.Thread(target=connection_task, args=(closed,)) for _ in range(3)]
+        threads += [threading.Thread(target=short_task) for _ in range(3)]
+        for t in threads:
+            t.start()
+        closed.set()
+        for t in threads:
+            t.join()
+
+    def run_turn_pool(pool, long_pool):
+        closed = threading.Event()
+        futures = [long_pool.submit(connection_task, closed, name="ws") for _ in range(3)]
+        futures += [pool.submit(short_task, name="send") for _ in range(3)]
+        closed.set()
+        for f in futures:
+            f.result()
+
+    start = time.perf_counter()
+    for _ in range(args.turns):
+        run_turn_threads()
+    per_thread_turn = (time.perf_counter() - start) / args.turns
+
+    # 短任务线程池只有1个线程时，长任务也不会占用它
+    pool = WorkerPool(max_workers=1, name="bench")
+    long_pool = WorkerPool(max_workers=None, max_queue=0, name="bench-long")
+    start = time.perf_counter()
+    for _ in range(args.turns):
+        run_turn_pool(pool, long_pool)
+    per_pool_turn = (time.perf_counter() - start) / args.turns
+    created = pool.threads_created + long_pool.threads_created
+    print(f"临时创建线程: {per_thread_turn * 1e6:.0f} 微秒/轮, 共创建 {args.turns * 6} 个线程")
+    print(f"共享线程池:   {per_pool_turn * 1e6:.0f} 微秒/轮, 共创建 {created} 个线程")
+    print(pool.report())
+    print(long_pool.report())
+    pool.shutdown()
+    long_pool.shutdown()
+    assert pool.workers == 0 and long_pool.workers == 0
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 讯飞开放平台WebSocket鉴权模块：ASR、星火大模型和TTS共用
+# 鉴权方式参考: https://www.xfyun.cn/doc/asr/voicedictation/API.html#接口鉴权
+#
+# - host和path从各自的base URL解析，不再硬编码
+# - API_SECRET只编码一次，HMAC密钥状态缓存后每次签名只需copy
+# - 签名URL按秒缓存（date头精度为秒），同一秒内的连接直接复用
+# - 可选的后台线程在每秒开始前预先签好下一秒的URL
+# - 配置热加载后凭证或接口地址变化时丢弃缓存的签名器并停止预签名线程，下次连接时按新配置重新创建
+#
+# 用法示例:
+#   signer = get_signer(API_KEY, API_SECRET, "wss://iat-api.xfyun.cn/v2/iat")
+#   url = signer.sign()
+
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+from settings import on_reload
+from event_log import log, INFO
+
+
+class RequestSigner:
+    """
+    讯飞WebSocket鉴权URL生成器
+    """
+    def __init__(self, api_key, api_secret, base_url, method="GET"):
+        """
+        :param api_key: API_KEY
+        :param api_secret: API_SECRET
+        :param base_url: 接口地址，例如 wss://iat-api.xfyun.cn/v2/iat
+        :param method: 请求方法
+        """
+        parsed = urlparse(base_url)
+        self.base_url = base_url
+        self.host = parsed.netloc
+        self.path = parsed.path or "/"
+        self.request_line = f"{method} {self.path} HTTP/1.1"
+        self.authorization_prefix = f'api_key="{api_key}", algorithm="hmac-sha256", headers="host date request-line", signature="'
+
+        # 缓存带密钥的HMAC状态，每次签名时copy
+        self._hmac = hmac.new(api_secret.encode("utf-8"), digestmod=hashlib.sha256)
+
+        # 签名URL缓存 {秒: URL}，整体替换以保证线程安全
+        self._urls = {}
+
+    def _sign_second(self, second):
+        """
+        生成指定秒的签名URL
+        :param second: Unix时间戳（整秒）
+        :return: 鉴权URL
+        """
+        # 生成RFC1123格式的时间戳
+        date = format_date_time(second)
+        signature_origin = f"host: {self.host}\ndate: {date}\n{self.request_line}"
+
+        # 进行hmac-sha256加密
+        signature = self._hmac.copy()
+        signature.update(signature_origin.encode("utf-8"))
+        signature_sha_base64 = base64.b64encode(signature.digest()).decode()
+
+        authorization_origin = f'{self.authorization_prefix}{signature_sha_base64}"'
+        authorization = base64.b64encode(authorization_origin.encode()).decode()
+
+        # 拼接鉴权参数
+        v = {
+            "authorization": authorization,
+            "date": date,
+            "host": self.host
+        }
+        return self.base_url + "?" + urlencode(v)
+
+    def sign(self):
+        """
+        获取当前时刻的鉴权URL，同一秒内直接返回缓存
+        :return: 鉴权URL
+        """
+        second = int(time.time())
+        url = self._urls.get(second)
+        if url is None:
+            url = self._sign_second(second)
+            self._store(second, url)
+        return url
+
+    def presign(self, second):
+        """
+        预先签好指定秒的URL
+        """
+        if second not in self._urls:
+            self._store(second, self._sign_second(second))
+
+    def _store(self, second, url):
+        # 只保留当前秒附近的条目
+        urls = {s: u for s, u in self._urls.items() if s >= second - 1}
+        urls[second] = url
+        self._urls = urls
+
+
+class _PresignThread(threading.Thread):
+    """
+    后台预签名线程：每秒开始前为已注册的签名器签好下一秒的URL
+    """
+    def __init__(self):
+        super().__init__(name="xf-auth-presign", daemon=True)
+        self.signers = []
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, signer):
+        with self.lock:
+            if signer not in self.signers:
+                self.signers.append(signer)
+
+    def stop(self, timeout=1.0):
+        """
+        停止线程并等待退出
+        """
+        self._stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            now = time.time()
+            next_second = int(now) + 1
+            # 在下一秒开始前约50毫秒醒来
+            if self._stopped.wait(max(0.0, next_second - now - 0.05)):
+                return
+            with self.lock:
+                signers = list(self.signers)
+            for signer in signers:
+                try:
+                    signer.presign(next_second)
+                except Exception as e:
+                    print(f"预签名失败: {e}")
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+_presign_thread = None
+
+
+def get_signer(api_key, api_secret, base_url, presign=False):
+    """
+    获取共享的签名器，相同凭证和地址只创建一次
+    :param api_key: API_KEY
+    :param api_secret: API_SECRET
+    :param base_url: 接口地址
+    :param presign: 是否在后台预先签名
+    :return: RequestSigner对象
+    """
+    global _presign_thread
+    key = (api_key, api_secret, base_url)
+    with _signers_lock:
+        signer = _signers.get(key)
+        if signer is None:
+            signer = RequestSigner(api_key, api_secret, base_url)
+            _signers[key] = signer
+        if presign:
+            if _presign_thread is None:
+                _presign_thread = _PresignThread()
+                _presign_thread.start()
+            _presign_thread.add(signer)
+    return signer
+
+
+def clear_signers():
+    """
+    丢弃所有缓存的签名器并停止预签名线程，之后的 get_signer 调用按当前配置重新创建
+    :return: 丢弃的签名器数量
+    """
+    global _presign_thread
+    with _signers_lock:
+        count = len(_signers)
+        _signers.clear()
+        thread, _presign_thread = _presign_thread, None
+    if thread is not None:
+        thread.stop()
+    return count
+
+
+# 影响签名器缓存键的配置项
+_AUTH_FIELDS = ("api_key", "api_secret", "asr_base_url", "spark_base_url", "tts_base_url", "super_tts_base_url")
+
+
+def _on_settings_reload(old, new):
+    """
+    配置热加载回调：凭证或接口地址变化后旧的签名器不会再被使用，丢弃它们并停止其预签名
+    """
+    if any(getattr(old, field) != getattr(new, field) for field in _AUTH_FIELDS):
+        count = clear_signers()
+        log(INFO, "auth.reload", f"讯飞凭证或接口地址已变化，丢弃 {count} 个签名器", console=False)
+
+
+on_reload(_on_settings_reload)
+
+
+# 测试代码：每次连接的签名耗时对比
+if __name__ == "__main__":
+    from datetime import datetime
+    from time import mktime
+
+    api_key = "0123456789abcdef0123456789abcdef"
+    api_secret = "ZmFrZS1zZWNyZXQtZm9yLWJlbmNobWFyaw=="
+    base_url = "wss://iat-api.xfyun.cn/v2/iat"
+
+    def legacy_sign():
+        # 原有实现：每次重新生成日期、创建HMAC对象并编码密钥
+        now = datetime.now()
+        date = format_date_time(mktime(now.timetuple()))
+        signature_origin = f"host: iat-api.xfyun.cn\ndate: {date}\nGET /v2/iat HTTP/1.1"
+        signature_sha = hmac.new(api_secret.encode("utf-8"), signature_origin.encode("utf-8"), digestmod=hashlib.sha256).digest()
+        signature_sha_base64 = base64.b64encode(signature_sha).decode()
+        authorization_origin = f'api_key="{api_key}", algorithm="hmac-sha256", headers="host date request-line", signature="{signature_sha_base64}"'
+        authorization = base64.b64encode(authorization_origin.encode()).decode()
+        return base_url + "?" + urlencode({"authorization": authorization, "date": date, "host": "iat-api.xfyun.cn"})
+
+    signer = RequestSigner(api_key, api_secret, base_url)
+    second = int(time.time())
+    assert signer._sign_second(second) == legacy_sign() or int(time.time()) != second
+
+    rounds = 20000
+
+    def bench(name, func):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        print(f"{name}: {(time.perf_counter() - start) / rounds * 1e6:.2f} 微秒/次")
+
+    bench("原有实现", legacy_sign)
+    bench("缓存HMAC状态，不缓存URL", lambda: signer._sign_second(int(time.time())))
+    bench("按秒缓存URL", signer.sign)
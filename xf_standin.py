@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 讯飞接口本地替身：仅依赖标准库的最小WebSocket服务器和客户端
+# 用于在没有网络和API密钥的情况下对上行发送、重连等逻辑做基准测试
+#
+# - 服务器可限制接收带宽，模拟慢速上行链路
+# - 每个连接在独立线程中交给 handler(conn, path) 处理
+# - iat_handler 模拟听写接口：统计收到的消息，收到最后一帧后返回识别结果
+# - spark_handler / tts_handler 模拟星火大模型和语音合成接口，返回固定内容
+#
+# 用法示例:
+#   server = StandInServer(iat_handler, bandwidth=64000)
+#   server.start()
+#   ws = StandInClient(server.url("/v2/iat"))
+#   ws.send('{"data": {...}}')
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+def _accept_key(key):
+    """
+    计算握手响应中的Sec-WebSocket-Accept
+    """
+    digest = hashlib.sha1((key + _WS_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def _encode_frame(opcode, payload, mask=False):
+    """
+    编码一个不分片的WebSocket帧
+    :param opcode: 操作码
+    :param payload: 负载字节
+    :param mask: 是否加掩码（客户端发送时必须加掩码）
+    :return: 帧字节
+    """
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header += struct.pack("!H", length)
+    else:
+        header.append(mask_bit | 127)
+        header += struct.pack("!Q", length)
+    if not mask:
+        return bytes(header) + payload
+    mask_key = os.urandom(4)
+    return bytes(header) + mask_key + _apply_mask(payload, mask_key)
+
+
+def _apply_mask(payload, mask_key):
+    """
+    对负载按4字节掩码做异或
+    """
+    # 整块转成大整数异或，比逐字节循环快得多
+    length = len(payload)
+    repeated = (mask_key * (length // 4 + 1))[:length]
+    masked = int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")
+    return masked.to_bytes(length, "big")
+
+
+class _FrameSocket:
+    """
+    在TCP连接上收发WebSocket帧
+    """
+    def __init__(self, sock, mask, bandwidth=None):
+        """
+        :param sock: 已完成握手的socket
+        :param mask: 发送时是否加掩码
+        :param bandwidth: 接收带宽上限（字节/秒），None表示不限
+        """
+        self.sock = sock
+        self.mask = mask
+        self.bandwidth = bandwidth
+        self.buffer = b""
+        self.received_bytes = 0
+        self.closed = False
+        self.send_lock = threading.Lock()
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            # 限速时每次只读一小块，按带宽补足耗时，对端的发送缓冲区会因此填满
+            chunk_size = 4096 if self.bandwidth else 65536
+            start = time.perf_counter()
+            chunk = self.sock.recv(chunk_size)
+            if not chunk:
+                raise ConnectionError("连接已关闭")
+            self.received_bytes += len(chunk)
+            self.buffer += chunk
+            if self.bandwidth:
+                delay = len(chunk) / self.bandwidth - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def recv_frame(self):
+        """
+        接收一条完整消息（会合并分片）
+        :return: (操作码, 负载)
+        """
+        message_opcode = None
+        parts = []
+        while True:
+            first, second = self._read(2)
+            fin = first & 0x80
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self._read(8))[0]
+            mask_key = self._read(4) if second & 0x80 else None
+            payload = self._read(length)
+            if mask_key:
+                payload = _apply_mask(payload, mask_key)
+
+            # 控制帧可以插在分片之间，直接返回
+            if opcode >= OPCODE_CLOSE:
+                return opcode, payload
+            if opcode != OPCODE_CONTINUATION:
+                message_opcode = opcode
+            parts.append(payload)
+            if fin:
+                return message_opcode, b"".join(parts)
+
+    def send_frame(self, opcode, payload):
+        with self.send_lock:
+            self.sock.sendall(_encode_frame(opcode, payload, self.mask))
+
+    def send(self, message):
+        """
+        发送一条文本消息
+        :param message: 字符串或字节
+        """
+        if isinstance(message, str):
+            self.send_frame(OPCODE_TEXT, message.encode("utf-8"))
+        else:
+            self.send_frame(OPCODE_BINARY, message)
+
+    def recv(self):
+        """
+        接收一条数据消息，自动回复ping
+        :return: 文本消息字符串（二进制消息返回字节），连接关闭时返回None
+        """
+        while not self.closed:
+            try:
+                opcode, payload = self.recv_frame()
+            except (ConnectionError, OSError):
+                self.closed = True
+                return None
+            if opcode == OPCODE_PING:
+                self.send_frame(OPCODE_PONG, payload)
+            elif opcode == OPCODE_CLOSE:
+                self.close()
+                return None
+            elif opcode == OPCODE_TEXT:
+                return payload.decode("utf-8")
+            elif opcode == OPCODE_BINARY:
+                return payload
+        return None
+
+    def close(self):
+        """
+        发送关闭帧并关闭连接
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_frame(OPCODE_CLOSE, struct.pack("!H", 1000))
+        except OSError:
+            pass
+        try:
+            # 与websocket-client一样先shutdown，唤醒其他线程中阻塞的recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class StandInServer:
+    """
+    最小WebSocket替身服务器
+    """
+    def __init__(self, handler, host="127.0.0.1", port=0, bandwidth=None, recv_buffer=None):
+        """
+        :param handler: 连接处理函数 handler(conn, path)
+        :param host: 监听地址
+        :param port: 监听端口，0表示随机端口
+        :param bandwidth: 每个连接的接收带宽上限（字节/秒），None表示不限
+        :param recv_buffer: 接收缓冲区大小（字节），限速时调小可更快形成反压
+        """
+        self.handler = handler
+        self.bandwidth = bandwidth
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if recv_buffer:
+            # 必须在listen前设置，accept得到的连接才会继承
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()[:2]
+        self.connections = []
+        self._thread = None
+        self._closed = False
+
+    def url(self, path="/"):
+        """
+        获取连接地址
+        """
+        return f"ws://{self.host}:{self.port}{path}"
+
+    def start(self):
+        """
+        在后台线程中开始接受连接
+        """
+        self.sock.listen(16)
+        self._thread = threading.Thread(target=self._accept_loop, name="standin-accept", daemon=True)
+        self._thread.start()
+        return self
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), name="standin-conn", daemon=True).start()
+
+    def _serve(self, client):
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                chunk = client.recv(4096)
+                if not chunk:
+                    client.close()
+                    return
+                request += chunk
+            head, rest = request.split(b"\r\n\r\n", 1)
+            lines = head.decode("latin-1").split("\r\n")
+            path = lines[0].split(" ")[1]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            response = ("HTTP/1.1 101 Switching Protocols\r\n"
+                        "Upgrade: websocket\r\n"
+                        "Connection: Upgrade\r\n"
+                        f"Sec-WebSocket-Accept: {_accept_key(headers.get('sec-websocket-key', ''))}\r\n\r\n")
+            client.sendall(response.encode())
+
+            conn = _FrameSocket(client, mask=False, bandwidth=self.bandwidth)
+            conn.buffer = rest
+            self.connections.append(conn)
+            self.handler(conn, path)
+        except Exception as e:
+            print(f"替身服务器处理连接出错: {e}")
+        finally:
+            try:
+                client.close()
+            except OSError:
+                pass
+
+    def stop(self):
+        """
+        停止接受新连接
+        """
+        self._closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class StandInClient(_FrameSocket):
+    """
+    最小WebSocket客户端，接口与websocket-client的send/recv/close一致
+    """
+    def __init__(self, url, send_buffer=None, timeout=10):
+        """
+        :param url: ws://地址
+        :param send_buffer: 发送缓冲区大小（字节）
+        :param timeout: 连接超时（秒）
+        """
+        parsed = urlparse(url)
+        sock = socket.create_connection((parsed.hostname, parsed.port or 80), timeout=timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        request = (f"GET {path} HTTP/1.1\r\n"
+                   f"Host: {parsed.netloc}\r\n"
+                   "Upgrade: websocket\r\n"
+                   "Connection: Upgrade\r\n"
+                   f"Sec-WebSocket-Key: {key}\r\n"
+                   "Sec-WebSocket-Version: 13\r\n\r\n")
+        sock.sendall(request.encode())
+
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("握手失败：连接已关闭")
+            response += chunk
+        head, rest = response.split(b"\r\n\r\n", 1)
+        if b" 101 " not in head.split(b"\r\n", 1)[0] or _accept_key(key).encode() not in head:
+            raise ConnectionError(f"握手失败: {head.decode('latin-1')}")
+
+        super().__init__(sock, mask=True)
+        self.buffer = rest
+
+
+def iat_handler(conn, path):
+    """
+    模拟讯飞听写接口：统计上行消息，收到最后一帧后返回一条识别结果并关闭
+    统计结果保存在 conn.stats 中
+    """
+    conn.stats = {"messages": 0, "audio_bytes": 0, "first_frame": None, "last_frame": False}
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        data = json.loads(message)["data"]
+        conn.stats["messages"] += 1
+        conn.stats["audio_bytes"] += len(base64.b64decode(data["audio"]))
+        if conn.stats["first_frame"] is None:
+            conn.stats["first_frame"] = data["status"] == 0
+        if data["status"] == 2:
+            conn.stats["last_frame"] = True
+            result = {
+                "code": 0,
+                "message": "success",
+                "data": {"status": 2, "result": {"ws": [{"cw": [{"w": "你好"}]}]}}
+            }
+            conn.send(json.dumps(result, ensure_ascii=False))
+            conn.close()
+            return
+
+
+# 替身大模型的固定回复，按token分段返回
+SPARK_REPLY_TOKENS = ["你好，", "我是", "本地替身，", "这是一条", "测试回复。"]
+
+
+def spark_handler(conn, path):
+    """
+    模拟星火大模型接口：收到请求后逐token返回固定回复并关闭
+    """
+    if conn.recv() is None:
+        return
+    last = len(SPARK_REPLY_TOKENS) - 1
+    for seq, token in enumerate(SPARK_REPLY_TOKENS):
+        status = 0 if seq == 0 else (2 if seq == last else 1)
+        reply = {
+            "header": {"code": 0, "message": "Success", "sid": "standin", "status": status},
+            "payload": {"choices": {"status": status, "seq": seq,
+                                    "text": [{"content": token, "role": "assistant", "index": 0}]}}
+        }
+        conn.send(json.dumps(reply, ensure_ascii=False))
+    conn.close()
+
+
+def tts_handler(conn, path, chunks=3, chunk_size=2048):
+    """
+    模拟语音合成接口：收到请求后返回若干个音频块并关闭
+    请求中带有header字段时按超拟人合成的格式返回，否则按普通在线合成的格式返回
+    """
+    message = conn.recv()
+    if message is None:
+        return
+    super_tts = "header" in json.loads(message)
+    audio = base64.b64encode(b"\xff\xf3" + b"\x00" * (chunk_size - 2)).decode()
+    for seq in range(chunks):
+        status = 2 if seq == chunks - 1 else 1
+        if super_tts:
+            reply = {"header": {"code": 0, "message": "success", "sid": "standin", "status": status},
+                     "payload": {"audio": {"audio": audio, "status": status, "seq": seq}}}
+        else:
+            reply = {"code": 0, "message": "success", "sid": "standin",
+                     "data": {"audio": audio, "status": status, "ced": str(seq)}}
+        conn.send(json.dumps(reply))
+    conn.close()
+
+
+def route_handler(conn, path):
+    """
+    按路径分发到对应的替身接口：/v2/iat、/v2/tts（或/v1/private/...超拟人合成），其余视为星火大模型
+    """
+    if path.startswith("/v2/iat"):
+        iat_handler(conn, path)
+    elif "tts" in path or path.startswith("/v1/private"):
+        tts_handler(conn, path)
+    else:
+        spark_handler(conn, path)
+
+
+# 测试代码：回环自检
+if __name__ == "__main__":
+    server = StandInServer(iat_handler).start()
+    ws = StandInClient(server.url("/v2/iat"))
+    audio = base64.b64encode(b"\x00" * 1280).decode()
+    for status in (0, 1, 1, 2):
+        ws.send(json.dumps({"data": {"status": status, "audio": audio}}))
+    reply = ws.recv()
+    ws.close()
+    server.stop()
+    stats = server.connections[0].stats
+    assert stats["messages"] == 4 and stats["audio_bytes"] == 4 * 1280 and stats["last_frame"]
+    print(f"替身服务器收到 {stats['messages']} 条消息, 回复: {reply}")